@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''Synthetic node hierarchies exercised by the benchmarks.
+
+Node classes are generated at import time and registered in the module, so
+that build_urls picks them up like hand-written nodes.'''
+from datetime import datetime
+from nuages.nodes import ResourceNode, CollectionNode, parseQueryString
+from nuages.forms import Validator, Param
+from nuages.http import Etag
+
+
+LAST_MODIFIED = datetime(2012, 1, 1)
+CHILDREN_COUNT = 20
+DEPTH = 5
+COLLECTION_SIZES = (('10', 10), ('1k', 1000), ('50k', 50000))
+
+
+def register(cls):
+    globals()[cls.__name__] = cls
+    return cls
+
+
+class BenchmarkResource(ResourceNode):
+    '''Readable resource with a constant ETag.'''
+    def _can_read(self):
+        return True
+
+    def get_etag(self):
+        return Etag(LAST_MODIFIED, self.__class__.__name__)
+
+    def retrieve(self):
+        return {'name': self.__class__.__name__,
+                'modified': LAST_MODIFIED,
+                'tags': ['nuages', 'benchmark']}
+
+
+class Resource(BenchmarkResource):
+    '''Resource with CHILDREN_COUNT children, each rendered as a link.'''
+    url = r'^resource/$'
+
+
+for i in range(CHILDREN_COUNT):
+    register(type('Child%02d' % i, (BenchmarkResource,),
+                  {'__module__': __name__,
+                   'url': r'^child%02d/$' % i,
+                   'parent': Resource}))
+
+
+class Private(BenchmarkResource):
+    '''Resource that can never be read.'''
+    url = r'^private/$'
+
+    def _can_read(self):
+        return False
+
+
+class SearchValidator(Validator):
+    q = Param()
+    limit = Param(type=int, required=False, default=10, min_value=1)
+
+
+class Search(BenchmarkResource):
+    url = r'^search/$'
+
+    @parseQueryString(SearchValidator)
+    def retrieve(self, validator, q, limit=10):
+        return {'q': q, 'limit': limit}
+
+
+class Item(BenchmarkResource):
+    '''Item of a collection. The parent and the url are set by the
+    collection.'''
+    def get_etag(self):
+        return Etag(LAST_MODIFIED, self.id)
+
+    def retrieve(self):
+        return {'id': self.id, 'modified': LAST_MODIFIED}
+
+
+class Items(CollectionNode):
+    '''Collection of size items.'''
+    size = 0
+    item_cls = None
+
+    def _can_read(self):
+        return True
+
+    def get_etag(self):
+        return Etag(LAST_MODIFIED, self.__class__.__name__)
+
+    def list(self, offset=0, limit=None):
+        last = self.size if limit is None else min(self.size, limit + 1)
+        return [self.item_cls(self.request, parent_node=self, id=str(i))
+                for i in xrange(offset, last)]
+
+
+for label, size in COLLECTION_SIZES:
+    collection_cls = register(type('Items%s' % label, (Items,),
+                                   {'__module__': __name__,
+                                    'url': r'^items-%s/$' % label,
+                                    'range_unit': 'items',
+                                    'size': size}))
+    collection_cls.item_cls = register(type('Item%s' % label, (Item,),
+                                            {'__module__': __name__,
+                                             'url': r'^(?P<id>\d+)/$',
+                                             'parent': collection_cls}))
+
+
+level_cls = None
+for depth in range(1, DEPTH + 1):
+    level_cls = register(type('Level%d' % depth, (BenchmarkResource,),
+                              {'__module__': __name__,
+                               'url': r'^l%d/(?P<l%d>\d+)/$' % (depth, depth),
+                               'parent': level_cls}))
+del level_cls
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+'''Runs the benchmark suite of the Nuages request pipeline.
+
+Usage, from the root of the repository:
+
+    python -m benchmarks.run [options] [scenario ...]
+
+Each scenario runs in a process of its own, so that the peak memory it
+reports is its own. Results can be saved as a baseline with --save, and
+are compared to the baseline given with --baseline: the run fails when a
+scenario got slower, or used more memory, than the tolerance allows.
+
+The baseline of the repository, benchmarks/baseline.json, is regenerated
+with:
+
+    python -m benchmarks.run --save benchmarks/baseline.json'''
+import os
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import sys
+import json
+import timeit
+import resource
+import platform
+import multiprocessing
+from optparse import OptionParser
+
+
+DEFAULT_TOLERANCE = .1
+
+
+def percentile(sorted_values, percent):
+    '''Nearest-rank percentile of a sorted list.'''
+    index = int(round(percent / 100.0 * len(sorted_values) + .5)) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
+
+def measure(name, driver, iterations, warmup):
+    '''Runs a scenario and returns its results. Meant to be called in a
+    process of its own.'''
+    from benchmarks.scenarios import get_scenario
+    scenario = get_scenario(name)
+    iterations = iterations or scenario.iterations
+    run = scenario.get_runner(driver)
+
+    status = run()
+    if status != scenario.status:
+        raise AssertionError('%s (%s) returned %s instead of %s' %
+                             (name, driver, status, scenario.status))
+    for i in xrange(min(warmup, iterations)):
+        run()
+
+    timer = timeit.default_timer
+    latencies = []
+    started = timer()
+    for i in xrange(iterations):
+        start = timer()
+        run()
+        latencies.append(timer() - start)
+    total = timer() - started
+
+    latencies.sort()
+    return {'scenario': name,
+            'driver': driver,
+            'iterations': iterations,
+            'throughput': iterations / total,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def measure_in_process(name, driver, iterations, warmup):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(measure, (name, driver, iterations, warmup))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def get_key(result):
+    return '%s/%s' % (result['scenario'], result['driver'])
+
+
+def compare(result, baseline, tolerance):
+    '''Returns the list of the regressions of result against baseline.'''
+    regressions = []
+    if result['p50'] > baseline['p50'] * (1 + tolerance):
+        regressions.append('p50')
+    if result['p99'] > baseline['p99'] * (1 + tolerance):
+        regressions.append('p99')
+    if result['throughput'] < baseline['throughput'] / (1 + tolerance):
+        regressions.append('throughput')
+    if result['peak_rss'] > baseline['peak_rss'] * (1 + tolerance):
+        regressions.append('peak_rss')
+    return regressions
+
+
+def format_change(value, baseline_value):
+    if not baseline_value:
+        return ''
+    return ' (%+.1f%%)' % ((value - baseline_value) * 100.0 / baseline_value)
+
+
+def report(result, baseline=None, regressions=()):
+    baseline = baseline or {}
+    columns = [
+        '%-26s' % get_key(result),
+        '%9.1f req/s%s' % (result['throughput'],
+                           format_change(result['throughput'],
+                                         baseline.get('throughput'))),
+        'p50 %8.3f ms%s' % (result['p50'] * 1000,
+                            format_change(result['p50'],
+                                          baseline.get('p50'))),
+        'p99 %8.3f ms%s' % (result['p99'] * 1000,
+                            format_change(result['p99'],
+                                          baseline.get('p99'))),
+        'peak %7.1f MB%s' % (result['peak_rss'] / 1024.0,
+                             format_change(result['peak_rss'],
+                                           baseline.get('peak_rss'))),
+    ]
+    if regressions:
+        columns.append('REGRESSION: %s' % ', '.join(regressions))
+    print '  '.join(columns)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('-d', '--driver', action='append', dest='drivers',
+                      help='Only run the scenarios with the given driver ' \
+                           '(client, direct or call).')
+    parser.add_option('-n', '--iterations', type='int', default=0,
+                      help='Number of iterations of every scenario, ' \
+                           'overriding their defaults.')
+    parser.add_option('-w', '--warmup', type='int', default=3,
+                      help='Iterations run before measuring.')
+    parser.add_option('-b', '--baseline',
+                      help='JSON file of results to compare to.')
+    parser.add_option('-t', '--tolerance', type='float',
+                      default=DEFAULT_TOLERANCE,
+                      help='Slowdown tolerated before reporting a ' \
+                           'regression, as a ratio (default %default).')
+    parser.add_option('-s', '--save',
+                      help='Saves the results to the given JSON file.')
+    parser.add_option('-l', '--list', action='store_true', default=False,
+                      help='Lists the scenarios.')
+    options, names = parser.parse_args(argv)
+
+    from benchmarks.scenarios import SCENARIOS
+    scenarios = [s for s in SCENARIOS if not names or s.name in names]
+    if options.list:
+        for scenario in SCENARIOS:
+            print '%-26s %s' % (scenario.name, ', '.join(scenario.drivers))
+        return 0
+
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    results, failed = {}, []
+    for scenario in scenarios:
+        for driver in scenario.drivers:
+            if options.drivers and driver not in options.drivers:
+                continue
+
+            result = measure_in_process(scenario.name, driver,
+                                        options.iterations, options.warmup)
+            key = get_key(result)
+            results[key] = result
+            regressions = []
+            if key in baseline:
+                regressions = compare(result, baseline[key],
+                                      options.tolerance)
+            if regressions:
+                failed.append(key)
+            report(result, baseline.get(key), regressions)
+
+    if options.save:
+        import django
+        with open(options.save, 'w') as results_file:
+            json.dump({'python': platform.python_version(),
+                       'django': django.get_version(),
+                       'platform': platform.platform(),
+                       'results': results}, results_file, indent=2,
+                      sort_keys=True)
+
+    if failed:
+        print '%d regression(s): %s' % (len(failed), ', '.join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
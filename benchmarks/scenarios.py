@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+'''Scenarios of the benchmark suite.
+
+Request scenarios can be driven through Django's test client, or directly
+through the hooks of the middleware and Node.process, which leaves URL
+resolution and Django's request handler out of the measure.'''
+from django.test.client import Client, RequestFactory
+from django.core.urlresolvers import resolve
+from nuages.middlewares import RequestHandlerMiddleware
+from nuages.core.formatters import ApiResponseFormatter
+from nuages.http import HttpRequest, HttpResponse, HttpError
+from benchmarks.nodes import LAST_MODIFIED
+
+
+CLIENT = 'client'
+DIRECT = 'direct'
+CALL = 'call'
+
+
+class Scenario(object):
+    drivers = (CLIENT, DIRECT)
+
+    def __init__(self, name, path, method='GET', status=200, iterations=200,
+                 headers=None):
+        self.name = name
+        self.path = path
+        self.method = method
+        self.status = status
+        self.iterations = iterations
+        self.headers = dict(headers or {})
+        self.headers.setdefault('HTTP_ACCEPT', 'application/json')
+
+    def get_runner(self, driver):
+        '''Returns a callable processing the request of the scenario once,
+        and returning the status of the response.'''
+        if driver == CLIENT:
+            client = Client()
+            send = getattr(client, self.method.lower())
+            return lambda: send(self.path, **self.headers).status_code
+
+        factory = RequestFactory()
+        build_request = getattr(factory, self.method.lower())
+        match = resolve(self.path)
+        middleware = RequestHandlerMiddleware()
+
+        def run():
+            request = build_request(self.path, **self.headers)
+            response = middleware.process_view(request, match.func, (),
+                                               match.kwargs)
+            if response is None:
+                try:
+                    response = match.func(request, **match.kwargs)
+                except HttpError, e:
+                    response = middleware.process_exception(request, e)
+            response = middleware.process_response(request, response)
+            if not isinstance(response.content, basestring):
+                ''.join(response) #Consumes streamed content.
+            return response.status_code
+        return run
+
+
+class SerializationScenario(Scenario):
+    '''Formats the payload of a collection of size items, without going
+    through any node.'''
+    drivers = (CALL,)
+
+    def __init__(self, name, size, content_type='application/json',
+                 iterations=200):
+        super(SerializationScenario, self).__init__(
+                                            name, '/', iterations=iterations,
+                                            headers={'HTTP_ACCEPT':
+                                                     content_type})
+        self.size = size
+
+    def get_runner(self, driver):
+        request = HttpRequest(RequestFactory().get(self.path, **self.headers))
+        payload = [{'uri': 'http://testserver/items-1k/%d/' % i,
+                    'etag': '%d-%d' % (i, i),
+                    'modified': LAST_MODIFIED} for i in xrange(self.size)]
+
+        def run():
+            response = HttpResponse()
+            response.payload = payload
+            ApiResponseFormatter(request, response).format()
+            return response.status_code
+        return run
+
+
+LEAF = '/l1/1/l2/2/l3/3/l4/4/l5/5/'
+NOT_MODIFIED_SINCE = 'Wed, 01 Jan 2020 00:00:00 GMT'
+SCENARIOS = [
+    Scenario('resource_children', '/resource/'),
+    Scenario('collection_10', '/items-10/'),
+    Scenario('collection_10_range', '/items-10/', status=206,
+             headers={'HTTP_RANGE': 'items=0-4'}),
+    Scenario('collection_1k', '/items-1k/', iterations=20),
+    Scenario('collection_1k_range', '/items-1k/', status=206,
+             headers={'HTTP_RANGE': 'items=0-99'}),
+    Scenario('collection_1k_html', '/items-1k/', iterations=20,
+             headers={'HTTP_ACCEPT': 'text/html'}),
+    Scenario('collection_50k', '/items-50k/', iterations=3),
+    Scenario('collection_50k_range', '/items-50k/', status=206,
+             headers={'HTTP_RANGE': 'items=25000-25099'}),
+    Scenario('deep_5', LEAF),
+    Scenario('conditional_304', '/resource/', status=304,
+             headers={'HTTP_IF_MODIFIED_SINCE': NOT_MODIFIED_SINCE}),
+    Scenario('options', '/resource/', method='OPTIONS'),
+    Scenario('error_403', '/private/', status=403),
+    Scenario('error_400', '/search/', status=400),
+    Scenario('error_405', '/resource/', method='DELETE', status=405),
+    Scenario('error_406', '/resource/', status=406,
+             headers={'HTTP_ACCEPT': 'image/png'}),
+    Scenario('error_416', '/items-10/', status=416,
+             headers={'HTTP_RANGE': 'items=100-199'}),
+    SerializationScenario('serialize_json_1k', 1000),
+]
+
+
+def get_scenario(name):
+    for scenario in SCENARIOS:
+        if scenario.name == name:
+            return scenario
+    raise KeyError(name)
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+'''Django settings used by the benchmark suite.'''
+DEBUG = False
+TEMPLATE_DEBUG = False
+SECRET_KEY = 'nuages-benchmarks'
+ROOT_URLCONF = 'benchmarks.urls'
+INSTALLED_APPS = ('nuages',)
+MIDDLEWARE_CLASSES = ('nuages.middlewares.RequestHandlerMiddleware',)
+DEFAULT_CONTENT_TYPE = 'application/json'
+TEMPLATE_DIRS = [] #Extended by nuages.settings
+TIME_ZONE = 'UTC'
+#Nodes are cached by Node.__new__, the benchmarks measure their processing.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    }
+}
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+from nuages.conf.urls import build_urls
+
+
+urlpatterns = build_urls('benchmarks.nodes')
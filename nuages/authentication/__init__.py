@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+import hmac
+import time
+import hashlib
+from django.conf import settings
+from django.contrib import auth
+from django.utils.crypto import constant_time_compare
+from django.utils.http import parse_http_date
+from django.utils.importlib import import_module
+from nuages.core import metrics
+from nuages.http import UnauthorizedError, PRINCIPAL_ATTRIBUTE, hash_body
+from nuages.utils.lru import LRUCache
+
+
+__all__ = ('Authentication', 'BasicAuthentication', 'BearerAuthentication',
+           'HMACAuthentication', 'authenticate', 'get_challenges',
+           'get_principal_key')
+
+'''
+Django settings:
+#NUAGES_AUTHENTICATION_BACKENDS
+#NUAGES_AUTHENTICATION_REALM
+#NUAGES_AUTHENTICATION_CACHE_SIZE
+#NUAGES_AUTHENTICATION_CACHE_TIMEOUT
+#NUAGES_HMAC_MAX_SKEW
+'''
+BACKENDS = getattr(settings, 'NUAGES_AUTHENTICATION_BACKENDS', ())
+REALM = getattr(settings, 'NUAGES_AUTHENTICATION_REALM', 'api')
+CACHE_SIZE = getattr(settings, 'NUAGES_AUTHENTICATION_CACHE_SIZE', 1000)
+CACHE_TIMEOUT = getattr(settings, 'NUAGES_AUTHENTICATION_CACHE_TIMEOUT', 300)
+HMAC_MAX_SKEW = getattr(settings, 'NUAGES_HMAC_MAX_SKEW', 300)
+
+
+class Authentication(object):
+    '''Base class of the authentication backends listed in
+    NUAGES_AUTHENTICATION_BACKENDS, each handling the requests whose
+    Authorization header uses its scheme.
+
+    Principals successfully verified are kept in an in-process LRU cache
+    for CACHE_TIMEOUT seconds, keyed by get_cache_key(credentials), so
+    a revoked credential can remain valid for that long.'''
+    scheme = None
+
+    def __init__(self):
+        self.cache = LRUCache(CACHE_SIZE, CACHE_TIMEOUT)
+
+    def get_challenge(self):
+        '''Returns the challenge of the backend, for the WWW-Authenticate
+        header of 401 responses.'''
+        return '%s realm="%s"' % (self.scheme, REALM)
+
+    def get_credentials(self, request):
+        '''Returns the credentials carried by the request, or None if they
+        are malformed.'''
+        raise NotImplementedError
+
+    def get_cache_key(self, credentials):
+        '''Returns the key of the credentials in the cache, None if their
+        verification can't be cached.'''
+        return hashlib.sha256('\0'.join(credentials)).hexdigest()
+
+    def verify(self, request, credentials):
+        '''Returns the principal identified by the credentials, None if
+        they're not valid.'''
+        raise NotImplementedError
+
+    def authenticate(self, request):
+        credentials = self.get_credentials(request)
+        if credentials is None:
+            return None
+
+        key = self.get_cache_key(credentials)
+        if key is None:
+            return self.verify(request, credentials)
+
+        principal = self.cache.get(key)
+        metrics.record_cache('authentication', principal is not None)
+        if principal is None:
+            principal = self.verify(request, credentials)
+            if principal is not None:
+                self.cache.set(key, principal)
+        return principal
+
+
+class BasicAuthentication(Authentication):
+    '''Authenticates the users of django.contrib.auth with their username
+    and password.'''
+    scheme = 'Basic'
+
+    def get_credentials(self, request):
+        value = request.META.get('HTTP_AUTHORIZATION')
+        if isinstance(value, tuple) and len(value) == 3:
+            return value[1:]
+
+    def verify(self, request, credentials):
+        username, password = credentials
+        user = auth.authenticate(username=username, password=password)
+        if user is not None and user.is_active:
+            return user
+
+
+class BearerAuthentication(Authentication):
+    '''Authenticates requests carrying a token. Subclasses implement
+    verify_token.'''
+    scheme = 'Bearer'
+
+    def get_credentials(self, request):
+        value = request.META.get('HTTP_AUTHORIZATION')
+        if isinstance(value, tuple) and len(value) == 2 and value[1]:
+            return (value[1].strip(' '),)
+
+    def verify(self, request, credentials):
+        return self.verify_token(credentials[0])
+
+    def verify_token(self, token):
+        '''Returns the principal the token was issued to, None if it's not
+        valid.'''
+        raise NotImplementedError
+
+
+class HMACAuthentication(Authentication):
+    '''Authenticates requests signed with a secret shared with the client.
+
+    The Authorization header is "HMAC <key id>:<signature>", where the
+    signature is the hex HMAC-SHA256 of the method, the full path, the Date
+    header and the hex SHA256 of the body, separated by new lines. Requests
+    dated more than NUAGES_HMAC_MAX_SKEW seconds away are rejected. Large
+    bodies are hashed from a temporary file (see nuages.http.hash_body).
+
+    Signatures differ from one request to the other, so the cache holds
+    the keys returned by get_key instead. Subclasses implement get_key.'''
+    scheme = 'HMAC'
+
+    def get_credentials(self, request):
+        value = request.META.get('HTTP_AUTHORIZATION')
+        if not isinstance(value, tuple) or len(value) != 2:
+            return None
+
+        key_id, _, signature = value[1].strip(' ').partition(':')
+        if key_id and signature:
+            return key_id, signature
+
+    def get_key(self, key_id):
+        '''Returns a (secret, principal) tuple for the key, None if it
+        doesn't exist.'''
+        raise NotImplementedError
+
+    def get_string_to_sign(self, request):
+        return '\n'.join([request.method,
+                          request.get_full_path(),
+                          request.META.get_raw('HTTP_DATE', ''),
+                          hash_body(request, 'sha256')])
+
+    def verify(self, request, credentials):
+        key_id, signature = credentials
+        try:
+            date = parse_http_date(request.META.get_raw('HTTP_DATE', ''))
+        except ValueError:
+            return None
+        if abs(time.time() - date) > HMAC_MAX_SKEW:
+            return None
+
+        key = self.cache.get(key_id)
+        metrics.record_cache('authentication', key is not None)
+        if key is None:
+            key = self.get_key(key_id)
+            if key is None:
+                return None
+            self.cache.set(key_id, key)
+
+        secret, principal = key
+        expected = hmac.new(secret, self.get_string_to_sign(request),
+                            hashlib.sha256).hexdigest()
+        if constant_time_compare(signature, expected):
+            return principal
+
+    def authenticate(self, request):
+        credentials = self.get_credentials(request)
+        if credentials is not None:
+            return self.verify(request, credentials)
+
+
+_backends = None
+def get_backends():
+    global _backends
+    if _backends is None:
+        backends = []
+        for path in BACKENDS:
+            module_name, class_name = path.rsplit('.', 1)
+            backends.append(getattr(import_module(module_name),
+                                    class_name)())
+        _backends = backends
+    return _backends
+
+
+def get_challenges():
+    return [backend.get_challenge() for backend in get_backends()]
+
+
+def get_principal_key(principal):
+    '''Returns a string identifying a principal, empty for anonymous
+    requests.'''
+    if principal is None:
+        return ''
+    return '%s:%s' % (principal.__class__.__name__,
+                      getattr(principal, 'pk', principal))
+
+
+def authenticate(request, node=None):
+    '''Authenticates the request with the backend of the scheme of its
+    Authorization header, once per request, and returns its principal.
+    Requests without credentials, or with a scheme no backend handles, are
+    anonymous and get a None principal. Invalid credentials raise an
+    UnauthorizedError.'''
+    base_request = getattr(request, '_base_request', request)
+    if hasattr(base_request, PRINCIPAL_ATTRIBUTE):
+        return getattr(base_request, PRINCIPAL_ATTRIBUTE)
+
+    principal = None
+    header = request.META.get_raw('HTTP_AUTHORIZATION')
+    if header:
+        scheme = header.strip(' ').split(' ', 1)[0].upper()
+        for backend in get_backends():
+            if backend.scheme.upper() != scheme:
+                continue
+
+            principal = backend.authenticate(request)
+            if principal is None:
+                raise UnauthorizedError(node, get_challenges(),
+                                        'Invalid credentials.')
+            break
+
+    setattr(base_request, PRINCIPAL_ATTRIBUTE, principal)
+    return principal
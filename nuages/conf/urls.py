@@ -50,7 +50,9 @@ def __build_node_url(node_cls):
         logger.warn('%s has none of the handlers required to define ' \
                     'the HTTP methods it supports' %
                     (node_cls.name or node_cls.__name__,))
-    
+
+    #The description served to OPTIONS requests is computed at startup.
+    node_cls.get_doc_representation()
     return url(node_cls.get_full_url_pattern(), node_cls.process,
                name=node_cls.get_view_name())
     
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from nuages.core import instrumentation
+from nuages.http import TooManyRequestsError, ServiceUnavailableError
+from nuages.authentication import get_principal_key
+from nuages.signals import request_shed
+from nuages.utils.lru import LRUCache
+
+
+__all__ = ('Gate', 'TokenBucket', 'admit')
+
+'''
+Django settings:
+#NUAGES_RETRY_AFTER
+#NUAGES_RATE_LIMIT_STORE
+#NUAGES_RATE_LIMIT_CACHE_SIZE
+#NUAGES_REQUEST_START_HEADER
+'''
+RETRY_AFTER = getattr(settings, 'NUAGES_RETRY_AFTER', 1)
+RATE_LIMIT_STORE = getattr(settings, 'NUAGES_RATE_LIMIT_STORE', 'memory')
+RATE_LIMIT_CACHE_SIZE = getattr(settings, 'NUAGES_RATE_LIMIT_CACHE_SIZE',
+                                10000)
+REQUEST_START_HEADER = getattr(settings, 'NUAGES_REQUEST_START_HEADER',
+                               'X-Request-Start')
+
+
+class Gate(object):
+    '''Lets at most size requests in at the same time.'''
+    def __init__(self, size):
+        self.size = size
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def enter(self, timeout=0):
+        '''Takes a slot, waiting up to timeout seconds for one to be
+        released. Returns False if none was.'''
+        deadline = time.time() + timeout
+        with self._condition:
+            while self.active >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class TokenBucket(object):
+    '''Rate limit of rate requests every period seconds, allowing bursts of
+    rate requests.
+
+    Buckets are kept in-process, or in the Django cache when
+    NUAGES_RATE_LIMIT_STORE is 'cache' so that every process shares them.
+    Buckets in the cache are read and written without a lock: requests
+    racing each other can both get the same token, so the limit is
+    approximate.'''
+    def __init__(self, rate, period, store=RATE_LIMIT_STORE):
+        self.rate = float(rate)
+        self.period = float(period)
+        self.store = store
+        self._buckets = LRUCache(RATE_LIMIT_CACHE_SIZE, self.period)
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        if self.store == 'cache':
+            return cache.get('nuages-bucket-%s' % key)
+        return self._buckets.get(key)
+
+    def _set(self, key, bucket):
+        if self.store == 'cache':
+            cache.set('nuages-bucket-%s' % key, bucket, int(self.period) + 1)
+        else:
+            self._buckets.set(key, bucket)
+
+    def take(self, key):
+        '''Takes a token from the bucket of key. Returns 0 if there was one,
+        the number of seconds until the next one otherwise.'''
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._get(key) or (self.rate, now)
+            tokens = min(self.rate, tokens + (now - updated) * self.rate /
+                                              self.period)
+            if tokens < 1:
+                self._set(key, (tokens, now))
+                return (1 - tokens) * self.period / self.rate
+
+            self._set(key, (tokens - 1, now))
+            return 0
+
+
+_gates = {}
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_gate(node_cls):
+    gate = _gates.get(node_cls)
+    if gate is None:
+        with _lock:
+            gate = _gates.setdefault(node_cls, Gate(node_cls.max_concurrency))
+    return gate
+
+
+def get_bucket(node_cls):
+    bucket = _buckets.get(node_cls)
+    if bucket is None:
+        with _lock:
+            bucket = _buckets.setdefault(node_cls,
+                                         TokenBucket(*node_cls.rate_limit))
+    return bucket
+
+
+def get_client_key(request):
+    '''Returns the key of the bucket of the client of a request: its
+    principal, or its address for anonymous requests.'''
+    return (get_principal_key(request.principal) or
+            request.META.get_raw('REMOTE_ADDR', ''))
+
+
+def get_queue_time(request):
+    '''Returns the seconds the request waited since the front server got
+    it, according to the header named by NUAGES_REQUEST_START_HEADER, None
+    if it's missing. The header holds a timestamp, optionally prefixed with
+    "t=", in seconds, milliseconds or microseconds.'''
+    value = request.META.get_raw('HTTP_' + REQUEST_START_HEADER)
+    if not value:
+        return None
+
+    try:
+        started = float(value.strip(' ').replace('t=', '', 1))
+    except ValueError:
+        return None
+
+    while started > 1e11: #In milliseconds or microseconds.
+        started /= 1000
+    return max(0, time.time() - started)
+
+
+def shed(node_cls, request, reason, error):
+    request_shed.send(sender=node_cls, request=request, node_cls=node_cls,
+                      reason=reason)
+    raise error
+
+
+@contextmanager
+def admit(node_cls, request):
+    '''Processes the block if node_cls can take the request in, and raises
+    an HttpError otherwise:
+    - a 429 when the client is over the rate_limit of the node,
+    - a 503 when the request waited more than max_queue_time seconds before
+    getting there, or max_concurrency requests are already being processed
+    by the node and no slot got free within max_queue_time.
+
+    Slots are released once the block is processed: the content of
+    streamed responses, like event streams, is sent outside of it.'''
+    gate = None
+    retry_after = node_cls.retry_after or RETRY_AFTER
+    with instrumentation.phase(request, 'admission'):
+        if node_cls.rate_limit:
+            wait = get_bucket(node_cls).take(get_client_key(request))
+            if wait:
+                shed(node_cls, request, 'rate_limit',
+                     TooManyRequestsError(node_cls, wait))
+
+        budget = 0
+        if node_cls.max_queue_time is not None:
+            budget = node_cls.max_queue_time - (get_queue_time(request) or 0)
+            if budget < 0:
+                shed(node_cls, request, 'queue_time',
+                     ServiceUnavailableError(node_cls, retry_after,
+                                             'The server is overloaded.'))
+
+        if node_cls.max_concurrency:
+            gate = get_gate(node_cls)
+            if not gate.enter(budget):
+                shed(node_cls, request, 'concurrency',
+                     ServiceUnavailableError(node_cls, retry_after,
+                                             'The server is overloaded.'))
+
+    try:
+        yield
+    finally:
+        if gate:
+            gate.leave()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import uuid
+import mimetypes
+from datetime import datetime
+from django.conf import settings
+from django.utils.http import parse_http_date_safe
+from nuages.http import (HttpResponse, Etag, ContentRange,
+                         RequestedRangeNotSatisfiableError, parse_byte_ranges)
+
+
+__all__ = ('get_etag', 'get_content_type', 'serve')
+
+'''
+Django settings:
+#NUAGES_SENDFILE_HEADER
+#NUAGES_MAX_BYTE_RANGES
+'''
+SENDFILE_HEADER = getattr(settings, 'NUAGES_SENDFILE_HEADER', None)
+MAX_BYTE_RANGES = getattr(settings, 'NUAGES_MAX_BYTE_RANGES', 16)
+BLOCK_SIZE = 64 * 1024
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+
+def get_etag(stat):
+    '''Returns the ETag of a file from its metadata: its modification time,
+    inode and size. The content is never read.'''
+    return Etag(datetime.fromtimestamp(stat.st_mtime),
+                '%x.%x' % (stat.st_ino, stat.st_size))
+
+
+def get_content_type(path):
+    return mimetypes.guess_type(path)[0] or DEFAULT_CONTENT_TYPE
+
+
+def iter_file(path, first, last, block_size=BLOCK_SIZE):
+    '''Yields the bytes of a file from position first to position last,
+    included, in blocks of at most block_size bytes. The file is opened
+    with the first block, and closed with the last.'''
+    with open(path, 'rb') as blob:
+        blob.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            block = blob.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def iter_parts(path, parts, boundary):
+    for head, (first, last) in parts:
+        yield head
+        for block in iter_file(path, first, last):
+            yield block
+        yield '\r\n'
+    yield '--%s--\r\n' % boundary
+
+
+def is_range_valid(request, etag):
+    '''Returns whether the Range header of a request applies: when it comes
+    with an If-Range header, its ETag or date must be the one of the
+    current representation, or the whole one is served.'''
+    value = request.META.get_raw('HTTP_IF_RANGE')
+    if not value:
+        return True
+
+    value = value.strip()
+    if value.startswith('W/'):
+        return False #Only strong validators can be used.
+    try:
+        return repr(Etag.parse(value)) == repr(etag)
+    except ValueError:
+        timestamp = parse_http_date_safe(value)
+        return timestamp is not None and timestamp == int(etag.timestamp)
+
+
+def get_ranges(node, length, etag):
+    '''Returns the ranges of the file requested by the client, None if the
+    whole file is. Requests for more than NUAGES_MAX_BYTE_RANGES ranges get
+    the whole file.'''
+    request = node.request
+    raw_header = request.META.get_raw('HTTP_RANGE')
+    if (not raw_header or request.method != 'GET' or
+        not is_range_valid(request, etag)):
+        return None
+
+    ranges = parse_byte_ranges(raw_header, length)
+    if ranges is None or len(ranges) > MAX_BYTE_RANGES:
+        return None
+    if not ranges:
+        error = RequestedRangeNotSatisfiableError(node)
+        error['Content-Range'] = 'bytes */%d' % length
+        raise error
+    return ranges
+
+
+def serve(node, path, stat, content_type):
+    '''Returns a response of node serving the file at path, or the ranges
+    of it asked for.
+
+    With NUAGES_SENDFILE_HEADER set, to X-Sendfile or X-Accel-Redirect for
+    instance, the file is sent by the front server, given the value of
+    node.get_sendfile_path() in that header, and ranges are left to it.
+    Otherwise, the file goes through the wsgi.file_wrapper of the server,
+    or is read in blocks, and never held in memory as a whole.'''
+    request = node.request
+    length = stat.st_size
+    response = HttpResponse(node=node, content_type=content_type)
+    response.preformatted = True
+    response['Accept-Ranges'] = 'bytes'
+
+    if SENDFILE_HEADER:
+        response[SENDFILE_HEADER] = node.get_sendfile_path()
+        return response
+
+    ranges = get_ranges(node, length, get_etag(stat))
+    if not ranges:
+        response['Content-Length'] = str(length)
+        if request.method == 'GET':
+            #Not a header: RequestMeta would upper case its name.
+            file_wrapper = request._base_request.META.get('wsgi.file_wrapper')
+            if file_wrapper and length:
+                response.content = file_wrapper(open(path, 'rb'), BLOCK_SIZE)
+            else:
+                response.content = iter_file(path, 0, length - 1)
+        return response
+
+    response.status = 206
+    if len(ranges) == 1:
+        first, last = ranges[0]
+        response['Content-Range'] = str(ContentRange('bytes', first, last,
+                                                     length))
+        response['Content-Length'] = str(last - first + 1)
+        response.content = iter_file(path, first, last)
+        return response
+
+    boundary = uuid.uuid4().hex
+    parts = [('--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n' %
+              (boundary, content_type,
+               ContentRange('bytes', first, last, length)), (first, last))
+             for first, last in ranges]
+    response['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+    response['Content-Length'] = str(sum([len(head) + last - first + 3
+                                          for head, (first, last) in parts]) +
+                                     len('--%s--\r\n' % boundary))
+    response.content = iter_parts(path, parts, boundary)
+    return response
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import Queue
+import atexit
+import logging
+import threading
+from django.conf import settings
+from django.db import close_connection
+from django.utils.importlib import import_module
+from nuages.core import metrics
+
+
+__all__ = ('Task', 'WorkQueue', 'ThreadPoolQueue', 'ImmediateQueue',
+           'get_queue', 'defer', 'flush')
+
+'''
+Django settings:
+#NUAGES_DEFERRED_QUEUE
+#NUAGES_DEFERRED_WORKERS
+#NUAGES_DEFERRED_QUEUE_SIZE
+#NUAGES_DEFERRED_OVERFLOW
+#NUAGES_DEFERRED_SHUTDOWN_TIMEOUT
+'''
+QUEUE = getattr(settings, 'NUAGES_DEFERRED_QUEUE',
+                'nuages.core.deferred.ThreadPoolQueue')
+WORKERS = getattr(settings, 'NUAGES_DEFERRED_WORKERS', 4)
+QUEUE_SIZE = getattr(settings, 'NUAGES_DEFERRED_QUEUE_SIZE', 1000)
+OVERFLOW = getattr(settings, 'NUAGES_DEFERRED_OVERFLOW', 'run')
+SHUTDOWN_TIMEOUT = getattr(settings, 'NUAGES_DEFERRED_SHUTDOWN_TIMEOUT', 5)
+TASKS_ATTRIBUTE = 'nuages_deferred'
+
+
+logger = logging.getLogger(__name__)
+
+
+class Task(object):
+    '''Call of func with args and kwargs, deferred by a node.'''
+    def __init__(self, func, args=(), kwargs=None, name=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.name = name or '%s.%s' % (getattr(func, '__module__', None),
+                                       getattr(func, '__name__',
+                                               func.__class__.__name__))
+        self.queued = time.time()
+
+    def run(self):
+        '''Calls the function, logging its failure instead of raising it.
+        Returns whether it succeeded.'''
+        start = time.time()
+        try:
+            self.func(*self.args, **self.kwargs)
+            result = 'done'
+        except Exception:
+            logger.exception('Deferred task %s failed.' % self.name)
+            result = 'failed'
+
+        metrics.record_task(self.name, result, time.time() - start,
+                            start - self.queued)
+        return result == 'done'
+
+
+class WorkQueue(object):
+    '''Base class of the queues running the deferred tasks.'''
+    def submit(self, task):
+        '''Queues the task. Returns False if the queue is full.'''
+        raise NotImplementedError
+
+    def drain(self, timeout):
+        '''Waits up to timeout seconds for the queued tasks to be run.'''
+        pass
+
+
+class ImmediateQueue(WorkQueue):
+    '''Runs the tasks as soon as they're submitted, in the thread of the
+    request, once its response is complete. Handy in development and in
+    tests.'''
+    def submit(self, task):
+        task.run()
+        return True
+
+
+class ThreadPoolQueue(WorkQueue):
+    '''Runs the tasks on workers threads of the process, started with the
+    first task so that forked processes get their own.
+
+    At most size tasks wait for a worker: the queue doesn't grow without
+    bounds when tasks are submitted faster than they run.'''
+    def __init__(self, workers=WORKERS, size=QUEUE_SIZE):
+        self.workers = workers
+        self.size = size
+        self._pid = None
+        self._tasks = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._tasks = Queue.Queue(self.size)
+
+            for i in range(self.workers):
+                worker = threading.Thread(target=self._work,
+                                          args=(self._tasks,),
+                                          name='nuages-deferred-%d' % i)
+                worker.daemon = True
+                worker.start()
+
+    def _work(self, tasks):
+        while True:
+            task = tasks.get()
+            try:
+                task.run()
+            finally:
+                close_connection() #Like Django does after each request.
+                tasks.task_done()
+
+    def submit(self, task):
+        self._start()
+        try:
+            self._tasks.put_nowait(task)
+            return True
+        except Queue.Full:
+            return False
+
+    def drain(self, timeout):
+        '''Queue.join can't time out, so the unfinished tasks are polled.'''
+        if self._pid != os.getpid():
+            return
+
+        deadline = time.time() + timeout
+        while self._tasks.unfinished_tasks and time.time() < deadline:
+            time.sleep(.05)
+
+
+_queue = None
+_lock = threading.Lock()
+def get_queue():
+    global _queue
+    if _queue is None:
+        with _lock:
+            if _queue is None:
+                module_name, class_name = QUEUE.rsplit('.', 1)
+                _queue = getattr(import_module(module_name), class_name)()
+                atexit.register(_queue.drain, SHUTDOWN_TIMEOUT)
+    return _queue
+
+
+def defer(request, func, *args, **kwargs):
+    '''Schedules a call to func once the response to request is complete.
+    request can either be a Django HttpRequest or the Nuages wrapper around
+    it.'''
+    base_request = getattr(request, '_base_request', request)
+    tasks = getattr(base_request, TASKS_ATTRIBUTE, None)
+    if tasks is None:
+        tasks = []
+        setattr(base_request, TASKS_ATTRIBUTE, tasks)
+    tasks.append(Task(func, args, kwargs))
+
+
+def flush(request, response):
+    '''Submits the tasks deferred while processing request to the queue
+    named by NUAGES_DEFERRED_QUEUE. The tasks of a request which failed are
+    dropped, as what they follow up on didn't happen.
+
+    When the queue is full, NUAGES_DEFERRED_OVERFLOW tells what becomes of
+    a task: 'run' runs it right away, which slows the request down and so
+    its client, 'drop' drops it.
+
+    Tasks may start before the transaction of the request is committed when
+    it's managed by a middleware, like TransactionMiddleware.'''
+    base_request = getattr(request, '_base_request', request)
+    tasks = getattr(base_request, TASKS_ATTRIBUTE, None)
+    if not tasks:
+        return
+
+    delattr(base_request, TASKS_ATTRIBUTE)
+    if response.status_code >= 400:
+        for task in tasks:
+            metrics.record_task(task.name, 'cancelled')
+        return
+
+    queue = get_queue()
+    for task in tasks:
+        if queue.submit(task):
+            continue
+
+        if OVERFLOW == 'run':
+            metrics.record_task(task.name, 'overflowed')
+            task.run()
+        else:
+            logger.warning('Deferred task %s dropped: the queue is full.' %
+                           task.name)
+            metrics.record_task(task.name, 'dropped')
@@ -1,16 +1,47 @@
 # -*- coding: utf-8 -*-
+import uuid
 from django.conf import settings
+from django.core.signals import request_started
 from django.template import loader, Context
 from nuages.core import serializers
 from nuages.utils import get_matching_mime_types
 from nuages.http import NotAcceptableError
 
 
+'''
+Django settings:
+#NUAGES_HTML_STREAMING_THRESHOLD
+'''
+HTML_STREAMING_THRESHOLD = getattr(settings,
+                                   'NUAGES_HTML_STREAMING_THRESHOLD', 100)
 HTTP_ERROR_FORMATS = ['application/json', 'application/xml', 'text/html',
                       'text/javascript', 'text/xml', '*/*']
 JSON_MIMETYPES = ['application/json', 'text/javascript']
 XML_MIMETYPES = ['application/xml', 'text/xml']
 HTML_MIMETYPES = ['application/xhtml+xml', 'text/html']
+ITEMS_PLACEHOLDER = 'nuagesitems%s' % uuid.uuid4().hex
+
+
+_compiled_templates = {}
+def get_template(template_name):
+    '''Returns the compiled template matching template_name. Templates are
+    compiled once per process and kept in memory until the cache is reset.'''
+    template = _compiled_templates.get(template_name)
+    if template is None:
+        template = loader.get_template(template_name)
+        _compiled_templates[template_name] = template
+    return template
+
+
+def reset_template_cache(**kwargs):
+    '''Drops all the compiled templates, forcing them to be loaded again from
+    the disk the next time they're used.'''
+    _compiled_templates.clear()
+
+
+if settings.DEBUG:
+    #Templates are reloaded on every request in DEBUG to pick up changes.
+    request_started.connect(reset_template_cache)
 
 
 class ResponseFormatter(object):
@@ -22,11 +53,31 @@ class ResponseFormatter(object):
         if not template_name:
             raise NotImplementedError
 
-        template = loader.get_template("nuages_%s.html" % template_name)
-        data.update({
-            'response': self.response,
-        })
-        return template.render(Context(data))
+        template = get_template("nuages_%s.html" % template_name)
+        context = {'response': self.response,
+                   'nuages_base': get_template('nuages_base.html')}
+        if not isinstance(data, (list, tuple)):
+            context.update(data or {})
+            context['payload'] = data
+            return template.render(Context(context))
+
+        #Collections are rendered around a placeholder, which gets replaced
+        #by the items rendered one by one.
+        context['items_placeholder'] = ITEMS_PLACEHOLDER
+        head, tail = template.render(Context(context)).split(ITEMS_PLACEHOLDER)
+        chunks = self._iter_html_items(head, data, tail)
+        if len(data) > HTML_STREAMING_THRESHOLD:
+            return chunks
+        return ''.join(chunks)
+
+    def _iter_html_items(self, head, items, tail):
+        '''Yields the HTML representation of a collection, one item at a
+        time.'''
+        yield head
+        item_template = get_template('nuages_item.html')
+        for item in items:
+            yield item_template.render(Context({'item': item}))
+        yield tail
 
     def json(self, data):
         return serializers.to_json(data)
@@ -42,6 +93,9 @@ class ResponseFormatter(object):
         matching_types = get_matching_mime_types(self.request,
                                                  HTTP_ERROR_FORMATS)
 
+        #Clients accepting anything get the default content type.
+        matching_types = [mime_type for mime_type in matching_types
+                          if mime_type != '*/*']
         if len(matching_types):
             content_type = matching_types[0]
 
@@ -50,7 +104,10 @@ class ResponseFormatter(object):
 
         if content_type in JSON_MIMETYPES:
             self.response.content = self.json(data)
-        elif content_type in XML_MIMETYPES:
+            return
+
+        data = serializers.expand(data)
+        if content_type in XML_MIMETYPES:
             self.response.content = self.xml(data)
         elif content_type in HTML_MIMETYPES:
             self.response.content = self.html(data)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from nuages.core import metrics
+from nuages.core.serializers import Fragment, to_json
+from nuages.utils.lru import LRUCache
+
+
+__all__ = ('render',)
+
+'''
+Django settings:
+#NUAGES_FRAGMENT_STORE
+#NUAGES_FRAGMENT_CACHE_SIZE
+'''
+FRAGMENT_STORE = getattr(settings, 'NUAGES_FRAGMENT_STORE', 'memory')
+FRAGMENT_CACHE_SIZE = getattr(settings, 'NUAGES_FRAGMENT_CACHE_SIZE', 10000)
+
+
+_fragments = LRUCache(FRAGMENT_CACHE_SIZE)
+
+
+def get_fragment_key(node, etag):
+    '''Fragments are kept per node, under its ETag so that they're not used
+    anymore once it changes, as items may share an ETag, and under the root
+    of the absolute URLs they may contain.'''
+    request = node.request
+    return hashlib.sha1('\0'.join([node.get_view_name(),
+                                   str(sorted(node._chained_args.items())),
+                                   repr(etag),
+                                   'https' if request.is_secure() else 'http',
+                                   request.get_host()])).hexdigest()
+
+
+def get_fragment(key):
+    if FRAGMENT_STORE == 'cache':
+        return cache.get('nuages-fragment-%s' % key)
+    return _fragments.get(key)
+
+
+def set_fragment(key, content, timeout):
+    if FRAGMENT_STORE == 'cache':
+        cache.set('nuages-fragment-%s' % key, content, timeout)
+    else:
+        _fragments.set(key, content, timeout)
+
+
+def render(node):
+    '''Returns the rendering of node in a collection as a Fragment encoded
+    in JSON, from the cache when the ETag of node didn't change since it
+    was last rendered, so that it's neither rendered nor encoded again.
+
+    The rendering must only depend on the ETag of the node: it's shared by
+    all the requests, whatever their principal. Nodes without an ETag are
+    rendered every time.'''
+    etag = node.get_etag()
+    if repr(etag) == '*':
+        return node.render_in_collection()
+
+    key = get_fragment_key(node, etag)
+    content = get_fragment(key)
+    metrics.record_cache('fragment', content is not None)
+    if content is not None:
+        return Fragment(content)
+
+    data = node.render_in_collection()
+    content = to_json(data)
+    set_fragment(key, content, node.fragment_timeout)
+    return Fragment(content, data)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from nuages.core import instrumentation, metrics, singleflight
+from nuages.http import BadRequestError, ConflictError, hash_body
+from nuages.authentication import get_principal_key
+from nuages.utils.lru import LRUCache
+
+
+__all__ = ('get_idempotency_key', 'process')
+
+'''
+Django settings:
+#NUAGES_IDEMPOTENCY_HEADER
+#NUAGES_IDEMPOTENCY_TIMEOUT
+#NUAGES_IDEMPOTENCY_STORE
+#NUAGES_IDEMPOTENCY_CACHE_SIZE
+'''
+IDEMPOTENCY_HEADER = getattr(settings, 'NUAGES_IDEMPOTENCY_HEADER',
+                             'Idempotency-Key')
+IDEMPOTENCY_TIMEOUT = getattr(settings, 'NUAGES_IDEMPOTENCY_TIMEOUT',
+                              24 * 60 * 60)
+IDEMPOTENCY_STORE = getattr(settings, 'NUAGES_IDEMPOTENCY_STORE', 'memory')
+IDEMPOTENCY_CACHE_SIZE = getattr(settings, 'NUAGES_IDEMPOTENCY_CACHE_SIZE',
+                                 10000)
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+
+_responses = LRUCache(IDEMPOTENCY_CACHE_SIZE)
+_lock = threading.Lock()
+
+
+def get_idempotency_key(request):
+    '''Returns the idempotency key sent by the client, None if there's
+    none.'''
+    key = request.META.get_raw('HTTP_' + IDEMPOTENCY_HEADER)
+    if key is None:
+        return None
+
+    key = key.strip(' ')
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise BadRequestError(description='%s must be made of 1 to %d ' \
+                              'characters.' % (IDEMPOTENCY_HEADER,
+                                               MAX_KEY_LENGTH))
+    return key
+
+
+def get_store_key(node, key):
+    '''Keys are scoped to the node and the principal of the request, so
+    that clients can't read the responses of each other.'''
+    return hashlib.sha1('\0'.join([node.get_view_name(),
+                                   get_principal_key(node.request.principal),
+                                   key])).hexdigest()
+
+
+def get_request_hash(request):
+    '''Returns the hash of what makes a request unique: the same key sent
+    with a different request is a mistake of the client. Large bodies are
+    hashed without being buffered (see nuages.http.hash_body).'''
+    hasher = hashlib.sha256()
+    map(hasher.update, [request.method, '\0',
+                        request.get_full_path(), '\0',
+                        request.META.get_raw('CONTENT_TYPE', ''), '\0',
+                        hash_body(request)])
+    return hasher.hexdigest()
+
+
+def get_record(store_key):
+    if IDEMPOTENCY_STORE == 'cache':
+        return cache.get('nuages-idempotency-%s' % store_key)
+    return _responses.get(store_key)
+
+
+def add_record(store_key, record, timeout):
+    '''Stores the record unless there's already one for the key. Returns
+    whether it was stored.'''
+    if IDEMPOTENCY_STORE == 'cache':
+        return cache.add('nuages-idempotency-%s' % store_key, record, timeout)
+
+    with _lock:
+        if store_key in _responses:
+            return False
+        _responses.set(store_key, record, timeout)
+        return True
+
+
+def set_record(store_key, record, timeout):
+    if IDEMPOTENCY_STORE == 'cache':
+        cache.set('nuages-idempotency-%s' % store_key, record, timeout)
+    else:
+        _responses.set(store_key, record, timeout)
+
+
+def delete_record(store_key):
+    if IDEMPOTENCY_STORE == 'cache':
+        cache.delete('nuages-idempotency-%s' % store_key)
+    else:
+        _responses.delete(store_key)
+
+
+def process(node, method_func, key):
+    '''Calls method_func, the _process_<method> function of node, the first
+    time the idempotency key is used, and stores its response for
+    node.idempotency_timeout seconds. Retries sharing the key get the same
+    response without method_func being called, and concurrent ones wait up
+    to node.coalesce_timeout seconds for the first one to complete.
+
+    The key is marked as taken while the first request is processed, so a
+    retry which stopped waiting, or came through another process, gets a
+    409 instead of running method_func a second time. Errors are not
+    stored, so that the request can be retried once they're fixed.'''
+    store_key = get_store_key(node, key)
+    request_hash = get_request_hash(node.request)
+
+    def run():
+        record = {'hash': request_hash, 'response': None}
+        if not add_record(store_key, record, node.idempotency_timeout):
+            return get_record(store_key) or record, True
+
+        try:
+            record['response'] = singleflight.freeze(node, method_func())
+        except:
+            delete_record(store_key)
+            raise
+
+        if record['response']['status'] < 500:
+            set_record(store_key, record, node.idempotency_timeout)
+        else:
+            delete_record(store_key)
+        return record, False
+
+    with instrumentation.phase(node.request, 'idempotency'):
+        (record, stored), coalesced = singleflight.flights.do(
+                                        'idempotency-%s' % store_key, run,
+                                        node.coalesce_timeout,
+                                        singleflight.ACROSS_PROCESSES)
+    replayed = stored or coalesced
+    metrics.record_cache('idempotency', replayed)
+    if replayed and record['hash'] != request_hash:
+        raise ConflictError(node, '%s was already used by another ' \
+                            'request.' % IDEMPOTENCY_HEADER)
+    if record['response'] is None:
+        raise ConflictError(node, 'A request with the same %s is still ' \
+                            'being processed.' % IDEMPOTENCY_HEADER)
+
+    response = singleflight.thaw(node, record['response'])
+    if replayed:
+        response[REPLAYED_HEADER] = 'true'
+    return response
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from nuages.signals import request_timed
+from nuages.core import queries
+
+
+'''
+Django settings:
+#NUAGES_SERVER_TIMING
+#NUAGES_SERVER_TIMING_HEADER
+'''
+SERVER_TIMING = getattr(settings, 'NUAGES_SERVER_TIMING', False)
+SERVER_TIMING_HEADER = getattr(settings, 'NUAGES_SERVER_TIMING_HEADER', None)
+TIMER_ATTRIBUTE = 'nuages_timer'
+
+
+class RequestTimer(object):
+    '''Measures the time spent in each phase of the processing of a
+    request, and the database queries run in it when they're accounted
+    (see NUAGES_QUERY_ACCOUNTING).
+
+    Time and queries go to the innermost phase running: those of the
+    permissions checked while rendering go to 'permissions' only, so that
+    the phases don't overlap and add up to at most the whole request.'''
+    def __init__(self, node_cls=None):
+        self.node_cls = node_cls
+        self.started = time.time()
+        self.timings = OrderedDict()
+        self.queries = (queries.QueryAccount() if queries.is_enabled()
+                        else None)
+        self._running = []
+        self._last = None
+        self._marks = None
+
+    def _switch(self):
+        '''Accounts what happened since the last phase was entered or left
+        to the innermost phase running, if any.'''
+        now = time.time()
+        if self._running:
+            name = self._running[-1]
+            self.timings[name] = self.timings.get(name, 0) + now - self._last
+            if self.queries:
+                self.queries.add(name, self._marks,
+                                 running=self._running[:-1])
+        self._last = now
+        if self.queries:
+            self._marks = self.queries.mark()
+
+    @contextmanager
+    def phase(self, name):
+        '''Adds the time spent in the block to the phase, less the time
+        spent in the phases nested in it. A phase entered again from within
+        itself, like the instantiation of parent nodes, is only measured
+        once.'''
+        if name in self._running:
+            yield
+            return
+
+        self._switch()
+        self._running.append(name)
+        try:
+            yield
+        finally:
+            self._switch()
+            self._running.remove(name)
+
+    @property
+    def duration(self):
+        return time.time() - self.started
+
+    def to_header(self):
+        '''Returns the value of a Server-Timing header.'''
+        metrics = self.timings.items() + [('total', self.duration)]
+        return ', '.join(['%s;dur=%.3f' % (name, seconds * 1000)
+                          for name, seconds in metrics])
+
+
+def start(request, node_cls):
+    '''Attaches a new RequestTimer to a request.'''
+    timer = RequestTimer(node_cls)
+    setattr(getattr(request, '_base_request', request), TIMER_ATTRIBUTE, timer)
+    return timer
+
+
+def get_timer(request):
+    '''Returns the RequestTimer of a request, creating it if needed. request
+    can either be a Django HttpRequest or the Nuages wrapper around it.'''
+    base_request = getattr(request, '_base_request', request)
+    timer = getattr(base_request, TIMER_ATTRIBUTE, None)
+    if timer is None:
+        timer = start(base_request, None)
+    return timer
+
+
+def phase(request, name):
+    return get_timer(request).phase(name)
+
+
+def is_server_timing_requested(request):
+    if SERVER_TIMING:
+        return True
+
+    if SERVER_TIMING_HEADER:
+        header = 'HTTP_' + SERVER_TIMING_HEADER.upper().replace('-', '_')
+        return header in request.META
+    return False
+
+
+def finish(request, response):
+    '''Reports the timings and queries of a request processed by Nuages,
+    through the request_timed signal and the Server-Timing header.'''
+    base_request = getattr(request, '_base_request', request)
+    timer = getattr(base_request, TIMER_ATTRIBUTE, None)
+    if timer is None:
+        return
+
+    delattr(base_request, TIMER_ATTRIBUTE)
+    if is_server_timing_requested(base_request):
+        response['Server-Timing'] = timer.to_header()
+
+    if timer.queries:
+        timer.queries.close()
+        queries.report(timer.queries, timer.node_cls, base_request, response)
+
+    request_timed.send(sender=timer.node_cls, request=base_request,
+                       response=response, node_cls=timer.node_cls,
+                       timings=timer.timings, duration=timer.duration,
+                       queries=timer.queries)
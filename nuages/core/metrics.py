@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import glob
+import time
+import errno
+import fcntl
+import atexit
+import bisect
+import logging
+import threading
+from django.conf import settings
+from nuages.signals import request_timed, request_shed
+
+
+__all__ = ('Counter', 'Histogram', 'Registry', 'registry', 'record_cache',
+           'record_task', 'CONTENT_TYPE')
+
+'''
+Django settings:
+#NUAGES_METRICS
+#NUAGES_METRICS_DIR
+#NUAGES_METRICS_FLUSH_INTERVAL
+#NUAGES_METRICS_LATENCY_BUCKETS
+#NUAGES_METRICS_SIZE_BUCKETS
+'''
+METRICS_ENABLED = getattr(settings, 'NUAGES_METRICS', False)
+METRICS_DIR = getattr(settings, 'NUAGES_METRICS_DIR', None)
+FLUSH_INTERVAL = getattr(settings, 'NUAGES_METRICS_FLUSH_INTERVAL', 5)
+LATENCY_BUCKETS = getattr(settings, 'NUAGES_METRICS_LATENCY_BUCKETS',
+                          (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+SIZE_BUCKETS = getattr(settings, 'NUAGES_METRICS_SIZE_BUCKETS',
+                       (100, 1000, 10000, 100000, 1000000, 10000000))
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+SNAPSHOT_PATTERN = 'nuages-metrics-%s.json'
+RETIRED = 'retired'
+LOCK_NAME = 'nuages-metrics.lock'
+
+
+logger = logging.getLogger(__name__)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, unicode(value)
+                                           .replace('\\', '\\\\')
+                                           .replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                              for name, value in pairs])
+
+
+class Metric(object):
+    '''Base class of the metrics. Values are kept per tuple of label values,
+    and updated under a lock held for a couple of additions only.'''
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return dict([(labels, self.copy_value(value))
+                         for labels, value in self.values.items()])
+
+    def copy_value(self, value):
+        return value
+
+    def merge(self, values, other_values):
+        '''Adds the values of another process to values.'''
+        raise NotImplementedError
+
+    def expose(self, values):
+        '''Returns the lines of the text exposition format for values.'''
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def merge(self, values, other_values):
+        for labels, value in other_values.items():
+            values[labels] = values.get(labels, 0) + value
+
+    def expose(self, values):
+        return ['%s%s %s' % (self.name, format_labels(self.labelnames, labels),
+                             format_value(value))
+                for labels, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    '''Counts observations in buckets. The value kept for each set of labels
+    is a list made of the count of each bucket, followed by the sum and the
+    total count of the observations.'''
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, labels, amount):
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            value = self.values.get(labels)
+            if value is None:
+                value = self.values[labels] = [0] * (len(self.buckets) + 3)
+            value[index] += 1
+            value[-2] += amount
+            value[-1] += 1
+
+    def copy_value(self, value):
+        return list(value)
+
+    def merge(self, values, other_values):
+        for labels, value in other_values.items():
+            if labels not in values:
+                values[labels] = list(value)
+            else:
+                values[labels] = map(sum, zip(values[labels], value))
+
+    def expose(self, values):
+        lines = []
+        for labels, value in sorted(values.items()):
+            cumulated = 0
+            for bound, count in zip(self.buckets + (float('inf'),), value):
+                cumulated += count
+                lines.append('%s_bucket%s %s' %
+                             (self.name,
+                              format_labels(self.labelnames, labels,
+                                            [('le', format_value(bound))]),
+                              format_value(cumulated)))
+            lines.append('%s_sum%s %s' % (self.name,
+                                          format_labels(self.labelnames,
+                                                        labels),
+                                          format_value(value[-2])))
+            lines.append('%s_count%s %s' % (self.name,
+                                            format_labels(self.labelnames,
+                                                          labels),
+                                            format_value(value[-1])))
+        return lines
+
+
+class Registry(object):
+    '''Holds the metrics of the process.
+
+    When a directory is given, the values of the process are regularly
+    written to a file of their own in it, and the exposition merges the
+    files of all the processes sharing the directory. The files of the
+    processes which are gone are merged into a file of retired values, so
+    that counters don't go backwards, and files don't pile up as workers
+    are replaced.'''
+    def __init__(self, directory=None, flush_interval=FLUSH_INTERVAL):
+        self.metrics = {}
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._last_flush = 0
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self.metrics.get(name) or self.register(
+                                        Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.metrics.get(name) or self.register(
+                                Histogram(name, help, labelnames, buckets))
+
+    def get_snapshot_path(self, pid=None):
+        return os.path.join(self.directory,
+                            SNAPSHOT_PATTERN % (pid or os.getpid()))
+
+    def read_snapshot(self, path):
+        '''Returns the values written to a file, by metric name, None if it
+        can't be read.'''
+        try:
+            with open(path) as snapshot_file:
+                data = json.load(snapshot_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return dict([(name, dict([(tuple(labels), value)
+                                  for labels, value in items]))
+                     for name, items in data.items()])
+
+    def write_snapshot(self, path, values):
+        data = dict([(name, [[list(labels), value] for labels, value
+                             in metric_values.items()])
+                     for name, metric_values in values.items()])
+        with open(path + '.tmp', 'w') as snapshot_file:
+            json.dump(data, snapshot_file)
+        os.rename(path + '.tmp', path)
+
+    def flush(self, force=False):
+        '''Writes the values of the process to its file, at most once every
+        flush_interval seconds.'''
+        if not self.directory:
+            return
+
+        now = time.time()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+
+        path = self.get_snapshot_path()
+        try:
+            self.write_snapshot(path, dict([(name, metric.snapshot())
+                                            for name, metric
+                                            in self.metrics.items()]))
+        except (IOError, OSError), e:
+            logger.warning('Unable to write metrics to %s (%s)' % (path, e))
+
+    def get_dead_paths(self):
+        '''Returns the paths of the files written by processes which are
+        gone.'''
+        paths = []
+        for path in glob.glob(os.path.join(self.directory,
+                                           SNAPSHOT_PATTERN % '*')):
+            pid = os.path.basename(path).split('-')[-1].split('.')[0]
+            if not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except OSError, e:
+                if e.errno == errno.ESRCH:
+                    paths.append(path)
+        return paths
+
+    def retire(self):
+        '''Merges the files of the processes which are gone into the file of
+        the retired values, and removes them. The processes sharing the
+        directory do it in turn, under a lock.'''
+        dead_paths = self.get_dead_paths()
+        if not dead_paths:
+            return
+
+        retired_path = self.get_snapshot_path(RETIRED)
+        try:
+            with open(os.path.join(self.directory, LOCK_NAME),
+                      'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    retired = self.read_snapshot(retired_path) or {}
+                    dead_paths = filter(os.path.exists, dead_paths)
+                    for path in dead_paths:
+                        for name, values in (self.read_snapshot(path)
+                                             or {}).items():
+                            metric = self.metrics.get(name)
+                            if metric:
+                                metric.merge(retired.setdefault(name, {}),
+                                             values)
+                    self.write_snapshot(retired_path, retired)
+                    map(os.remove, dead_paths)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        except (IOError, OSError), e:
+            logger.warning('Unable to retire metrics to %s (%s)' %
+                           (retired_path, e))
+
+    def collect(self):
+        '''Returns the values of every metric, merged with those written by
+        the other processes if the registry is shared.'''
+        values = dict([(name, metric.snapshot())
+                       for name, metric in self.metrics.items()])
+        if not self.directory:
+            return values
+
+        self.retire()
+        own_path = self.get_snapshot_path()
+        for path in glob.glob(os.path.join(self.directory,
+                                           SNAPSHOT_PATTERN % '*')):
+            if path == own_path:
+                continue
+
+            for name, other_values in (self.read_snapshot(path)
+                                       or {}).items():
+                metric = self.metrics.get(name)
+                if metric:
+                    metric.merge(values[name], other_values)
+        return values
+
+    def expose(self):
+        '''Returns the metrics in the Prometheus text exposition format.'''
+        lines = []
+        values = self.collect()
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            lines += metric.expose(values[name])
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(directory=METRICS_DIR)
+#The values of the process since its last flush would be lost otherwise.
+atexit.register(registry.flush, True)
+requests_total = registry.counter('nuages_requests_total',
+                                  'Requests processed by Nuages nodes.',
+                                  ('node', 'method', 'status'))
+request_duration = registry.histogram('nuages_request_duration_seconds',
+                                      'Latency of the requests, in seconds.',
+                                      ('node', 'method'))
+response_size = registry.histogram('nuages_response_size_bytes',
+                                   'Size of the response bodies, in bytes.',
+                                   ('node', 'method'), buckets=SIZE_BUCKETS)
+cache_requests = registry.counter('nuages_cache_requests_total',
+                                  'Lookups in the caches of '
+                                  'representations.',
+                                  ('cache', 'result'))
+shed_requests = registry.counter('nuages_shed_requests_total',
+                                 'Requests turned away by the admission '
+                                 'control of the nodes.',
+                                 ('node', 'reason'))
+deferred_tasks = registry.counter('nuages_deferred_tasks_total',
+                                  'Tasks deferred by the nodes, by result: '
+                                  'done, failed, cancelled, overflowed or '
+                                  'dropped.',
+                                  ('task', 'result'))
+deferred_duration = registry.histogram('nuages_deferred_duration_seconds',
+                                       'Run time of the deferred tasks, in '
+                                       'seconds.',
+                                       ('task',))
+deferred_wait = registry.histogram('nuages_deferred_wait_seconds',
+                                   'Time the deferred tasks waited for a '
+                                   'worker, in seconds.',
+                                   ('task',))
+
+
+def record_cache(cache_name, hit):
+    '''Counts a lookup in one of the caches of representations.'''
+    if METRICS_ENABLED:
+        cache_requests.inc((cache_name, 'hit' if hit else 'miss'))
+
+
+def record_task(task_name, result, duration=None, wait=None):
+    '''Counts a deferred task, and measures its run when it ran.'''
+    if not METRICS_ENABLED:
+        return
+
+    deferred_tasks.inc((task_name, result))
+    if duration is not None:
+        deferred_duration.observe((task_name,), duration)
+        deferred_wait.observe((task_name,), wait)
+    registry.flush()
+
+
+def get_response_size(response):
+    if response.has_header('Content-Length'):
+        return int(response['Content-Length'])
+
+    if getattr(response, '_base_content_is_iter', False):
+        return None #Measuring a streamed response would consume it.
+    return len(response.content)
+
+
+def record_request(sender, request, response, node_cls, duration, **kwargs):
+    '''Receiver of the request_timed signal.'''
+    if node_cls is None:
+        return
+
+    labels = (node_cls.get_view_name(), request.method)
+    requests_total.inc(labels + (str(response.status_code),))
+    request_duration.observe(labels, duration)
+    size = get_response_size(response)
+    if size is not None:
+        response_size.observe(labels, size)
+    registry.flush()
+
+
+def record_shed(sender, node_cls, reason, **kwargs):
+    '''Receiver of the request_shed signal.'''
+    shed_requests.inc((node_cls.get_view_name(), reason))
+
+
+if METRICS_ENABLED:
+    request_timed.connect(record_request,
+                          dispatch_uid='nuages.core.metrics.record_request')
+    request_shed.connect(record_shed,
+                         dispatch_uid='nuages.core.metrics.record_shed')
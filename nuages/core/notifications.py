@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+import json
+import time
+import errno
+import Queue
+import socket
+import logging
+import tempfile
+import threading
+import urlparse
+from django.conf import settings
+from django.utils.importlib import import_module
+from nuages.core import instrumentation
+from nuages.http import HttpResponse
+
+
+__all__ = ('Broker', 'InProcessBroker', 'SocketBroker', 'Subscription',
+           'get_broker', 'publish', 'wait', 'stream')
+
+'''
+Django settings:
+#NUAGES_NOTIFICATIONS
+#NUAGES_NOTIFICATIONS_BROKER
+#NUAGES_NOTIFICATIONS_DIR
+#NUAGES_MAX_WAIT
+#NUAGES_EVENT_STREAM_TIMEOUT
+#NUAGES_EVENT_STREAM_HEARTBEAT
+'''
+NOTIFICATIONS = getattr(settings, 'NUAGES_NOTIFICATIONS', False)
+BROKER = getattr(settings, 'NUAGES_NOTIFICATIONS_BROKER',
+                 'nuages.core.notifications.InProcessBroker')
+NOTIFICATIONS_DIR = getattr(settings, 'NUAGES_NOTIFICATIONS_DIR',
+                            os.path.join(tempfile.gettempdir(),
+                                         'nuages-notifications'))
+MAX_WAIT = getattr(settings, 'NUAGES_MAX_WAIT', 30)
+EVENT_STREAM_TIMEOUT = getattr(settings, 'NUAGES_EVENT_STREAM_TIMEOUT', 300)
+EVENT_STREAM_HEARTBEAT = getattr(settings, 'NUAGES_EVENT_STREAM_HEARTBEAT',
+                                 15)
+EVENT_STREAM = 'text/event-stream'
+SOCKET_PATTERN = 'nuages-broker-%s.sock'
+MAX_DATAGRAM_SIZE = 64 * 1024
+EVENT_TYPES = {'POST': 'created',
+               'PUT': 'replaced',
+               'PATCH': 'modified',
+               'DELETE': 'deleted'}
+
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription(object):
+    '''Receives the events published on a channel until it's closed.'''
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.events = Queue.Queue()
+
+    def get(self, timeout=None):
+        '''Returns the next event, None if none came within timeout
+        seconds.'''
+        try:
+            return self.events.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker(object):
+    '''Base class of the brokers, which hand the events published on
+    channels to their subscriptions.'''
+    def subscribe(self, channel):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+    def publish(self, channels, event):
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    '''Delivers events to the subscriptions of the process only.'''
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channels, event):
+        with self._lock:
+            subscriptions = [subscription for channel in channels
+                             for subscription
+                             in self._subscriptions.get(channel, ())]
+        for subscription in subscriptions:
+            subscription.events.put(event)
+
+
+class SocketBroker(InProcessBroker):
+    '''Delivers events to the subscriptions of every process of the host
+    sharing directory.
+
+    Each process with subscriptions binds a Unix datagram socket in the
+    directory, and events are sent to all the sockets found there. Sockets
+    left behind by dead processes are removed by the first publisher
+    hitting them.'''
+    def __init__(self, directory=NOTIFICATIONS_DIR):
+        super(SocketBroker, self).__init__()
+        self.directory = directory
+        self._pid = None
+        self._socket = None
+
+    def get_socket_path(self, pid=None):
+        return os.path.join(self.directory,
+                            SOCKET_PATTERN % (pid or os.getpid()))
+
+    def _listen(self):
+        '''Binds the socket of the process, once per process so that forked
+        workers get their own.'''
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    pass #Created by another process in the meantime.
+
+            path = self.get_socket_path()
+            if os.path.exists(path):
+                os.remove(path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(path)
+
+        listener = threading.Thread(target=self._receive, args=(self._socket,))
+        listener.daemon = True
+        listener.start()
+
+    def _receive(self, receiving_socket):
+        while True:
+            data = receiving_socket.recv(MAX_DATAGRAM_SIZE)
+            try:
+                message = json.loads(data)
+                super(SocketBroker, self).publish(message['channels'],
+                                                  message['event'])
+            except (ValueError, KeyError):
+                logger.warning('Invalid notification received: %r' % data)
+
+    def subscribe(self, channel):
+        self._listen()
+        return super(SocketBroker, self).subscribe(channel)
+
+    def publish(self, channels, event):
+        data = json.dumps({'channels': channels, 'event': event})
+        own_path = self.get_socket_path()
+        sending_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            for path in glob.glob(os.path.join(self.directory,
+                                               SOCKET_PATTERN % '*')):
+                if path == own_path:
+                    continue
+                try:
+                    sending_socket.sendto(data, path)
+                except socket.error, e:
+                    if e.errno in [errno.ECONNREFUSED, errno.ENOENT]:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    else:
+                        logger.warning('Unable to notify %s (%s)' % (path, e))
+        finally:
+            sending_socket.close()
+        super(SocketBroker, self).publish(channels, event)
+
+
+_broker = None
+def get_broker():
+    global _broker
+    if _broker is None:
+        module_name, class_name = BROKER.rsplit('.', 1)
+        _broker = getattr(import_module(module_name), class_name)()
+    return _broker
+
+
+def get_channel(node):
+    '''Returns the channel of the events of a node: its path.'''
+    return node.build_url(absolute=False)
+
+
+def get_channels(path):
+    '''Returns the channels an event on path is published on: the path, and
+    the path of every ancestor, so that watching a node means watching its
+    subtree.'''
+    channels = []
+    while path and path != '/':
+        channels.append(path)
+        path = path.rstrip('/').rsplit('/', 1)[0] + '/'
+    return channels
+
+
+def publish(node, response):
+    '''Publishes the change made to node by a successful write. The event
+    of a creation is published on the path of the created resource.'''
+    if not NOTIFICATIONS or response.status_code >= 400:
+        return
+
+    path = get_channel(node)
+    if node.request.method == 'POST' and response.has_header('Location'):
+        path = urlparse.urlparse(response['Location']).path
+    event = {'type': EVENT_TYPES.get(node.request.method, 'changed'),
+             'uri': path,
+             'time': time.time()}
+    with instrumentation.phase(node.request, 'notification'):
+        get_broker().publish(get_channels(path), event)
+
+
+def get_wait(request):
+    '''Returns the number of seconds the client is willing to wait for a
+    change, from its Prefer header, capped by NUAGES_MAX_WAIT.'''
+    prefer = request.META.get_raw('HTTP_PREFER', '')
+    for preference in prefer.split(','):
+        name, _, value = preference.split(';')[0].strip().partition('=')
+        if name.lower() == 'wait':
+            try:
+                return min(max(0, int(value)), MAX_WAIT)
+            except ValueError:
+                return 0
+    return 0
+
+
+def wait(node):
+    '''Long-poll: holds a conditional GET whose If-None-Match still matches
+    the ETag of node, for up to the wait asked for in its Prefer header, or
+    until a change in the subtree of node is published. The request is
+    then processed as usual, and gets a 304 if nothing changed.
+
+    Returns the number of seconds waited for, None if the request isn't a
+    long-poll or if notifications are disabled, as no change would end the
+    wait.'''
+    if not NOTIFICATIONS:
+        return None
+
+    seconds = get_wait(node.request)
+    etags = node.request.META.get('HTTP_IF_NONE_MATCH')
+    if not seconds or not etags:
+        return None
+
+    #Subscribing before reading the ETag, a change can't go unnoticed.
+    subscription = get_broker().subscribe(get_channel(node))
+    try:
+        with instrumentation.phase(node.request, 'etag'):
+            etag = node.get_etag()
+        if etag in etags:
+            subscription.get(seconds)
+    finally:
+        subscription.close()
+    return seconds
+
+
+def is_stream_requested(request, node_cls):
+    '''Returns whether request asks for the event stream of node_cls. It's
+    never the case when notifications are disabled, so that the stream is
+    treated as any other unavailable content type: a 406 if nothing else is
+    acceptable.'''
+    accept = request.META.get('HTTP_ACCEPT') or []
+    return (NOTIFICATIONS and node_cls.watchable and
+            request.method == 'GET' and EVENT_STREAM in accept)
+
+
+def format_event(event):
+    return 'id: %f\nevent: %s\ndata: %s\n\n' % (event['time'], event['type'],
+                                               json.dumps(event))
+
+
+def iter_events(channel, timeout, heartbeat):
+    '''Yields the events published on channel in the event stream format,
+    and a comment every heartbeat seconds without any so that proxies keep
+    the connection open, until timeout seconds have passed.
+
+    The subscription is only made once the first chunk is asked for: a
+    response which is never sent, replaced by a 304 or abandoned by its
+    client, leaves none behind.'''
+    subscription = get_broker().subscribe(channel)
+    deadline = time.time() + timeout
+    try:
+        yield 'retry: 1000\n\n'
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            event = subscription.get(min(heartbeat, remaining))
+            yield format_event(event) if event else ':\n\n'
+    finally:
+        subscription.close()
+
+
+def stream(node):
+    '''Returns a text/event-stream response of the changes made to the
+    subtree of node, kept open for NUAGES_EVENT_STREAM_TIMEOUT seconds,
+    after which clients reconnect.
+
+    The response holds a worker for that long, but not the max_concurrency
+    slot of the node, which is released once Node.process returns: streams
+    aren't counted by max_concurrency, limit the workers of the server or
+    the rate_limit of the node instead.'''
+    response = HttpResponse(node=node,
+                            content=iter_events(get_channel(node),
+                                                EVENT_STREAM_TIMEOUT,
+                                                EVENT_STREAM_HEARTBEAT),
+                            content_type=EVENT_STREAM)
+    response['Cache-Control'] = 'no-cache'
+    response.preformatted = True
+    return response
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import glob
+import hmac
+import time
+import uuid
+import pstats
+import cPickle
+import hashlib
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from nuages.core import instrumentation
+
+
+'''
+Django settings:
+#NUAGES_PROFILER
+#NUAGES_PROFILER_MODE
+#NUAGES_PROFILER_THRESHOLD
+#NUAGES_PROFILER_DIR
+#NUAGES_PROFILER_MAX_CAPTURES
+#NUAGES_PROFILER_SAMPLING_INTERVAL
+#NUAGES_PROFILER_HEADER
+#NUAGES_PROFILER_SIGNATURE_TTL
+'''
+PROFILER_ENABLED = getattr(settings, 'NUAGES_PROFILER', False)
+PROFILER_MODE = getattr(settings, 'NUAGES_PROFILER_MODE', 'sampling')
+THRESHOLD = getattr(settings, 'NUAGES_PROFILER_THRESHOLD', 1.0)
+CAPTURES_DIR = getattr(settings, 'NUAGES_PROFILER_DIR', None)
+MAX_CAPTURES = getattr(settings, 'NUAGES_PROFILER_MAX_CAPTURES', 100)
+SAMPLING_INTERVAL = getattr(settings, 'NUAGES_PROFILER_SAMPLING_INTERVAL',
+                            .005)
+PROFILE_HEADER = getattr(settings, 'NUAGES_PROFILER_HEADER',
+                         'X-Nuages-Profile')
+SIGNATURE_TTL = getattr(settings, 'NUAGES_PROFILER_SIGNATURE_TTL', 300)
+SAMPLING = 'sampling'
+CPROFILE = 'cprofile'
+CAPTURE_EXTENSION = '.nprof'
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_signature(path, expires):
+    return '%d:%s' % (expires, hmac.new(settings.SECRET_KEY,
+                                        '%d:%s' % (expires, path),
+                                        hashlib.sha1).hexdigest())
+
+
+def sign(path, ttl=SIGNATURE_TTL):
+    '''Returns the value of the profiling header forcing the capture of a
+    request to path, valid for ttl seconds.'''
+    return get_signature(path, int(time.time() + ttl))
+
+
+def is_signed(request):
+    header = 'HTTP_' + PROFILE_HEADER.upper().replace('-', '_')
+    signature = request.META.get(header)
+    if not signature:
+        return False
+
+    expires = signature.split(':', 1)[0]
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+
+    expected = get_signature(request.path, int(expires))
+    #Constant time comparison
+    return (len(signature) == len(expected) and
+            not sum([ord(a) ^ ord(b) for a, b in zip(signature, expected)]))
+
+
+def get_frame_name(code):
+    return '%s:%s:%d' % (code.co_filename, code.co_name, code.co_firstlineno)
+
+
+def get_function_name(func):
+    '''Returns the name of a function as found in the keys of pstats.'''
+    filename, lineno, name = func
+    return '%s:%s:%d' % (filename, name, lineno)
+
+
+class SamplingProfiler(object):
+    '''Samples the stack of a thread at regular intervals from a background
+    thread. The samples are kept as collapsed stacks, i.e. frame names
+    separated by semi-colons, from the outermost to the innermost.'''
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self._thread_id = None
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            names = []
+            while frame is not None:
+                names.append(get_frame_name(frame.f_code))
+                frame = frame.f_back
+            if names:
+                stack = ';'.join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def start(self):
+        self._thread_id = threading.current_thread().ident
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        '''Stops the sampling, waiting for a sample being taken so that
+        stacks doesn't change anymore.'''
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join(self.interval + 1)
+
+    def get_data(self):
+        return {'mode': SAMPLING, 'stacks': self.stacks,
+                'interval': self.interval}
+
+
+class FunctionProfiler(object):
+    '''Records every function call with cProfile.'''
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def get_data(self):
+        self.profile.create_stats()
+        return {'mode': CPROFILE, 'stats': self.profile.stats}
+
+
+class CaptureStore(object):
+    '''Keeps the latest max_captures captures in a directory, one file per
+    capture. None are kept when max_captures is 0.'''
+    def __init__(self, directory, max_captures=MAX_CAPTURES):
+        self.directory = directory
+        self.max_captures = max_captures
+
+    def get_paths(self):
+        return sorted(glob.glob(os.path.join(self.directory,
+                                             '*' + CAPTURE_EXTENSION)))
+
+    def save(self, capture):
+        '''Writes the capture, and removes the oldest ones over
+        max_captures. Returns the path of the capture, None if it wasn't
+        kept.'''
+        if not self.max_captures:
+            return None
+
+        name = '%.6f-%s%s' % (time.time(), uuid.uuid4().hex[:8],
+                              CAPTURE_EXTENSION)
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as capture_file:
+            cPickle.dump(capture, capture_file, cPickle.HIGHEST_PROTOCOL)
+
+        for old_path in self.get_paths()[:-self.max_captures]:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+        return path
+
+    def load(self):
+        for path in self.get_paths():
+            try:
+                with open(path, 'rb') as capture_file:
+                    yield cPickle.load(capture_file)
+            except (IOError, EOFError, cPickle.UnpicklingError), e:
+                logger.warning('Unable to load capture %s (%s)' % (path, e))
+
+
+def get_threshold(node_cls):
+    threshold = getattr(node_cls, 'profile_threshold', None)
+    return THRESHOLD if threshold is None else threshold
+
+
+@contextmanager
+def capture(node_cls, request, kwargs):
+    '''Profiles the block and saves the capture if it lasted longer than
+    the profile_threshold of the node, or if the request was signed. Signed
+    requests are always profiled with cProfile.'''
+    if not PROFILER_ENABLED or not CAPTURES_DIR or not MAX_CAPTURES:
+        yield
+        return
+
+    signed = is_signed(request)
+    threshold = get_threshold(node_cls)
+    if not signed and threshold is None:
+        yield
+        return
+
+    profiler = (FunctionProfiler() if signed or PROFILER_MODE == CPROFILE
+                else SamplingProfiler())
+    start = time.time()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        duration = time.time() - start
+        if signed or duration >= threshold:
+            data = profiler.get_data()
+            data.update({
+                'node': '%s.%s' % (node_cls.__module__, node_cls.__name__),
+                'view_name': node_cls.get_view_name(),
+                'kwargs': dict([(key, unicode(value))
+                                for key, value in kwargs.items()]),
+                'method': request.method,
+                'path': request.path,
+                'duration': duration,
+                'timings': dict(instrumentation.get_timer(request).timings),
+                'created': time.time(),
+            })
+            try:
+                CaptureStore(CAPTURES_DIR).save(data)
+            except (IOError, OSError), e:
+                logger.warning('Unable to save profile capture (%s)' % e)
+
+
+class StatsDict(object):
+    '''Allows pstats.Stats to load the stats of a capture.'''
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def get_stats(captures, stream=None):
+    '''Returns a pstats.Stats summing the cProfile captures.'''
+    stats = None
+    for capture in captures:
+        if capture['mode'] != CPROFILE:
+            continue
+        if stats is None:
+            stats = pstats.Stats(StatsDict(capture['stats']), stream=stream)
+        else:
+            stats.add(StatsDict(capture['stats']))
+    return stats
+
+
+def stats_to_stacks(stats):
+    '''Approximates collapsed stacks from cProfile stats: the own time of
+    each function, in microseconds, is attributed to the chain of its
+    heaviest callers.'''
+    stacks = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        if not tt:
+            continue
+
+        names, seen, current = [], set(), func
+        while current is not None and current not in seen:
+            seen.add(current)
+            names.append(get_function_name(current))
+            callers = stats.get(current, (0, 0, 0, 0, {}))[4]
+            current = (max(callers, key=lambda c: callers[c][3])
+                       if callers else None)
+
+        stack = ';'.join(reversed(names))
+        stacks[stack] = stacks.get(stack, 0) + int(tt * 1000000)
+    return stacks
+
+
+def get_collapsed_stacks(captures):
+    '''Returns the collapsed stacks of all the captures, ready to be turned
+    into a flamegraph. Sampled stacks are counted in samples, the ones
+    coming from cProfile in microseconds.'''
+    stacks = {}
+    for capture in captures:
+        if capture['mode'] == SAMPLING:
+            capture_stacks = capture['stacks']
+        else:
+            capture_stacks = stats_to_stacks(capture['stats'])
+
+        for stack, count in capture_stacks.items():
+            stacks[stack] = stacks.get(stack, 0) + count
+    return stacks
+
+
+def get_call_tree(stacks):
+    '''Turns collapsed stacks into a tree of nested dicts, where each node
+    holds its total count under the None key.'''
+    tree = {None: 0}
+    for stack, count in stacks.items():
+        tree[None] += count
+        node = tree
+        for name in stack.split(';'):
+            node = node.setdefault(name, {None: 0})
+            node[None] += count
+    return tree
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import re
+import logging
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+from nuages.signals import request_timed
+
+
+__all__ = ('QueryAccount', 'capture_queries', 'QueryAssertionsMixin')
+
+'''
+Django settings:
+#NUAGES_QUERY_ACCOUNTING
+#NUAGES_QUERY_HEADER
+#NUAGES_N_PLUS_ONE_THRESHOLD
+'''
+QUERY_ACCOUNTING = getattr(settings, 'NUAGES_QUERY_ACCOUNTING', False)
+QUERY_HEADER = getattr(settings, 'NUAGES_QUERY_HEADER', 'X-Nuages-Queries')
+N_PLUS_ONE_THRESHOLD = getattr(settings, 'NUAGES_N_PLUS_ONE_THRESHOLD', 5)
+#Phases in which the same query repeated over and over is suspicious.
+N_PLUS_ONE_PHASES = ('rendering',)
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LISTS = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+
+
+logger = logging.getLogger(__name__)
+_captures = []
+
+
+def is_enabled():
+    return QUERY_ACCOUNTING or bool(_captures)
+
+
+def get_shape(sql):
+    '''Returns the SQL of a query stripped of its literal values, so that
+    queries only differing by their parameters share the same shape.'''
+    shape = IN_LISTS.sub('IN (?)', LITERALS.sub('?', sql))
+    return ' '.join(shape.split())
+
+
+class QueryAccount(object):
+    '''Counts and times the database queries run in each phase of the
+    processing of a request.
+
+    Queries are read from the log Django keeps on each connection, which is
+    forced on until the account is closed.'''
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.shapes = {}
+        self.total = 0
+        self.duration = 0
+        self._connections = connections.all()
+        self._debug_cursors = [c.use_debug_cursor for c in self._connections]
+        for connection in self._connections:
+            connection.use_debug_cursor = True
+        self._start = self.mark()
+
+    def mark(self):
+        '''Returns the position of the logs of the connections, to be given
+        to add() once the phase is over.'''
+        return [len(c.queries) for c in self._connections]
+
+    def get_queries(self, marks):
+        return list(itertools.chain(*[c.queries[mark:] for c, mark
+                                      in zip(self._connections, marks)]))
+
+    def add(self, phase, marks, running=()):
+        '''Accounts the queries run since marks to the phase.
+
+        The shapes of the queries are tracked for the outermost of the
+        phases running in which repeated queries are suspicious, so that
+        those of a phase nested in rendering, e.g. permissions checked for
+        each item, are looked at as well.'''
+        queries = self.get_queries(marks)
+        count, duration = self.phases.get(phase, (0, 0))
+        self.phases[phase] = (count + len(queries),
+                              duration + sum([float(q['time'])
+                                              for q in queries]))
+        suspicious = [name for name in list(running) + [phase]
+                      if name in N_PLUS_ONE_PHASES]
+        if suspicious:
+            shapes = self.shapes.setdefault(suspicious[0], {})
+            for query in queries:
+                shape = get_shape(query['sql'])
+                shapes[shape] = shapes.get(shape, 0) + 1
+
+    def close(self):
+        '''Totals the queries of the request and stops forcing the logs of
+        the connections.'''
+        queries = self.get_queries(self._start)
+        self.total = len(queries)
+        self.duration = sum([float(q['time']) for q in queries])
+        for connection, debug_cursor in zip(self._connections,
+                                            self._debug_cursors):
+            connection.use_debug_cursor = debug_cursor
+
+    def get_count(self, phase):
+        return self.phases.get(phase, (0, 0))[0]
+
+    def get_n_plus_one(self, threshold=N_PLUS_ONE_THRESHOLD):
+        '''Returns a list of (phase, shape, count) tuples for the queries
+        repeated at least threshold times in a phase, most repeated
+        first.'''
+        suspects = [(phase, shape, count)
+                    for phase, shapes in self.shapes.items()
+                    for shape, count in shapes.items() if count >= threshold]
+        return sorted(suspects, key=lambda suspect: -suspect[2])
+
+    def to_header(self):
+        '''Returns a summary of the account, for the header named by
+        NUAGES_QUERY_HEADER.'''
+        items = [('total', self.total, self.duration)]
+        items += [(phase, count, duration) for phase, (count, duration)
+                  in self.phases.items()]
+        value = ', '.join(['%s;count=%d;dur=%.3f' % (name, count,
+                                                     duration * 1000)
+                           for name, count, duration in items])
+        suspects = self.get_n_plus_one()
+        if suspects:
+            value += ', n+1;count=%d' % len(suspects)
+        return value
+
+
+def report(account, node_cls, request, response):
+    '''Logs the likely N+1 problems found in an account, and adds a summary
+    of the account to the response in DEBUG.'''
+    for phase, shape, count in account.get_n_plus_one():
+        logger.warning('Likely N+1 queries while %s %s %s: %d x %s' %
+                       (phase, request.method, request.path, count, shape))
+
+    if settings.DEBUG:
+        response[QUERY_HEADER] = account.to_header()
+
+
+@contextmanager
+def capture_queries():
+    '''Enables the accounting of queries in the block, and yields the list
+    which receives the QueryAccount of every request processed by a node in
+    it.'''
+    accounts = []
+    def receiver(sender, queries=None, **kwargs):
+        if queries is not None:
+            accounts.append(queries)
+
+    _captures.append(accounts)
+    request_timed.connect(receiver, weak=False)
+    try:
+        yield accounts
+    finally:
+        request_timed.disconnect(receiver)
+        _captures.remove(accounts)
+
+
+class QueryAssertionsMixin(object):
+    '''Adds assertions on the queries run by nodes to a
+    django.test.TestCase.'''
+    @contextmanager
+    def assertNodeQueries(self, max_queries=None, allow_n_plus_one=False,
+                          **max_queries_by_phase):
+        '''Fails if a request processed in the block ran more than
+        max_queries queries, exceeded the maximum given for a phase, or
+        showed N+1 queries while rendering.
+
+            with self.assertNodeQueries(10, rendering=0):
+                self.client.get('/books/')'''
+        with capture_queries() as accounts:
+            yield accounts
+
+        for account in accounts:
+            if max_queries is not None and account.total > max_queries:
+                self.fail('%d queries run, %d expected at most:\n%s' %
+                          (account.total, max_queries, account.to_header()))
+
+            for phase, maximum in max_queries_by_phase.items():
+                count = account.get_count(phase)
+                if count > maximum:
+                    self.fail('%d queries run while %s, %d expected at most.'
+                              % (count, phase, maximum))
+
+            suspects = account.get_n_plus_one()
+            if suspects and not allow_n_plus_one:
+                self.fail('Likely N+1 queries:\n' +
+                          '\n'.join(['%s: %d x %s' % (phase, count, shape)
+                                     for phase, shape, count in suspects]))
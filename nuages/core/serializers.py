@@ -2,7 +2,7 @@
 import json
 
 
-__all__ = ('to_json', 'to_xml')
+__all__ = ('Fragment', 'to_json', 'to_xml', 'expand', 'is_serializable')
 
 
 from datetime import datetime, date, time
@@ -15,9 +15,51 @@ class CustomEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+class Fragment(str):
+    '''Data already encoded in JSON, output as is by to_json when it's the
+    data itself or an item of the data list. data is decoded again when
+    needed in another format.'''
+    def __new__(cls, content, data=None):
+        fragment = super(Fragment, cls).__new__(cls, content)
+        fragment._data = data
+        return fragment
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = json.loads(self)
+        return self._data
+
+
 def to_json(data):
+    if isinstance(data, Fragment):
+        return str(data)
+
+    if isinstance(data, list) and any([isinstance(item, Fragment)
+                                       for item in data]):
+        return '[%s]' % ', '.join([str(item) if isinstance(item, Fragment)
+                                   else to_json(item) for item in data])
     return json.dumps(data, cls=CustomEncoder)
 
 
+def is_serializable(data):
+    '''Returns whether data can be encoded by to_json.'''
+    try:
+        to_json(data)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def expand(data):
+    '''Returns data with its fragments decoded.'''
+    if isinstance(data, Fragment):
+        return data.data
+    if isinstance(data, list):
+        return [item.data if isinstance(item, Fragment) else item
+                for item in data]
+    return data
+
+
 def to_xml(data):
     raise NotImplementedError('XML Serialization has yet to be implemented.')
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import time
+import uuid
+import hashlib
+import itertools
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from nuages.core import instrumentation, metrics, sync
+from nuages.core.formatters import ApiResponseFormatter
+from nuages.http import HttpResponse
+from nuages.authentication import get_principal_key
+
+
+__all__ = ('SingleFlight', 'flights', 'process')
+
+'''
+Django settings:
+#NUAGES_COALESCE_TIMEOUT
+#NUAGES_COALESCE_ACROSS_PROCESSES
+'''
+COALESCE_TIMEOUT = getattr(settings, 'NUAGES_COALESCE_TIMEOUT', 5)
+ACROSS_PROCESSES = getattr(settings, 'NUAGES_COALESCE_ACROSS_PROCESSES',
+                           False)
+POLL_INTERVALS = (.005, .01, .02, .05, .1)
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight(object):
+    '''Runs a function once for all the callers asking for the same key at
+    the same time, and hands its result to each one of them.
+
+    Callers of the same process wait for the first one. With shared, the
+    first caller also takes a lock in the cache, and the callers of the
+    other processes poll the cache for its result. Callers who waited more
+    than timeout seconds, or whose leader failed, run the function
+    themselves.'''
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=COALESCE_TIMEOUT, shared=False):
+        '''Returns the result of fn, and whether it was computed by another
+        caller.'''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            if flight.done.wait(timeout) and not flight.failed:
+                return flight.result, True
+            return fn(), False
+
+        try:
+            flight.result, coalesced = self._run(key, fn, timeout, shared)
+            return flight.result, coalesced
+        except:
+            flight.failed = True
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _run(self, key, fn, timeout, shared):
+        if not shared:
+            return fn(), False
+
+        lock_key = 'nuages-flight-%s' % key
+        token = uuid.uuid4().hex
+        if not cache.add(lock_key, token, timeout):
+            result = self._wait(lock_key, timeout)
+            if result is not None:
+                return result, True
+            return fn(), False
+
+        try:
+            result = fn()
+            cache.set('%s-%s' % (lock_key, token), result, timeout)
+            return result, False
+        finally:
+            cache.delete(lock_key)
+
+    def _wait(self, lock_key, timeout):
+        '''Polls the cache for the result of the process holding the lock.
+        Returns None if it didn't come in time.'''
+        token = cache.get(lock_key)
+        if token is None:
+            return None
+
+        deadline = time.time() + timeout
+        for interval in itertools.chain(POLL_INTERVALS,
+                                        itertools.repeat(POLL_INTERVALS[-1])):
+            result = cache.get('%s-%s' % (lock_key, token))
+            if result is not None:
+                return result
+            if cache.get(lock_key) != token or time.time() > deadline:
+                #The leader either failed, or is taking too long.
+                return cache.get('%s-%s' % (lock_key, token))
+            time.sleep(interval)
+
+
+flights = SingleFlight()
+
+
+def get_key(node):
+    '''Returns the key of the requests sharing the response of node: same
+    node, URL, negotiated representation and principal.'''
+    request = node.request
+    hasher = hashlib.sha1()
+    map(hasher.update, [node.get_view_name(),
+                        str(sorted(node._chained_args.items())),
+                        request.get_full_path(),
+                        request.META.get_raw('HTTP_ACCEPT', ''),
+                        request.META.get_raw('HTTP_RANGE', ''),
+                        request.META.get_raw('HTTP_IF_MODIFIED_SINCE', ''),
+                        request.META.get_raw('HTTP_' + sync.SYNC_TOKEN_HEADER,
+                                             ''),
+                        get_principal_key(request.principal)])
+    return hasher.hexdigest()
+
+
+def freeze(node, response):
+    '''Serializes the response of a node, and turns it into a dict made of
+    simple types which can be shared between requests and processes.'''
+    formatted = response.preformatted
+    if not formatted and response.payload:
+        with instrumentation.phase(node.request, 'serialization'):
+            ApiResponseFormatter(node.request, response).format()
+        formatted = True
+
+    return {'status': response.status_code,
+            'content': response.content if formatted else '',
+            'headers': response.items(),
+            'formatted': formatted}
+
+
+def thaw(node, frozen):
+    '''Returns a new response of node made from a frozen one.'''
+    response = HttpResponse(node=node, content=frozen['content'],
+                            status=frozen['status'])
+    for header, value in frozen['headers']:
+        response[header] = value
+    response.preformatted = frozen['formatted']
+    return response
+
+
+def process(node, method_func):
+    '''Calls method_func, the _process_<method> function of node, once for
+    all the identical requests processed at the same time, and returns a
+    response of node made from its serialized result.'''
+    with instrumentation.phase(node.request, 'coalescing'):
+        frozen, coalesced = flights.do(get_key(node),
+                                       lambda: freeze(node, method_func()),
+                                       node.coalesce_timeout,
+                                       ACROSS_PROCESSES)
+    metrics.record_cache('coalescing', coalesced)
+    return thaw(node, frozen)
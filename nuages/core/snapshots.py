@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+import os
+import copy
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpRequest as DjangoHttpRequest
+from nuages import authentication
+from nuages.core import metrics, singleflight, deferred
+from nuages.core.serializers import to_json
+from nuages.http import HttpRequest, Etag, PRINCIPAL_ATTRIBUTE
+from nuages.utils.lru import LRUCache
+
+
+__all__ = ('Snapshot', 'get', 'refresh', 'invalidate')
+
+'''
+Django settings:
+#NUAGES_SNAPSHOT_STORE
+#NUAGES_SNAPSHOT_DIR
+#NUAGES_SNAPSHOT_CACHE_SIZE
+'''
+SNAPSHOT_STORE = getattr(settings, 'NUAGES_SNAPSHOT_STORE', 'memory')
+SNAPSHOT_DIR = getattr(settings, 'NUAGES_SNAPSHOT_DIR',
+                       os.path.join(tempfile.gettempdir(),
+                                    'nuages-snapshots'))
+SNAPSHOT_CACHE_SIZE = getattr(settings, 'NUAGES_SNAPSHOT_CACHE_SIZE', 100)
+SNAPSHOT_PATTERN = 'nuages-snapshot-%s.json'
+DETACHED_META = ('QUERY_STRING', 'HTTP_ACCEPT', 'HTTP_HOST', 'SERVER_NAME',
+                 'SERVER_PORT')
+
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot(object):
+    '''Rendered items of a collection, each one encoded in JSON, as they
+    were when the snapshot was built. modified is the time the items last
+    changed, which may be older than built when a refresh found the same
+    items.'''
+    def __init__(self, items, built=None, modified=None, digest=None):
+        self.items = items
+        self.built = built or time.time()
+        self.modified = modified or self.built
+        self.digest = digest or hashlib.sha1('\n'.join(items)).hexdigest()
+
+    @property
+    def age(self):
+        return max(0, time.time() - self.built)
+
+    def get_etag(self):
+        return Etag(datetime.fromtimestamp(self.modified), self.digest[:20])
+
+    def to_dict(self):
+        return {'items': self.items, 'built': self.built,
+                'modified': self.modified, 'digest': self.digest}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['items'], data['built'], data['modified'],
+                   data['digest'])
+
+
+class DetachedRequest(DjangoHttpRequest):
+    '''Copy of a request keeping what building a snapshot needs once the
+    request is over: its path, query string, host, scheme, Accept header
+    and principal. Neither its body nor the rest of its environment are
+    kept.'''
+    def __init__(self, request):
+        super(DetachedRequest, self).__init__()
+        self.method = 'GET'
+        self.path = request.path
+        self.path_info = request.path_info
+        self.GET = request.GET.copy()
+        base_request = getattr(request, '_base_request', request)
+        self.META = dict([(key, base_request.META[key])
+                          for key in DETACHED_META
+                          if key in base_request.META])
+        self._host = request.get_host()
+        self._secure = request.is_secure()
+        setattr(self, PRINCIPAL_ATTRIBUTE, request.principal)
+
+    def get_host(self):
+        return self._host
+
+    def is_secure(self):
+        return self._secure
+
+
+_snapshots = LRUCache(SNAPSHOT_CACHE_SIZE)
+_builders = {}
+_scheduled = set()
+_connected = set()
+_lock = threading.Lock()
+
+
+def get_snapshot_key(node):
+    '''Snapshots are kept per URL and query string, per principal, as the
+    items are filtered by their permissions, and per root of the absolute
+    URLs they contain.'''
+    request = node.request
+    hasher = hashlib.sha1()
+    map(hasher.update, [node.get_view_name(), '\0',
+                        str(sorted(node._chained_args.items())), '\0',
+                        request.META.get_raw('QUERY_STRING', ''), '\0',
+                        authentication.get_principal_key(request.principal),
+                        '\0',
+                        'https' if request.is_secure() else 'http', '\0',
+                        request.get_host()])
+    return hasher.hexdigest()
+
+
+def get_snapshot_path(key):
+    return os.path.join(SNAPSHOT_DIR, SNAPSHOT_PATTERN % key)
+
+
+def load(node_cls, key):
+    if node_cls.snapshot_store == 'cache':
+        data = cache.get('nuages-snapshot-%s' % key)
+        return Snapshot.from_dict(data) if data else None
+
+    if node_cls.snapshot_store == 'disk':
+        try:
+            with open(get_snapshot_path(key)) as snapshot_file:
+                return Snapshot.from_dict(json.load(snapshot_file))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    return _snapshots.get(key)
+
+
+def save(node_cls, key, snapshot):
+    '''Stores the snapshot for snapshot_max_age seconds, after which it
+    can't be served anymore.'''
+    if node_cls.snapshot_store == 'cache':
+        cache.set('nuages-snapshot-%s' % key, snapshot.to_dict(),
+                  node_cls.snapshot_max_age)
+    elif node_cls.snapshot_store == 'disk':
+        if not os.path.isdir(SNAPSHOT_DIR):
+            try:
+                os.makedirs(SNAPSHOT_DIR)
+            except OSError:
+                pass #Created by another process in the meantime.
+
+        path = get_snapshot_path(key)
+        temporary_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(temporary_path, 'w') as snapshot_file:
+                json.dump(snapshot.to_dict(), snapshot_file)
+            os.rename(temporary_path, path)
+        except (IOError, OSError), e:
+            logger.warning('Unable to write snapshot to %s (%s)' % (path, e))
+    else:
+        _snapshots.set(key, snapshot, node_cls.snapshot_max_age)
+
+
+def build(node):
+    '''Returns the rendered items of the collection of node, up to its
+    max_limit, each one encoded in JSON.'''
+    items = node._call_http_method_handler(offset=0,
+                                           limit=node.max_limit - 1)
+    return [to_json(item) for item in node._render_items(items)[0]]
+
+
+def refresh(node, key=None):
+    '''Builds and stores a new snapshot of the collection of node. Identical
+    refreshes running at the same time are coalesced.'''
+    key = key or get_snapshot_key(node)
+
+    def run():
+        items = build(node)
+        snapshot = Snapshot(items)
+        previous = load(node.__class__, key)
+        if previous and previous.digest == snapshot.digest:
+            snapshot.modified = previous.modified
+        save(node.__class__, key, snapshot)
+        return snapshot
+
+    return singleflight.flights.do('snapshot-%s' % key, run,
+                                   node.coalesce_timeout)[0]
+
+
+def get_node(builder):
+    '''Returns a new node to build a snapshot with, on a copy of the
+    detached request kept by remember.'''
+    node_cls, request, kwargs = builder
+    return node_cls(HttpRequest(copy.copy(request)), **kwargs)
+
+
+def schedule(builder, key):
+    '''Queues a refresh of a snapshot with the deferred tasks, unless one
+    already is.'''
+    with _lock:
+        if key in _scheduled:
+            return
+        _scheduled.add(key)
+
+    def run():
+        try:
+            refresh(get_node(builder), key)
+        finally:
+            with _lock:
+                _scheduled.discard(key)
+
+    task = deferred.Task(run, name='nuages.core.snapshots.refresh')
+    if not deferred.get_queue().submit(task):
+        with _lock:
+            _scheduled.discard(key) #Retried by the next request.
+
+
+def invalidate(node_cls):
+    '''Refreshes, in the background, the snapshots of node_cls served by
+    the process.'''
+    with _lock:
+        builders = _builders.get(node_cls, {}).items()
+    for key, builder in builders:
+        schedule(builder, key)
+
+
+def connect(node_cls):
+    '''Connects the signals of node_cls.snapshot_signals, either signals or
+    (signal, sender) pairs, to the invalidation of its snapshots.'''
+    with _lock:
+        if node_cls in _connected:
+            return
+        _connected.add(node_cls)
+
+    def receiver(**kwargs):
+        invalidate(node_cls)
+
+    for signal in node_cls.snapshot_signals:
+        signal, sender = (signal if isinstance(signal, tuple)
+                          else (signal, None))
+        signal.connect(receiver, sender=sender, weak=False,
+                       dispatch_uid='nuages-snapshot-%s' %
+                                    node_cls.get_view_name())
+
+
+def remember(node, key):
+    '''Keeps what's needed to build the next refreshes of a snapshot in the
+    background: the class and arguments of its node, and a detached copy of
+    the request. Returns them.'''
+    with _lock:
+        builders = _builders.setdefault(node.__class__, OrderedDict())
+        builder = builders.pop(key, None)
+        if builder is None:
+            builder = (node.__class__, DetachedRequest(node.request),
+                       node._chained_args)
+        builders[key] = builder
+        while len(builders) > SNAPSHOT_CACHE_SIZE:
+            builders.popitem(last=False)
+    return builder
+
+
+def get(node):
+    '''Returns the snapshot of the collection of node.
+
+    Snapshots older than snapshot_interval seconds are refreshed in the
+    background, and served meanwhile. Those older than snapshot_max_age
+    seconds, or missing, are built before being served.'''
+    node_cls = node.__class__
+    key = get_snapshot_key(node)
+    connect(node_cls)
+    builder = remember(node, key)
+
+    snapshot = load(node_cls, key)
+    fresh = snapshot is not None and snapshot.age <= node.snapshot_max_age
+    metrics.record_cache('snapshot', fresh)
+    if not fresh:
+        return refresh(node, key)
+
+    if snapshot.age > node.snapshot_interval:
+        schedule(builder, key)
+    return snapshot
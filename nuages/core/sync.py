@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import time
+from datetime import datetime
+from django.conf import settings
+from django.utils.crypto import salted_hmac, constant_time_compare
+from nuages.http import GoneError, datetime_to_timestamp
+
+
+__all__ = ('make_sync_token', 'parse_sync_token', 'get_since')
+
+'''
+Django settings:
+#NUAGES_SYNC_TOKEN_HEADER
+#NUAGES_SYNC_MAX_AGE
+'''
+SYNC_TOKEN_HEADER = getattr(settings, 'NUAGES_SYNC_TOKEN_HEADER',
+                            'Sync-Token')
+SYNC_MAX_AGE = getattr(settings, 'NUAGES_SYNC_MAX_AGE', 30 * 24 * 60 * 60)
+SALT = 'nuages.core.sync'
+
+
+def get_signature(value):
+    return salted_hmac(SALT, value).hexdigest()[:20]
+
+
+def make_sync_token(timestamp):
+    '''Returns a token standing for the state of a collection at timestamp.
+    Tokens are signed, so that clients can't forge them.'''
+    value = '%d' % (timestamp * 1000)
+    return '%s-%s' % (value, get_signature(value))
+
+
+def parse_sync_token(token):
+    '''Returns the timestamp of a token, None if it's not valid.'''
+    value, _, signature = token.strip().partition('-')
+    if not value.isdigit() or not constant_time_compare(signature,
+                                                        get_signature(value)):
+        return None
+    return int(value) / 1000.0
+
+
+def get_since(node):
+    '''Returns the timestamp of the last synchronization of the client
+    requesting node, from its sync token or its If-Modified-Since header,
+    None if it's not synchronizing.
+
+    Raises a GoneError when the token is invalid, or older than
+    max_sync_age: changes that old may not be tracked anymore, so the
+    client has to synchronize from scratch.'''
+    token = node.request.META.get_raw('HTTP_' + SYNC_TOKEN_HEADER)
+    if token:
+        since = parse_sync_token(token)
+        if since is None or since < time.time() - node.max_sync_age:
+            raise GoneError(node, 'The %s has expired, the collection has ' \
+                            'to be retrieved again without it.' %
+                            SYNC_TOKEN_HEADER)
+        return since
+
+    modified_since = node.request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if isinstance(modified_since, datetime):
+        return datetime_to_timestamp(modified_since)
+    return None
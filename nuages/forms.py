@@ -1,9 +1,21 @@
 # -*- coding: utf-8 -*-
-import urlparse
+import itertools
+from datetime import datetime, date
 from django import forms
 from django.forms import ModelForm, fields
 from django.forms import ValidationError
+from django.utils.datastructures import SortedDict
 from django.utils.encoding import force_unicode
+from nuages.http import parse_datetime
+from nuages.core.serializers import is_serializable
+
+
+__all__ = ('Form', 'Validator', 'Param', 'UnexpectedFieldsError')
+
+
+TRUE_VALUES = ['1', 'true', 'yes', 'on']
+FALSE_VALUES = ['0', 'false', 'no', 'off']
+DATE_FORMAT = '%Y-%m-%d'
 
 
 class UnexpectedFieldsError(Exception):
@@ -12,12 +24,19 @@ class UnexpectedFieldsError(Exception):
                                                     ', '.join(field_names))
 
 
+def errors_as_text(errors):
+    lines = []
+    for key, messages in errors.items():
+        lines.append('%s: %s' % (key, ', '.join([force_unicode(msg) for
+                                                 msg in messages])))
+    return '\n'.join(lines)
+
+
 class Form(ModelForm):
     def __init__(self, data=None, strict=True, node=None, *args, **kwargs):
         super(Form, self).__init__(data=data, *args, **kwargs)
         if strict:
-            unexpected_fields = [key for key
-                                 in urlparse.parse_qs(data.urlencode())
+            unexpected_fields = [key for key in (data or {}).keys()
                                  if key not in self.fields]
             if len(unexpected_fields):
                 raise UnexpectedFieldsError(unexpected_fields)
@@ -25,12 +44,192 @@ class Form(ModelForm):
 
 
     def errors_as_text(self):
-        lines = []
-        for key, messages in self.errors.items():
-            lines.append('%s: %s' % (key, ', '.join([force_unicode(msg) for
-                                                     msg in messages])))
-        return '\n'.join(lines)
+        return errors_as_text(self.errors)
 
     def get_first_error(self):
         for v in self.errors.values():
             return ';'.join([force_unicode(i) for i in v])
+
+
+def to_bool(value):
+    '''Converts a string, or a JSON boolean or 0/1 number, to a bool.'''
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, long)) and value in (0, 1):
+        return bool(value)
+    if not isinstance(value, basestring):
+        raise ValueError(value)
+    if value.lower() in TRUE_VALUES:
+        return True
+    if value.lower() in FALSE_VALUES:
+        return False
+    raise ValueError(value)
+
+
+def to_date(value):
+    try:
+        return datetime.strptime(value, DATE_FORMAT).date()
+    except ValueError:
+        return parse_datetime(value).date()
+
+
+class Param(object):
+    '''Declares a parameter of a Validator.
+
+    - type: Callable turning the raw string into a Python value. int, float,
+    bool, unicode, date and datetime are supported out of the box.
+    - required: Required parameters are passed to the handler as args, in the
+    order they were declared and each preceded by the Validator, as the
+    fields of a Form are by the form. Optional ones are passed as kwargs.
+    - default: Value of an optional parameter when it's missing.
+    - choices: Values the parameter is restricted to, once converted.
+    - many: When True, all the values of the parameter are kept in a list.'''
+    creation_counter = itertools.count()
+    converters = {bool: to_bool,
+                  date: to_date,
+                  datetime: parse_datetime,
+                  str: unicode}
+    messages = {'required': u'This field is required.',
+                int: u'Enter a whole number.',
+                float: u'Enter a number.',
+                bool: u'Enter a valid boolean.',
+                date: u'Enter a valid date.',
+                datetime: u'Enter a valid date/time.',
+                'invalid': u'Enter a valid value.',
+                'invalid_list': u'Enter a list of values.',
+                'invalid_choice': u'Select a valid choice. %s is not one of ' \
+                                  u'the available choices.',
+                'min_value': u'Ensure this value is greater than or equal ' \
+                             u'to %s.',
+                'max_value': u'Ensure this value is less than or equal ' \
+                             u'to %s.'}
+    schema_types = {int: 'integer', float: 'number', bool: 'boolean'}
+
+    def __init__(self, type=unicode, required=True, default=None, choices=None,
+                 many=False, min_value=None, max_value=None, help_text=''):
+        self.type = type
+        self.required = required
+        self.default = default
+        self.choices = choices
+        self.many = many
+        self.min_value = min_value
+        self.max_value = max_value
+        self.help_text = help_text
+        self.convert = self.converters.get(type, type)
+        self.creation_counter = Param.creation_counter.next()
+
+    def clean(self, value):
+        '''Converts a raw value, and raises a ValidationError if it's
+        invalid.'''
+        try:
+            value = self.convert(value)
+        except (ValueError, TypeError):
+            raise ValidationError(self.messages.get(self.type,
+                                                    self.messages['invalid']))
+
+        if self.choices is not None and value not in self.choices:
+            raise ValidationError(self.messages['invalid_choice'] % value)
+        if self.min_value is not None and value < self.min_value:
+            raise ValidationError(self.messages['min_value'] % self.min_value)
+        if self.max_value is not None and value > self.max_value:
+            raise ValidationError(self.messages['max_value'] % self.max_value)
+        return value
+
+    def get_schema(self):
+        '''Returns the JSON schema of the parameter.'''
+        schema = {'type': self.schema_types.get(self.type, 'string')}
+        if self.type in (date, datetime):
+            schema['format'] = 'date' if self.type is date else 'date-time'
+        if self.choices is not None:
+            schema['enum'] = list(self.choices)
+        if self.min_value is not None:
+            schema['minimum'] = self.min_value
+        if self.max_value is not None:
+            schema['maximum'] = self.max_value
+        if self.many:
+            schema = {'type': 'array', 'items': schema}
+        if self.help_text:
+            schema['description'] = force_unicode(self.help_text)
+        if self.default is not None and is_serializable(self.default):
+            schema['default'] = self.default
+        return schema
+
+
+class ValidatorMetaclass(type):
+    '''Collects the Param attributes of a Validator class, and compiles them
+    into a plan followed by the validation of every request.'''
+    def __new__(mcs, name, bases, attrs):
+        params = [(key, attrs.pop(key)) for key, value in attrs.items()
+                  if isinstance(value, Param)]
+        params.sort(key=lambda item: item[1].creation_counter)
+        for base in bases[::-1]:
+            if hasattr(base, 'base_fields'):
+                params = base.base_fields.items() + params
+
+        #A Param redefined by a subclass replaces the one of its base.
+        attrs['base_fields'] = SortedDict(params)
+        attrs['plan'] = tuple([(key, param.clean, param.required,
+                                param.default, param.many)
+                               for key, param
+                               in attrs['base_fields'].items()])
+        return super(ValidatorMetaclass, mcs).__new__(mcs, name, bases, attrs)
+
+
+class Validator(object):
+    '''A lightweight alternative to Form to validate the parameters of a
+    request, declared with Param attributes:
+
+        class ListValidator(Validator):
+            status = Param(choices=['open', 'closed'])
+            since = Param(datetime, required=False)
+
+    Unlike a Form, a Validator is never instantiated: the parameters are
+    checked by walking a plan compiled once, when the class is created.'''
+    __metaclass__ = ValidatorMetaclass
+    strict = True
+
+    @classmethod
+    def validate(cls, data):
+        '''Validates a dict or a QueryDict.
+
+        Returns a tuple made of the required values, a dict of the optional
+        ones, and a dict of the error messages of each invalid parameter.
+        Raises an UnexpectedFieldsError in strict mode if data holds unknown
+        parameters.'''
+        if cls.strict:
+            unexpected_fields = [key for key in data.keys()
+                                 if key not in cls.base_fields]
+            if len(unexpected_fields):
+                raise UnexpectedFieldsError(unexpected_fields)
+
+        required, optional, errors = (), {}, {}
+        getlist = getattr(data, 'getlist', None)
+        for key, clean, is_required, default, many in cls.plan:
+            if many:
+                raw = getlist(key) if getlist else data.get(key) or []
+                if not isinstance(raw, (list, tuple)):
+                    errors[key] = [Param.messages['invalid_list']]
+                    continue
+                raw = [item for item in raw if item not in ('', None)]
+            else:
+                raw = data.get(key)
+                if raw == '':
+                    raw = None
+
+            if raw is None or raw == []:
+                if is_required:
+                    errors[key] = [Param.messages['required']]
+                    continue
+                value = default
+            else:
+                try:
+                    value = map(clean, raw) if many else clean(raw)
+                except ValidationError, e:
+                    errors[key] = e.messages
+                    continue
+
+            if is_required:
+                required += (value,)
+            else:
+                optional[key] = value
+        return required, optional, errors
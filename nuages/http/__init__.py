@@ -1,4 +1,7 @@
 import re
+import math
+import hashlib
+import tempfile
 import itertools
 import collections
 import logging
@@ -14,12 +17,26 @@ from nuages.utils import get_matching_mime_types, parse_accept_header
 __all__ = ('HttpResponse', 'HttpResponse', 'HttpError', 'NotModifiedError',
            'InvalidRequestError', 'UnauthorizedError', 'ForbiddenError',
            'MethodNotAllowedError', 'NotAcceptableError', 'ConflictError',
-           'PreconditionFailedError', 'UnsupportedMediaTypeError',
-           'RequestRangeNotSatisfiableError', 'Etag', 'Range', 'ContentRange',)
+           'GoneError', 'PreconditionFailedError',
+           'RequestEntityTooLargeError', 'UnsupportedMediaTypeError',
+           'RequestRangeNotSatisfiableError', 'TooManyRequestsError',
+           'ServiceUnavailableError', 'Etag', 'Range', 'ContentRange',
+           'BodyReader', 'get_body_reader', 'hash_body', 'read_body',
+           'parse_byte_ranges',)
+
+'''
+Django settings:
+#NUAGES_BODY_SPOOL_THRESHOLD
+'''
+BODY_SPOOL_THRESHOLD = getattr(settings, 'NUAGES_BODY_SPOOL_THRESHOLD',
+                               1024 * 1024)
 
 
 logger = logging.getLogger(__name__)
 ISO8601_DATEFORMAT = '%Y-%m-%dT%T.%fZ'
+PARSED_META_ATTRIBUTE = 'nuages_parsed_meta'
+PRINCIPAL_ATTRIBUTE = 'nuages_principal'
+BODY_READER_ATTRIBUTE = 'nuages_body_reader'
 
 
 def datetime_to_timestamp(datetm):
@@ -55,22 +72,192 @@ def parse_datetime(datestr):
                            (datestr, repr(e)))
 
 
+class BodyReader(object):
+    '''File-like reader of the body of a request, of length bytes, reading
+    it from the client as it's read from the reader instead of buffering it
+    as a whole. Iterating over a reader yields chunks of at most chunk_size
+    bytes.
+
+    The body is hashed while it's read, and its hash is available once it's
+    been read entirely. Spooled bodies are read from the client up front,
+    and can be read again and sought.'''
+    def __init__(self, request, length, chunk_size=64 * 1024,
+                 algorithm='sha1'):
+        self.request = request
+        self.length = length
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self._hasher = hashlib.new(algorithm)
+        self._file = None
+
+    @property
+    def complete(self):
+        return self.bytes_read >= self.length
+
+    @property
+    def spooled(self):
+        return self._file is not None
+
+    def read(self, size=-1):
+        '''Returns at most size bytes of the body, the rest of it when size
+        is negative. Raises a BadRequestError if the client sends less than
+        the length of the body.'''
+        if size is None:
+            size = -1
+        if self._file is not None:
+            return self._file.read(size)
+
+        remaining = self.length - self.bytes_read
+        if size < 0 or size > remaining:
+            size = remaining
+
+        chunks = []
+        while size > 0:
+            chunk = self.request.read(size)
+            if not chunk:
+                raise BadRequestError(description='The body is shorter than '
+                                      'its Content-Length.')
+            size -= len(chunk)
+            self.bytes_read += len(chunk)
+            self._hasher.update(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def hexdigest(self):
+        '''Returns the hash of the body.'''
+        if not self.complete:
+            raise RuntimeError('The body has yet to be read entirely.')
+        return self._hasher.hexdigest()
+
+    def get_etag(self, last_modified=None):
+        '''Returns an ETag made of the hash of the body.'''
+        return Etag(last_modified or datetime.now(), self.hexdigest())
+
+    def spool(self, threshold):
+        '''Reads the rest of the body into a temporary file, kept in memory
+        up to threshold bytes. Returns the reader.'''
+        if self._file is None:
+            spooled = tempfile.SpooledTemporaryFile(max_size=threshold)
+            for chunk in self:
+                spooled.write(chunk)
+            spooled.seek(0)
+            self._file = spooled
+        return self
+
+    def seek(self, offset, whence=0):
+        if self._file is None:
+            raise IOError('Only spooled bodies can be sought.')
+        self._file.seek(offset, whence)
+
+    def tell(self):
+        if self._file is None:
+            return self.bytes_read
+        return self._file.tell()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def get_body_reader(request, length):
+    '''Returns the BodyReader of a request, of length bytes, shared by
+    everything reading its body so that it's read from the client once.'''
+    base_request = getattr(request, '_base_request', request)
+    reader = getattr(base_request, BODY_READER_ATTRIBUTE, None)
+    if reader is None:
+        reader = BodyReader(base_request, length)
+        setattr(base_request, BODY_READER_ATTRIBUTE, reader)
+    return reader
+
+
+def is_body_buffered(request):
+    base_request = getattr(request, '_base_request', request)
+    #Django 1.3 keeps the body in _raw_post_data, 1.4 in _body.
+    return (hasattr(base_request, '_raw_post_data') or
+            hasattr(base_request, '_body'))
+
+
+def hash_body(request, algorithm='sha256'):
+    '''Returns the hex hash of the body of a request.
+
+    Bodies larger than NUAGES_BODY_SPOOL_THRESHOLD bytes, which haven't
+    been read yet, aren't buffered in memory: they're spooled by the
+    BodyReader of the request, from which parseBody and read_body read them
+    afterwards.'''
+    try:
+        length = int(request.META.get_raw('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length <= BODY_SPOOL_THRESHOLD or is_body_buffered(request):
+        return hashlib.new(algorithm, request.raw_post_data).hexdigest()
+
+    reader = get_body_reader(request, length).spool(BODY_SPOOL_THRESHOLD)
+    hasher = hashlib.new(algorithm)
+    reader.seek(0)
+    map(hasher.update, reader)
+    reader.seek(0)
+    return hasher.hexdigest()
+
+
+def read_body(request):
+    '''Returns the body of a request as a string, from its BodyReader when
+    it's been spooled.'''
+    base_request = getattr(request, '_base_request', request)
+    reader = getattr(base_request, BODY_READER_ATTRIBUTE, None)
+    if reader is None or not reader.spooled:
+        return request.raw_post_data
+
+    reader.seek(0)
+    body = reader.read()
+    reader.seek(0)
+    return body
+
+
+def parse_etags(raw_header):
+    '''Returns the list of the entity tags found in the value of an If-Match
+    or If-None-Match header, stripped of their quotes and weak indicators.'''
+    etags = []
+    for etag in (raw_header or '').split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if etag:
+            etags.append(etag.strip('"'))
+    return etags
+
+
 class RequestMeta(collections.MutableMapping):
-    '''Wrapper around the META dict of a Django HttpRequest instance'''
-    def __init__(self, request_meta):
+    '''Wrapper around the META dict of a Django HttpRequest instance.
+
+    Headers are parsed the first time they're read, and kept in parsed,
+    which can be shared by the wrappers of the same request.'''
+    def __init__(self, request_meta, parsed=None):
         self.store = request_meta
+        self.parsed = {} if parsed is None else parsed
 
     def __getitem__(self, key):
         key = self.__keytransform__(key)
-        header, value = key, self.store.get(key)
+        if key not in self.parsed:
+            self.parsed[key] = self.__parse__(key, self.store.get(key))
+        return self.parsed[key]
 
+    def __parse__(self, header, value):
         try:
             if header == 'HTTP_AUTHORIZATION':
                 try:
-                    protocol, token = value.strip(' ').split(' ')
+                    protocol, token = value.strip(' ').split(' ', 1)
                     protocol = protocol.upper()
                     if protocol == 'BASIC':
-                        username, password = token.decode('base64').split(':')
+                        username, password = (token.strip(' ')
+                                              .decode('base64')
+                                              .split(':', 1))
                         return protocol, username, password
 
                     return protocol, token
@@ -78,8 +265,13 @@ class RequestMeta(collections.MutableMapping):
                     return value
 
             if header in ['HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH']:
-                return (Etag.parse(value) if ';' not in value
-                        else [map(Etag.parse, value.split(';'))])
+                etags = []
+                for raw_etag in parse_etags(value):
+                    try:
+                        etags.append(Etag.parse(raw_etag))
+                    except ValueError:
+                        continue #Can't be one of ours, so can't match.
+                return etags
 
             if header == 'HTTP_IF_RANGE':
                 return Etag.parse(value)
@@ -91,7 +283,7 @@ class RequestMeta(collections.MutableMapping):
             if header == 'HTTP_RANGE':
                 return Range.parse(value)
 
-            if header == 'HTTP_CONTENT_TYPE':
+            if header in ['HTTP_CONTENT_TYPE', 'CONTENT_TYPE']:
                 return value.split(';')[0] #removing potential "; charset=UTF-8"
 
             if header == 'HTTP_ACCEPT':
@@ -116,11 +308,27 @@ class RequestMeta(collections.MutableMapping):
 
         return default
 
+    def get_parsed(self, key, type_, default=None):
+        '''Returns the parsed value of a header, or default if it's missing
+        or malformed, i.e. if it couldn't be parsed into an instance of
+        type_.'''
+        value = self.get(key)
+        return value if isinstance(value, type_) else default
+
+    def get_raw(self, key, default=None):
+        '''Returns the value of a header as it was received, without any
+        parsing.'''
+        return self.store.get(self.__keytransform__(key), default)
+
     def __setitem__(self, key, value):
-        self.store[self.__keytransform__(key)] = value
+        key = self.__keytransform__(key)
+        self.parsed.pop(key, None)
+        self.store[key] = value
 
     def __delitem__(self, key):
-        del self.store[self.__keytransform__(key)]
+        key = self.__keytransform__(key)
+        self.parsed.pop(key, None)
+        del self.store[key]
 
     def __iter__(self):
         return iter(self.store)
@@ -139,7 +347,11 @@ class HttpRequest(object):
     '''
     def __init__(self, base_request):
         self._base_request = base_request
-        self.META = RequestMeta(base_request.META)
+        parsed = getattr(base_request, PARSED_META_ATTRIBUTE, None)
+        if parsed is None:
+            parsed = {}
+            setattr(base_request, PARSED_META_ATTRIBUTE, parsed)
+        self.META = RequestMeta(base_request.META, parsed)
 
     @property
     def method(self):
@@ -149,6 +361,12 @@ class HttpRequest(object):
         return self.META.get('HTTP_X_HTTP_METHOD_OVERRIDE',
                              self._base_request.method).upper()
 
+    @property
+    def principal(self):
+        '''The principal the request was authenticated as by
+        nuages.authentication, None for anonymous requests.'''
+        return getattr(self._base_request, PRINCIPAL_ATTRIBUTE, None)
+
     def __getattr__(self, name):
         '''Allows all the attributes of the base HttpRequest to be mirrored in
         the wrapper, unless they've been overridden.'''
@@ -156,10 +374,14 @@ class HttpRequest(object):
 
 
 class HttpResponse(_HttpResponse):
-    '''A transparent wrapper around the Django HttpResponse class.'''
+    '''A transparent wrapper around the Django HttpResponse class.
+
+    Unless preformatted is set, the payload is serialized according to the
+    Accept header of the request once the response leaves the node.'''
     def __init__(self, node=None, payload=None, *args, **kwargs):
         self.__node = node
         self.payload = None
+        self.preformatted = False
         super(HttpResponse, self).__init__(*args, **kwargs)
 
     def __getattr(self, attr):
@@ -254,9 +476,10 @@ class UnauthorizedError(HttpError):
     containing a challenge applicable to the requested resource."
 
     (http://www.w3.org/Protocols/rfc2616/rfc2616-sec10.html#sec10.4.2)'''
-    def __init__(self, node=None):
-        super(UnauthorizedError, self).__init__(node, 401)
-        #TODO: Add a WWW-Authenticate header
+    def __init__(self, node=None, challenges=(), description=''):
+        super(UnauthorizedError, self).__init__(node, 401, description)
+        if challenges:
+            self['WWW-Authenticate'] = ', '.join(challenges)
 
 
 class ForbiddenError(HttpError):
@@ -309,6 +532,14 @@ class ConflictError(HttpError):
         super(ConflictError, self).__init__(node, 409, description)
 
 
+class GoneError(HttpError):
+    '''"The requested resource is no longer available at the server and no
+    forwarding address is known. This condition is expected to be
+    considered permanent."'''
+    def __init__(self, node=None, description=''):
+        super(GoneError, self).__init__(node, 410, description)
+
+
 class PreconditionFailedError(HttpError):
     '''"The precondition given in one or more of the request-header fields
     evaluated to false when it was tested on the server."'''
@@ -316,6 +547,16 @@ class PreconditionFailedError(HttpError):
         super(PreconditionFailedError, self).__init__(node, 412, description)
 
 
+class RequestEntityTooLargeError(HttpError):
+    '''"The server is refusing to process a request because the request
+    entity is larger than the server is willing or able to process."'''
+    def __init__(self, node=None, max_size=None, description=''):
+        if max_size and not description:
+            description = 'Request entity must not exceed %d bytes.' % max_size
+        super(RequestEntityTooLargeError, self).__init__(node, 413,
+                                                         description)
+
+
 class UnsupportedMediaTypeError(HttpError):
     '''"The server is refusing to service the request because the entity of
     the request is in a format not supported by the requested resource for the
@@ -339,6 +580,31 @@ class RequestedRangeNotSatisfiableError(HttpError):
                                                                 description)
 
 
+class TooManyRequestsError(HttpError):
+    '''"The user has sent too many requests in a given amount of time
+    ("rate limiting").
+
+    The response representations SHOULD include details explaining the
+    condition, and MAY include a Retry-After header indicating how long to
+    wait before making a new request."
+    (http://tools.ietf.org/html/rfc6585#section-4)'''
+    def __init__(self, node=None, retry_after=None, description=''):
+        super(TooManyRequestsError, self).__init__(node, 429, description)
+        self.payload['error'] = 'TOO MANY REQUESTS'
+        if retry_after:
+            self['Retry-After'] = str(int(math.ceil(retry_after)))
+
+
+class ServiceUnavailableError(HttpError):
+    '''"The server is currently unable to handle the request due to a
+    temporary overloading or maintenance of the server. [...] If known, the
+    length of the delay MAY be indicated in a Retry-After header."'''
+    def __init__(self, node=None, retry_after=None, description=''):
+        super(ServiceUnavailableError, self).__init__(node, 503, description)
+        if retry_after:
+            self['Retry-After'] = str(int(math.ceil(retry_after)))
+
+
 class Etag(object):
     '''The ETag response-header field provides the current value of the entity
     tag for the requested variant
@@ -358,10 +624,9 @@ class Etag(object):
             if repr(self) == '*' or repr(instance) == '*':
                 return True
 
-            if self.id_ != instance.id_:
-                return False
-
-            return self.last_modified == instance.last_modified
+            #ETags are compared as they're sent to clients, with their
+            #timestamps rounded to the millisecond.
+            return repr(self) == repr(instance)
         except:
             return False
 
@@ -386,11 +651,18 @@ class Etag(object):
 
     @classmethod
     def parse(cls, raw_etag):
+        raw_etag = raw_etag.strip()
+        if raw_etag.startswith('W/'):
+            raw_etag = raw_etag[2:]
+        raw_etag = raw_etag.strip('"')
+        if raw_etag == '*':
+            return ETAG_WILDCARD
+
         try:
-            timestamp, id_ = raw_etag.split('-')
-            return cls(datetime.fromtimestamp(timestamp), id_)
-        except:
-            ValueError('Invalid \'Etag\' header value')
+            timestamp, id_ = raw_etag.split('-', 1)
+            return cls(datetime.fromtimestamp(float(timestamp)), id_)
+        except (ValueError, TypeError):
+            raise ValueError('Invalid \'Etag\' header value')
 
 
 ETAG_WILDCARD = Etag(datetime.fromtimestamp(0), '0')
@@ -421,6 +693,41 @@ class Range(object):
                    int(values['limit']))
 
 
+def parse_byte_ranges(raw_header, length):
+    '''Returns the (first, last) positions, included, of the ranges of a
+    bytes Range header which a body of length bytes can satisfy, None if
+    the header isn't a valid bytes Range header, which must then be
+    ignored. Suffix ranges ("-500") and open ranges ("9500-") are resolved
+    against length.
+    (http://tools.ietf.org/html/rfc7233#section-2.1)'''
+    unit, _, specs = (raw_header or '').partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        if not spec.strip():
+            continue
+        match = re.match(r'^(\d*)-(\d*)$', spec.strip())
+        if not match or match.groups() == ('', ''):
+            return None
+
+        first, last = match.groups()
+        if not first:
+            suffix = int(last)
+            if suffix and length:
+                ranges.append((max(0, length - suffix), length - 1))
+            continue
+
+        first = int(first)
+        if last and int(last) < first:
+            return None
+        if first < length:
+            last = int(last) if last else length - 1
+            ranges.append((first, min(last, length - 1)))
+    return ranges if specs.strip() else None
+
+
 class ContentRange(object):
     '''Builds a valid Content-Range header representation as defined in the
     HTTP protocol.
@@ -433,4 +740,4 @@ class ContentRange(object):
         map(lambda key: setattr(self, key, self.__locals[key]), self.__locals)
 
     def __repr__(self):
-        return '%(unit) %(first)-%(last)/%(total)' % self.__locals
+        return '%(unit)s %(first)d-%(last)d/%(total)s' % self.__locals
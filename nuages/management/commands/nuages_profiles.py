@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from nuages.core import profiling
+
+
+FORMATS = ('tree', 'collapsed', 'stats', 'list')
+
+
+class Command(BaseCommand):
+    help = ('Aggregates the profiles captured by Nuages into a call tree, '
+            'cProfile stats or collapsed stacks for flamegraph.pl.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='tree',
+                    help='Output format: %s.' % ', '.join(FORMATS)),
+        make_option('--node', dest='node', default=None,
+                    help='Only aggregate the captures of the node with this '
+                         'view name.'),
+        make_option('--dir', dest='directory',
+                    default=profiling.CAPTURES_DIR,
+                    help='Directory of the captures '
+                         '(NUAGES_PROFILER_DIR by default).'),
+        make_option('--limit', dest='limit', type='int', default=40,
+                    help='Number of functions printed in the stats.'),
+        make_option('--min-percent', dest='min_percent', type='float',
+                    default=1.0,
+                    help='Branches of the tree under this percentage of the '
+                         'total are hidden.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['format'] not in FORMATS:
+            raise CommandError('Unknown format "%s".' % options['format'])
+        if not options['directory']:
+            raise CommandError('No directory of captures given.')
+
+        captures = [capture for capture
+                    in profiling.CaptureStore(options['directory']).load()
+                    if not options['node'] or
+                    capture['view_name'] == options['node']]
+        if not captures:
+            raise CommandError('No captures found.')
+
+        getattr(self, 'write_%s' % options['format'])(captures, **options)
+
+    def write_list(self, captures, **options):
+        for capture in captures:
+            self.stdout.write('%(path)s %(method)s %(node)s %(mode)s '
+                              '%(duration).3fs\n' % capture)
+            for phase, duration in sorted(capture['timings'].items()):
+                self.stdout.write('    %s: %.3fs\n' % (phase, duration))
+
+    def write_stats(self, captures, limit, **options):
+        stats = profiling.get_stats(captures, stream=self.stdout)
+        if stats is None:
+            raise CommandError('No cProfile captures found.')
+        stats.sort_stats('cumulative').print_stats(limit)
+
+    def write_collapsed(self, captures, **options):
+        stacks = profiling.get_collapsed_stacks(captures)
+        for stack, count in sorted(stacks.items()):
+            self.stdout.write('%s %d\n' % (stack, count))
+
+    def write_tree(self, captures, min_percent, **options):
+        tree = profiling.get_call_tree(
+                                profiling.get_collapsed_stacks(captures))
+        self._write_branch(tree, tree[None], min_percent, 0)
+
+    def _write_branch(self, branch, total, min_percent, depth):
+        children = sorted([(node[None], name) for name, node
+                           in branch.items() if name is not None],
+                          reverse=True)
+        for count, name in children:
+            percent = 100.0 * count / (total or 1)
+            if percent < min_percent:
+                continue
+            self.stdout.write('%s%5.1f%% %s\n' % ('  ' * depth, percent, name))
+            self._write_branch(branch[name], total, min_percent, depth + 1)
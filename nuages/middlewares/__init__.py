@@ -1,8 +1,9 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
 from django.http import Http404
 from django.conf import settings
 from django.utils.cache import patch_vary_headers
 from nuages.utils import add_header_if_undefined
+from nuages.core import instrumentation, notifications, deferred
 from nuages.core.formatters import ApiResponseFormatter, ErrorResponseFormatter
 from nuages.nodes import get_method_handlers, get_matching_mime_types_for_node
 from nuages.http import (HttpRequest, HttpError, HttpResponse,
@@ -21,33 +22,46 @@ class RequestHandlerMiddleware():
         method in the node.'''
         try:
             node_cls = view_func.im_self
+            timer = instrumentation.start(request, node_cls)
             request = HttpRequest(request)
 
-            if not len(node_cls.get_allowed_methods(implicits=False)):
-                if settings.DEBUG:
-                    names = set(get_method_handlers(node_cls).values())
-                    raise RuntimeError('%s has no instance methods (%s) to ' \
-                                       'process HTTP requests.' %
-                                       (node_cls.__name__, ', '.join(names)))
-
-                #404 seems to be the most reasonable choice
-                raise Http404
-
-            if request.method not in node_cls.get_allowed_methods():
-                raise MethodNotAllowedError()
-
-            if (request.method != 'OPTIONS' and
-                not len(get_matching_mime_types_for_node(request, node_cls))):
-                    raise NotAcceptableError(node_cls)
-
+            with timer.phase('validation'):
+                self._validate_request(request, node_cls)
         except(HttpError), http_exception:
             return self.process_exception(request, http_exception)
         except AttributeError:
             pass
 
+    def _validate_request(self, request, node_cls):
+        '''Raises an HttpError if the request can't be processed by the node.'''
+        if not len(node_cls.get_allowed_methods(implicits=False)):
+            if settings.DEBUG:
+                names = set(get_method_handlers(node_cls).values())
+                raise RuntimeError('%s has no instance methods (%s) to ' \
+                                   'process HTTP requests.' %
+                                   (node_cls.__name__, ', '.join(names)))
+
+            #404 seems to be the most reasonable choice
+            raise Http404
+
+        if request.method not in node_cls.get_allowed_methods():
+            raise MethodNotAllowedError(node_cls)
+
+        if (request.method != 'OPTIONS' and
+            not len(get_matching_mime_types_for_node(request, node_cls)) and
+            not notifications.is_stream_requested(request, node_cls)):
+                raise NotAcceptableError(node_cls)
+
     def process_response(self, request, response):
         '''Completes the response with global headers that might have not
-        been defined at the node level'''
+        been defined at the node level, then hands the work deferred by the
+        node over to its queue.'''
+        response = self._complete_response(request, response)
+        instrumentation.finish(request, response)
+        deferred.flush(request, response)
+        return response
+
+    def _complete_response(self, request, response):
         if (not issubclass(response.__class__, HttpResponse) or
             not response.node or
             isinstance(response, HttpError) or
@@ -57,18 +71,27 @@ class RequestHandlerMiddleware():
         try:
             node = response.node
             request = node.request
-            etag = node.get_etag()
+            with instrumentation.phase(request, 'etag'):
+                etag = node.get_etag()
             last_modified = etag.last_modified
 
-            if(request.META.get('HTTP_IF_MATCH', ETAG_WILDCARD) != etag or
-               request.META.get('HTTP_IF_UNMODIFIED_SINCE',
-                                last_modified + DAY_DELTA) <= last_modified):
-                raise PreconditionFailedError(self)
-
-            if(request.META.get('HTTP_IF_NONE_MATCH') == etag or
-                request.META.get('HTTP_IF_MODIFIED_SINCE',
-                                 last_modified - DAY_DELTA) >= last_modified):
-                raise NotModifiedError(self)
+            #The preconditions of the other methods are evaluated by the
+            #node before its handler runs, and a wildcard ETag tells nothing
+            #about the modifications of the resource.
+            if request.method in ['GET', 'HEAD'] and repr(etag) != '*':
+                meta = request.META
+                if(etag not in meta.get_parsed('HTTP_IF_MATCH', list,
+                                               [ETAG_WILDCARD]) or
+                   meta.get_parsed('HTTP_IF_UNMODIFIED_SINCE', datetime,
+                                   last_modified + DAY_DELTA) <=
+                   last_modified):
+                    raise PreconditionFailedError(self)
+
+                if(etag in meta.get_parsed('HTTP_IF_NONE_MATCH', list, []) or
+                    meta.get_parsed('HTTP_IF_MODIFIED_SINCE', datetime,
+                                    last_modified - DAY_DELTA) >=
+                    last_modified):
+                    raise NotModifiedError(self)
 
             if request.is_secure():
                 add_header_if_undefined(response, 'Strict-Transport-Security',
@@ -77,11 +100,14 @@ class RequestHandlerMiddleware():
             response['Etag'] = etag
             response['Last-Modified'] = etag.last_modified
 
-            if not response.payload:
+            if response.preformatted:
+                patch_vary_headers(response, ['Accept'])
+            elif not response.payload:
                 del response["Content-Type"]
                 response['Content-Length'] = "0"
             else:
-                ApiResponseFormatter(request, response).format()
+                with instrumentation.phase(request, 'serialization'):
+                    ApiResponseFormatter(request, response).format()
                 patch_vary_headers(response, ['Accept'])
 
             return response
@@ -1,32 +1,65 @@
 # -*- coding: utf-8 -*-
+import os
+import time
 import inspect
 import urlparse
 import hashlib
 import itertools
 import re
+import functools
+import json
+from datetime import datetime
 from django.conf import settings
 from django.utils.importlib import import_module
 from django.core.urlresolvers import reverse, resolve
 from django.core.cache import cache
-from nuages.forms import Form, UnexpectedFieldsError
-from nuages.http import (HttpRequest, HttpResponse,
+from django.http import QueryDict
+from django.utils.cache import patch_vary_headers
+from django.db import transaction
+from nuages.forms import (Form, Validator, UnexpectedFieldsError,
+                          errors_as_text)
+from nuages import authentication
+from nuages.core import (instrumentation, metrics, profiling, singleflight,
+                         admission, idempotency, sync, notifications,
+                         deferred, fragments, snapshots, blobs)
+from nuages.core.serializers import Fragment, to_json
+from nuages.http import (HttpRequest, HttpResponse, HttpError, parse_etags,
+                         BODY_SPOOL_THRESHOLD, get_body_reader, read_body,
                          ETAG_WILDCARD, ForbiddenError, InvalidRequestError,
-                         RequestedRangeNotSatisfiableError,
-                         UnsupportedMediaTypeError,
-                         MethodNotAllowedError)
+                         UnauthorizedError, ConflictError,
+                         PreconditionFailedError,
+                         BadRequestError, RequestedRangeNotSatisfiableError,
+                         RequestEntityTooLargeError, UnsupportedMediaTypeError,
+                         MethodNotAllowedError, NotAcceptableError,
+                         NotFoundError, ContentRange)
 from nuages.utils import get_matching_mime_types, doc
+from nuages.utils.lru import LRUCache
+from nuages.utils.patch import JSON_PATCH, MERGE_PATCH, Patch, PatchError
 
 
-__all__ = ('Node', 'CollectionNode', 'ResourceNode', 'NodeAlias',
-           'parseQueryString', 'parseBody')
+__all__ = ('Node', 'CollectionNode', 'ModelCollectionNode', 'ResourceNode',
+           'MetricsNode', 'BlobNode', 'NodeAlias', 'parseQueryString',
+           'parseBody', 'parsePatch', 'prefetch')
 
 '''
 Django settings:
 #NUAGES_API_ENDPOINT
 #NUAGES_MAX_COLLECTION_SIZE
+#NUAGES_MAX_BODY_SIZE
+#NUAGES_COUNT_CACHE_TIMEOUT
+#NUAGES_CURSOR_CACHE_TIMEOUT
+#NUAGES_PERMISSION_BATCH_SIZE
+#NUAGES_MAX_BATCH_SIZE
+#NUAGES_ALIAS_CACHE_SIZE
 '''
 API_ENDPOINT = urlparse.urlparse(getattr(settings, 'NUAGES_API_ENDPOINT', ''))
 MAX_COLLECTION_SIZE = getattr(settings, 'NUAGES_MAX_COLLECTION_SIZE', 1000)
+MAX_BODY_SIZE = getattr(settings, 'NUAGES_MAX_BODY_SIZE', 2 * 1024 * 1024)
+COUNT_CACHE_TIMEOUT = getattr(settings, 'NUAGES_COUNT_CACHE_TIMEOUT', 60)
+CURSOR_CACHE_TIMEOUT = getattr(settings, 'NUAGES_CURSOR_CACHE_TIMEOUT', 300)
+PERMISSION_BATCH_SIZE = getattr(settings, 'NUAGES_PERMISSION_BATCH_SIZE', 500)
+MAX_BATCH_SIZE = getattr(settings, 'NUAGES_MAX_BATCH_SIZE', 1000)
+ALIAS_CACHE_SIZE = getattr(settings, 'NUAGES_ALIAS_CACHE_SIZE', 10000)
 IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS']
 RESOURCE_HTTP_METHODS_HANDLERS = {  'HEAD'     : 'retrieve',
                                     'GET'      : 'retrieve',
@@ -40,13 +73,56 @@ COLLECTION_HTTP_METHODS_HANDLER = { 'HEAD'     : 'list',
                                     'PATCH'    : 'modify',
                                     'DELETE'   : 'delete', }
 FORM_URL_ENCODED = 'application/x-www-form-urlencoded'
+JSON = 'application/json'
+DOC_CONTENT_TYPE = 'application/json'
 
 
 def get_matching_mime_types_for_node(request, node_class):
-    return get_matching_mime_types(request, node_class.outputs)
+    #*/* only gets replaced by the default content type once the node is
+    #instantiated, and requests are validated before that.
+    outputs = [settings.DEFAULT_CONTENT_TYPE if output == '*/*' else output
+               for output in node_class.outputs]
+    return get_matching_mime_types(request, outputs)
+
+
+def build_absolute_url(request, relative, secure=False):
+    '''Returns the absolute URL of a path, on the API root configured in the
+    settings, or on the host of the request.'''
+    secure = secure or request.is_secure()
+    return urlparse.urlunparse(('https' if secure else 'http',
+                                API_ENDPOINT[1] or request.get_host(),
+                                relative, None, None, None))
+
+
+def iter_batches(iterable, size):
+    '''Yields lists of at most size items of iterable.'''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def filter_permitted(request, nodes):
+    '''Returns the nodes the request is allowed to cross, in order. The
+    permissions of the nodes of each class are evaluated in one call to
+    its filter_permitted method.'''
+    by_class = {}
+    for node in nodes:
+        by_class.setdefault(node.__class__, []).append(node)
+
+    permitted = set()
+    with instrumentation.phase(request, 'permissions'):
+        for node_cls, group in by_class.items():
+            for node in node_cls.filter_permitted(request, group):
+                node._crossable = True
+                permitted.add(id(node))
+    return [node for node in nodes if id(node) in permitted]
 
 
 flattened_urlconf = []
+_doc_representations = {}
 def flatten_urlconf():
     def flatten(item):
         if hasattr(item, 'url_patterns'):
@@ -72,10 +148,22 @@ class Node(object):
     name = None
     parent = None
     secure = False
+    authentication_required = False
+    coalesce = False
+    coalesce_timeout = singleflight.COALESCE_TIMEOUT
+    max_concurrency = None
+    max_queue_time = None
+    rate_limit = None
+    retry_after = None
+    patch_response = 'full'
+    watchable = False
     method_handlers = None
+    profile_threshold = None
     _chained_args = None
     _parent_node = None
+    _crossable = None
     _post_mortem_etag = None
+    _patch = None
     outputs = ['application/json', 'application/xml',
                'application/xml+xhtml', 'text/html', '*/*']
 
@@ -90,7 +178,7 @@ class Node(object):
             return cached
 
         cls.pattern_regex = re.compile(cls.get_full_url_pattern())
-        cls.label = cls.label or cls.__name__.lower()
+        cls.label = cls.get_label()
         cls.outputs = set([settings.DEFAULT_CONTENT_TYPE if c == '*/*' else c
                            for c in cls.outputs])
 
@@ -99,15 +187,20 @@ class Node(object):
         cache.set(key, instance)
         return instance
 
-    def __init__(self, request, parent_node=None, *args, **kwargs):
+    def __init__(self, request, parent_node=None, check_permissions=True,
+                 *args, **kwargs):
         '''Initializes a new instance of the Node class:
         - request: Current HttpRequest instance.
+        - check_permissions: When False, the node isn't checked for
+        crossability, which is left to a batch call to filter_permitted.
         - *args, **kwargs are passed all the way to the top parent node.'''
 
         if not getattr(self, '__nuages_node_key__'):
             return
 
         self.request = request
+        self._crossable = None
+        self._patch = None
         map(lambda t: setattr(self, t[0], t[1]), kwargs.items())
         self._chained_args = kwargs
 
@@ -116,7 +209,8 @@ class Node(object):
         elif self.parent:
             self._parent_node = self.parent(request, **self._chained_args)
 
-        self._try_cross()
+        if check_permissions:
+            self._try_cross()
 
         self._matching_outputs = get_matching_mime_types_for_node(
             request,
@@ -137,38 +231,51 @@ class Node(object):
         be modified or not'''
         return False
 
+    def is_crossable(self):
+        '''Returns whether the node can be crossed. _can_cross is only called
+        once per node.'''
+        if self._crossable is None:
+            with instrumentation.phase(self.request, 'permissions'):
+                self._crossable = bool(self._can_cross())
+        return self._crossable
+
     def _try_cross(self):
         '''Checks if the node is crossable, otherwise raises an exception.'''
-        if not self._can_cross():
+        if not self.is_crossable():
             raise ForbiddenError(self, 'Access to resource has been denied.')
 
     def _try_read(self):
         '''Checks if the node is readable, otherwise raises an exception.'''
-        if not self._can_read():
-            raise ForbiddenError(self, 'Access to resource has been denied.')
+        with instrumentation.phase(self.request, 'permissions'):
+            if not self._can_read():
+                raise ForbiddenError(self,
+                                     'Access to resource has been denied.')
 
     def _try_write(self):
         '''Checks if the node is writable, otherwise raises an exception.'''
-        if not self._can_write():
-            raise ForbiddenError(self, 'Access to resource has been denied.')
+        with instrumentation.phase(self.request, 'permissions'):
+            if not self._can_write():
+                raise ForbiddenError(self,
+                                     'Access to resource has been denied.')
 
     def _try_handle_request(self):
         if self.request.method == 'OPTIONS':
             return True
 
-        func_name = ('_can_%s' %
-                     self.method_handlers[self.request.method])
+        with instrumentation.phase(self.request, 'permissions'):
+            func_name = ('_can_%s' %
+                         self.method_handlers[self.request.method])
 
-        if hasattr(self, func_name):
-            if not getattr(self, func_name)():
-                raise ForbiddenError(self,
-                                     'Access to resource has been denied.')
-            return
+            if hasattr(self, func_name):
+                if not getattr(self, func_name)():
+                    raise ForbiddenError(self,
+                                         'Access to resource has been denied.')
+                return
 
-        if self.request.method.upper() in IDEMPOTENT_METHODS:
-            return self._try_read()
+            if self.request.method.upper() in IDEMPOTENT_METHODS:
+                return self._try_read()
 
-        return self._try_write()
+            return self._try_write()
 
     def build_url(self, absolute=True):
         '''Dynamically builds the URL of the current node.
@@ -177,18 +284,22 @@ class Node(object):
         API root configured in the settings.'''
         self._try_cross() #You don't need the URL of a resource you can't cross.
 
-        kwargs = self._chained_args
-        for key in [key for (key, value) in self.__class__.pattern_regex.groupindex.items() if key not in self._chained_args]:
-            kwargs.pop(key, None)
+        #Only the arguments captured by the URL pattern are used to reverse it.
+        groups = self.__class__.pattern_regex.groupindex
+        kwargs = dict([(key, value) for key, value
+                       in self._chained_args.items() if key in groups])
 
         relative = reverse(self.get_view_name(), kwargs=kwargs)
         if not absolute:
             return relative
+        return build_absolute_url(self.request, relative, self.secure)
 
-        secure = self.secure or self.request.is_secure()
-        return urlparse.urlunparse(('https' if secure else 'http',
-                                    API_ENDPOINT[1] or self.request.get_host(),
-                                    relative, None, None, None))
+    def defer(self, func, *args, **kwargs):
+        '''Calls func with args and kwargs once the response is complete,
+        outside of the time the client waits for it. Meant for the side
+        effects of handlers, like indexing or notifying other services.
+        Deferred calls are dropped if the request fails.'''
+        deferred.defer(self.request, func, *args, **kwargs)
 
     def get_etag(self):
         '''Gets the ETag of the current node.'''
@@ -211,28 +322,102 @@ class Node(object):
           self,
           self.method_handlers[method or self.request.method.upper()]
         )
-        return handler(*args, **kwargs)
+        with instrumentation.phase(self.request, 'handler'):
+            return handler(*args, **kwargs)
 
-    def _process_get(self):
+    def _process_get(self, fields=None):
+        '''Renders the resource and the references to its children, or only
+        the given fields of the resource.'''
         response = HttpResponse(node=self,
                                 content_type=self._matching_outputs[0])
         data = self._call_http_method_handler(method='GET')
-        for node_cls in self.__class__.get_children_nodes():
-            try:
-                child_node = node_cls(self.request, parent_node=self, **self._chained_args)
-                data.update(child_node.render_in_parent())
-            except ForbiddenError:
-                continue
+        if fields is not None:
+            response.payload = dict([(key, value) for key, value
+                                     in data.items() if key in fields])
+            return response
+
+        with instrumentation.phase(self.request, 'rendering'):
+            children = [node_cls(self.request, parent_node=self,
+                                 check_permissions=False,
+                                 **self._chained_args)
+                        for node_cls in self.__class__.get_children_nodes()]
+            for child_node in filter_permitted(self.request, children):
+                try:
+                    data.update(child_node.render_in_parent())
+                except ForbiddenError:
+                    continue
 
         response.payload = data
         return response
 
     def _process_patch(self):
         '''If not exception is raised, the resource is serialized and included
-        in the body of the response'''
-        if self._call_http_method_handler() is False:
-            return HttpResponse(node=self, status=204)
-        return self._process_get()
+        in the body of the response, according to patch_response:
+        - 'full': the whole resource,
+        - 'changes': the fields changed by the JSON Patch or Merge Patch
+        received (see parsePatch), the whole resource for other bodies,
+        - 'minimal': nothing, the new ETag being in the headers of a 204.
+        Clients can ask for 'minimal' or 'full' with a Prefer header set to
+        return=minimal or return=representation.'''
+        try:
+            result = self._call_http_method_handler()
+        except PatchError, e:
+            raise ConflictError(self, 'The patch can\'t be applied: %s' % e)
+
+        mode, preferred = self._get_patch_response()
+        fields = self._patch.get_fields() if self._patch else None
+        if result is False or mode == 'minimal':
+            response = HttpResponse(node=self, status=204)
+        elif mode == 'changes' and fields is not None:
+            response = self._process_get(fields=fields)
+        else:
+            response = self._process_get()
+
+        if preferred:
+            response['Preference-Applied'] = ('return=minimal'
+                                              if mode == 'minimal'
+                                              else 'return=representation')
+        return response
+
+    def _get_patch_response(self):
+        '''Returns the patch_response mode of the request, and whether it
+        was asked for by the client.'''
+        prefer = self.request.META.get_raw('HTTP_PREFER', '')
+        for preference in prefer.split(','):
+            preference = preference.split(';')[0].strip().lower()
+            if preference == 'return=minimal':
+                return 'minimal', True
+            if preference == 'return=representation':
+                return 'full', True
+        return self.patch_response, False
+
+    def _check_preconditions(self):
+        '''Evaluates the If-Match, If-None-Match and If-Unmodified-Since
+        headers of requests changing the resource, before the handler runs,
+        so that a client working on a stale representation can't overwrite
+        the changes of another one.
+
+        Malformed headers are ignored, and so are all of them for a node
+        whose ETag is the wildcard, as for GET requests.'''
+        meta = self.request.META
+        if_match = meta.get_parsed('HTTP_IF_MATCH', list)
+        if_none_match = meta.get_parsed('HTTP_IF_NONE_MATCH', list)
+        if_unmodified_since = meta.get_parsed('HTTP_IF_UNMODIFIED_SINCE',
+                                              datetime)
+        if (if_match is None and if_none_match is None and
+            if_unmodified_since is None):
+            return
+
+        with instrumentation.phase(self.request, 'etag'):
+            etag = self.get_etag()
+        if repr(etag) == '*':
+            return
+
+        if ((if_match is not None and etag not in if_match) or
+            (if_none_match is not None and etag in if_none_match) or
+            (if_unmodified_since is not None and
+             etag.last_modified.replace(microsecond=0) > if_unmodified_since)):
+            raise PreconditionFailedError(self)
 
     def _process_put(self):
         self._call_http_method_handler()
@@ -268,9 +453,17 @@ class Node(object):
         the current node to generate a doc and add it to the body of the
         response.'''
         allowed = self.__class__.get_allowed_methods(implicits=False)
-        response = HttpResponse(node=self, status=200)
+        content, etag = self.__class__.get_doc_representation()
+        client_etags = parse_etags(
+                        self.request.META.get_raw('HTTP_IF_NONE_MATCH'))
+        if etag in client_etags or '*' in client_etags:
+            response = HttpResponse(node=self, status=304)
+        else:
+            response = HttpResponse(node=self, status=200,
+                                    content=content,
+                                    content_type=DOC_CONTENT_TYPE)
         response['Allow'] = ', '.join(map(lambda x: x.upper(), allowed))
-        response.content = self.__class__.generate_doc()
+        response['ETag'] = '"%s"' % etag
         return response
 
     @property
@@ -280,16 +473,22 @@ class Node(object):
 
     @classmethod
     def generate_doc(cls):
-        allowed = cls.get_allowed_methods(implicits=False)
-        node_doc = doc.Node(name=cls.label,
+        '''Returns the description of the node as a nuages.utils.doc.Node
+        instance.'''
+        allowed = sorted(cls.get_allowed_methods(implicits=False))
+        node_doc = doc.Node(name=cls.get_label(),
                             url_regex=cls.get_full_url_pattern(),
-                            accept=cls.outputs)
+                            accept=set([settings.DEFAULT_CONTENT_TYPE
+                                        if c == '*/*' else c
+                                        for c in cls.outputs]),
+                            description=cls.__doc__ or '')
         for i, handler_func in enumerate([getattr(cls,
                                                   cls.method_handlers[m])
                                           for m in allowed]):
             qstr_deco = handler_func.func_dict.get(parseQueryString.__name__)
             qstr_form = qstr_deco.form_cls if qstr_deco else None
-            body_deco = handler_func.func_dict.get(parseBody.__name__)
+            body_deco = (handler_func.func_dict.get(parseBody.__name__) or
+                         handler_func.func_dict.get(parsePatch.__name__))
             body_form = body_deco.form_cls if body_deco else None
             method_doc = doc.Method(verb=allowed[i],
                                     description=handler_func.__doc__,
@@ -298,7 +497,30 @@ class Node(object):
                                     content_types=(body_deco.content_types if
                                                    body_deco else []))
             node_doc.methods.append(method_doc)
-        return str(node_doc)
+        return node_doc
+
+    @classmethod
+    def get_doc_representation(cls):
+        '''Returns a tuple made of the JSON encoded description of the node,
+        and its ETag. Both are computed once per node class.'''
+        if cls not in _doc_representations:
+            content = to_json(cls.generate_doc().to_dict())
+            etag = hashlib.sha1(content).hexdigest()
+            _doc_representations[cls] = (content, etag)
+        return _doc_representations[cls]
+
+    @classmethod
+    def get_label(cls):
+        return cls.label or cls.__name__.lower()
+
+    @classmethod
+    def filter_permitted(cls, request, nodes):
+        '''Returns the nodes of the class the request is allowed to cross.
+
+        Collection items and children are checked in batches through this
+        method rather than one by one: override it to decide for many nodes
+        at once, with a single query for instance.'''
+        return [node for node in nodes if node.is_crossable()]
 
     @classmethod
     def get_children_nodes(cls):
@@ -335,77 +557,232 @@ class Node(object):
 
     @classmethod
     def process(cls, request, **kwargs):
-        instance = cls(HttpRequest(request), **kwargs)
-        instance._try_handle_request()
-        method_func = getattr(instance,
-                              '_process_' + instance.request.method.lower())
-        return method_func()
+        with profiling.capture(cls, request, kwargs):
+            request = HttpRequest(request)
+            with instrumentation.phase(request, 'authentication'):
+                principal = authentication.authenticate(request, cls)
+            if principal is None and cls.authentication_required:
+                raise UnauthorizedError(cls, authentication.get_challenges())
+
+            with admission.admit(cls, request):
+                with instrumentation.phase(request, 'instantiation'):
+                    instance = cls(request, **kwargs)
+                instance._try_handle_request()
+                method = instance.request.method
+                if method not in IDEMPOTENT_METHODS:
+                    instance._check_preconditions()
+                elif notifications.is_stream_requested(instance.request, cls):
+                    return notifications.stream(instance)
+                elif cls.watchable and method in ['GET', 'HEAD']:
+                    notifications.wait(instance)
+
+                method_func = getattr(instance, '_process_' + method.lower())
+                if (cls.coalesce and method in ['GET', 'HEAD'] and
+                    not getattr(cls, 'snapshot', False)):
+                    #Identical requests processed at the same time share the
+                    #response of the first one. Those of a collection served
+                    #from a snapshot already share it, and its ETag, which
+                    #only the node reading it knows.
+                    return singleflight.process(instance, method_func)
+
+                response = method_func()
+                if method in notifications.EVENT_TYPES and response:
+                    notifications.publish(instance, response)
+                return response
 
 
 class CollectionNode(Node):
     label = None
     range_unit = None
     max_limit = MAX_COLLECTION_SIZE
+    permission_batch_size = PERMISSION_BATCH_SIZE
+    idempotency_timeout = idempotency.IDEMPOTENCY_TIMEOUT
+    max_batch_size = MAX_BATCH_SIZE
+    delta = False
+    max_sync_age = sync.SYNC_MAX_AGE
+    snapshot = False
+    snapshot_interval = 60
+    snapshot_max_age = 300
+    snapshot_store = snapshots.SNAPSHOT_STORE
+    snapshot_signals = ()
     method_handlers = COLLECTION_HTTP_METHODS_HANDLER
+    _snapshot = None
 
     def __new__(cls, *args, **kwargs):
         cls.range_unit = cls.range_unit or cls.__name__ + 's'
-        cls.label = cls.label or cls.range_unit
         return super(CollectionNode, cls).__new__(cls, *args, **kwargs)
 
-    def _call_http_method_handler(self, *args, **kwargs):
-        handler_name = self.method_handlers[self.request.method.upper()]
+    @classmethod
+    def get_label(cls):
+        return cls.label or cls.range_unit or cls.__name__ + 's'
+
+    def _call_http_method_handler(self, method=None, *args, **kwargs):
+        method = method or self.request.method.upper()
+        handler_name = self.method_handlers[method]
         handler = getattr(self, handler_name, None)
         if not handler:
             raise RuntimeError(
                 '%s has no method "%s" to handle the incoming %s request.' %
-                (self.__class__.__name__, handler_name,
-                 self.request.method.upper())
+                (self.__class__.__name__, handler_name, method)
             )
 
-        return handler(*args, **kwargs)
+        with instrumentation.phase(self.request, 'handler'):
+            return handler(*args, **kwargs)
 
-    def _process_get(self, fields=[]):
-        #TODO: Account for the max_limit property
+    def _process_get(self, fields=None):
+        '''Renders the items of the collection, or the range of them asked
+        for. Collections are always rendered whole: fields is ignored.'''
         response = HttpResponse(node=self,
                                 content_type=self._matching_outputs[0])
 
         request_range = self.request.META.get('HTTP_RANGE')
+        since = self._start_sync(response)
+        if self.snapshot and since is None:
+            return self._process_snapshot(response, request_range)
+
         kwparams = {}
         if not request_range:
             response['Accept-Range'] = self.range_unit
         else:
-            kwparams = {'offset': request_range.offset,
-                        'limit' : request_range.limit}
-        items = self._call_http_method_handler(**kwparams)
+            kwparams = self._get_range_params(request_range)
+        if since is not None:
+            kwparams['since'] = since
+        #Also called to render the collection after a PATCH.
+        items = self._call_http_method_handler(method='GET', **kwparams)
         if items is None:
             raise ValueError(
                 '%s() method of node %s returned None.' %
-                (self.method_handlers.get(self.request.method),
-                 self.__class__.__name__)
+                (self.method_handlers['GET'], self.__class__.__name__)
             )
 
-        if not len(items) and request_range:
-            raise RequestedRangeNotSatisfiableError(self)
+        with instrumentation.phase(self.request, 'rendering'):
+            response.payload, count = self._render_items(items)
+            response.payload += self._render_tombstones(since, request_range)
 
-        response.payload = []
-        for item in items:
-            try:
-                response.payload.append(item.render_in_collection())
-            except ForbiddenError:
-                pass
+        if request_range:
+            self._set_content_range(response, kwparams, count, since)
+        return self._set_status(response, request_range)
 
+    def _get_range_params(self, request_range):
+        '''Returns the parameters of the list handler for the range of items
+        asked for.'''
+        #TODO: Account for the max_limit property
+        return {'offset': request_range.offset,
+                'limit' : request_range.limit}
+
+    def _set_content_range(self, response, kwparams, count, since=None):
+        '''Completes the response to a range request, count being the number
+        of items served. Raises a RequestedRangeNotSatisfiableError when the
+        range is past the end of the collection.'''
+        if not count and since is None:
+            raise RequestedRangeNotSatisfiableError(self)
+
+    def _set_status(self, response, request_range=None):
         if not len(response.payload):
             response.status = 204
         elif request_range:
             response.status = 206
         else:
             response.status = 200
-
         return response
 
+    def _process_snapshot(self, response, request_range=None):
+        '''Serves the collection from its snapshot, which holds its items
+        already rendered and encoded, up to max_limit of them.
+
+        Snapshots are shared by the requests for the same URL made by the
+        same principal, and built with the permissions of that principal:
+        the listing mustn't depend on anything else. They're refreshed in
+        the background once older than snapshot_interval seconds, or when
+        one of snapshot_signals is sent, and never served once older than
+        snapshot_max_age seconds. get_etag answers with the ETag of the
+        snapshot, and shouldn't be overridden. The requests for a snapshot
+        aren't coalesced.'''
+        with instrumentation.phase(self.request, 'snapshot'):
+            self._snapshot = snapshots.get(self)
+        items = self._snapshot.items
+        response['Age'] = str(int(self._snapshot.age))
+
+        if not request_range:
+            response['Accept-Range'] = self.range_unit
+        else:
+            first, last = request_range.offset, request_range.limit
+            if last < first or first >= len(items):
+                raise RequestedRangeNotSatisfiableError(self)
+
+            last = min(last, len(items) - 1)
+            response['Content-Range'] = str(ContentRange(self.range_unit,
+                                                         first, last,
+                                                         len(items)))
+            items = items[first:last + 1]
+
+        response.payload = map(Fragment, items)
+        return self._set_status(response, request_range)
+
+    def get_etag(self):
+        if self._snapshot is not None:
+            return self._snapshot.get_etag()
+        return super(CollectionNode, self).get_etag()
+
+    def _start_sync(self, response):
+        '''Adds a token standing for the current state of the collection to
+        the response of delta collections, and returns the timestamp of the
+        last synchronization of the client, if any.
+
+        Given a since timestamp, the list handler of a delta collection only
+        returns the items changed after it, and its tombstones(since) method
+        the URIs of the items deleted after it. Clients paging through
+        changes should keep the token of the first page.'''
+        if not self.delta:
+            return None
+
+        response[sync.SYNC_TOKEN_HEADER] = sync.make_sync_token(time.time())
+        patch_vary_headers(response, [sync.SYNC_TOKEN_HEADER])
+        return sync.get_since(self)
+
+    def _render_tombstones(self, since, request_range=None):
+        '''Returns the renderings of the items deleted since the last
+        synchronization, given with the first range of changes only.'''
+        if (since is None or not hasattr(self, 'tombstones') or
+            (request_range and request_range.offset)):
+            return []
+        return [{'uri': uri, 'deleted': True}
+                for uri in self.tombstones(since)]
+
+    def _render_items(self, items):
+        '''Renders the items the request is allowed to cross, their
+        permissions being evaluated by batches of permission_batch_size
+        items. Returns the list of renderings, and the number of items
+        iterated.
+
+        Items with a fragment_timeout are rendered through the fragment
+        cache.'''
+        payload, count = [], 0
+        for batch in iter_batches(items, self.permission_batch_size):
+            count += len(batch)
+            for item in filter_permitted(self.request, batch):
+                try:
+                    if getattr(item, 'fragment_timeout', None):
+                        payload.append(fragments.render(item))
+                    else:
+                        payload.append(item.render_in_collection())
+                except ForbiddenError:
+                    pass
+        return payload, count
+
     def _process_post(self):
-        '''Redirects the client to the Node returned by the handler.'''
+        '''Redirects the client to the Node returned by the handler.
+
+        Requests carrying an Idempotency-Key are processed once, retries
+        being answered with the response of the first one.'''
+        key = idempotency.get_idempotency_key(self.request)
+        if key is not None and self.idempotency_timeout:
+            return idempotency.process(self, self._add, key)
+        return self._add()
+
+    def _add(self):
+        if self._is_bulk_request():
+            return self._process_bulk()
 
         created_node = self._call_http_method_handler()
         if not created_node:
@@ -418,9 +795,271 @@ class CollectionNode(Node):
         response['Location'] = created_node.build_url()
         return response
 
+    def _process_put(self):
+        if self._is_bulk_request():
+            return self._process_bulk()
+        return super(CollectionNode, self)._process_put()
+
+    def _process_patch(self):
+        if self._is_bulk_request():
+            return self._process_bulk()
+        return super(CollectionNode, self)._process_patch()
+
+    def _process_delete(self):
+        if self._is_bulk_request():
+            return self._process_bulk()
+        return super(CollectionNode, self)._process_delete()
+
+    def _is_bulk_request(self):
+        '''Requests with a JSON array in their body are processed in bulk
+        when the node has a bulk_<handler> method. Bodies larger than the
+        max_size of the bulk parser are left to the handler, so that they're
+        never buffered here.'''
+        handler_name = self.method_handlers[self.request.method.upper()]
+        if (not hasattr(self, 'bulk_' + handler_name) or
+            self.request.META.get('CONTENT_TYPE') != JSON):
+            return False
+
+        try:
+            content_length = int(self.request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return False
+        max_size = self._get_bulk_parser().max_size
+        if not content_length or (max_size and content_length > max_size):
+            return False
+        return read_body(self.request).lstrip()[:1] == '['
+
+    def _get_bulk_parser(self):
+        '''Returns the parseBody decorator of the handler of the method,
+        unless it streams the body: arrays are parsed in memory, within the
+        limit of NUAGES_MAX_BODY_SIZE.'''
+        handler_name = self.method_handlers[self.request.method.upper()]
+        parser = getattr(getattr(self, handler_name, None), 'parseBody', None)
+        if parser is None or parser.stream:
+            parser = parseBody(content_types=[JSON])
+        return parser
+
+    def _process_bulk(self):
+        '''Processes a JSON array of items at once.
+
+        Each item is validated by the parseBody decorator of the handler of
+        the method, or passed as is in the 'payload' parameter when it has
+        none or streams the body. The bulk_<handler> method is then called
+        in a transaction, with the list of the (args, kwargs) tuples of the
+        valid items, and returns a list holding, for each one of them in order:
+        - the ResourceNode it created, replaced or modified,
+        - None, when there's nothing to return (i.e. deleted items),
+        - an HttpError instance, when the item couldn't be processed.
+        Raising an exception rolls back the whole batch.
+
+        The response is a 207 listing the status of every item sent, with
+        the Location and ETag of its node when there's one.'''
+        method = self.request.method.upper()
+        handler_name = self.method_handlers[method]
+        items = self._get_bulk_parser().parse_many(self, self.max_batch_size)
+        valid = [item for item in items if not isinstance(item, HttpError)]
+
+        results = []
+        if valid:
+            with instrumentation.phase(self.request, 'handler'):
+                with transaction.commit_on_success():
+                    results = getattr(self, 'bulk_' + handler_name)(valid)
+            if results is None or len(results) != len(valid):
+                raise ValueError('%s() method of node %s must return one ' \
+                                 'result per item.' %
+                                 ('bulk_' + handler_name,
+                                  self.__class__.__name__))
+        results = iter(results)
+
+        payload = []
+        with instrumentation.phase(self.request, 'rendering'):
+            for item in items:
+                if not isinstance(item, HttpError):
+                    item = results.next()
+                if isinstance(item, HttpError):
+                    payload.append({'status': item.status_code,
+                                    'error': item.payload.get('error'),
+                                    'description':
+                                        item.payload.get('description')})
+                elif item is None:
+                    payload.append({'status': 204})
+                else:
+                    payload.append({'status': 201 if method == 'POST' else 200,
+                                    'location': item.build_url(),
+                                    'etag': str(item.get_etag())})
+
+        response = HttpResponse(node=self, status=207,
+                                content_type=self._matching_outputs[0])
+        response.payload = payload
+        return response
+
+
+class ModelCollectionNode(CollectionNode):
+    '''Collection of the instances of a Django QuerySet, each one rendered
+    by an item_node instance.
+
+    - queryset: QuerySet of the collection, or override get_queryset().
+    - item_node: ResourceNode class of the items. Its instances are given
+    the model instance they represent in their 'instance' attribute.
+    - item_kwarg: URL argument of item_node receiving the primary key.
+    - keyset_field: Unique field the collection is ordered by. When set,
+    the range following one already served is fetched with a filter on the
+    last key seen instead of an OFFSET.
+    - count_timeout: Number of seconds the total count of the collection,
+    reported in the Content-Range header, is kept in cache.
+    - modified_field: Date field holding the time of the last modification
+    of an instance. Setting it turns delta on: clients synchronizing get
+    the instances modified since their last synchronization only, and the
+    URIs returned by tombstones(since) for the ones deleted.
+
+    Counts and keys are cached per URL and query string: override
+    get_cache_key() if the queryset depends on something else, like the
+    user.'''
+    queryset = None
+    item_node = None
+    item_kwarg = 'id'
+    keyset_field = None
+    modified_field = None
+    count_timeout = COUNT_CACHE_TIMEOUT
+    cursor_timeout = CURSOR_CACHE_TIMEOUT
+
+    @property
+    def delta(self):
+        return bool(self.modified_field)
+
+    def get_queryset(self):
+        if self.queryset is None:
+            raise RuntimeError('%s has no queryset.' % self.__class__.__name__)
+        return self.queryset.all()
+
+    def get_changed_queryset(self, since=None):
+        '''Returns the queryset, restricted to the instances modified after
+        the since timestamp when there's one.'''
+        queryset = self.get_queryset()
+        if since is None:
+            return queryset
+
+        since = datetime.fromtimestamp(since)
+        if getattr(settings, 'USE_TZ', False):
+            from django.utils import timezone #Django 1.4+
+            since = timezone.make_aware(since, timezone.get_default_timezone())
+        return queryset.filter(**{self.modified_field + '__gt': since})
+
+    def get_item_node(self, instance):
+        node = self.item_node(self.request, parent_node=self,
+                              check_permissions=False,
+                              **{self.item_kwarg: unicode(instance.pk)})
+        node.instance = instance
+        return node
+
+    def get_cache_key(self, *parts):
+        hasher = hashlib.sha1()
+        map(hasher.update, [self.get_view_name(),
+                            str(sorted(self._chained_args.items())),
+                            self.request.META.get_raw('QUERY_STRING', '')] +
+                           map(str, parts))
+        return 'nuages-collection-' + hasher.hexdigest()
+
+    def get_rendering_needs(self):
+        '''Returns what the render_in_collection method of item_node
+        declared it needs with the prefetch decorator, if anything.'''
+        return getattr(self.item_node.render_in_collection, 'func_dict',
+                       {}).get(prefetch.__name__)
+
+    def get_projected_queryset(self, since=None):
+        '''Returns the queryset restricted to the fields needed to render
+        the items, with their related objects, and ordered by keyset_field.'''
+        queryset = self.get_changed_queryset(since)
+        needs = self.get_rendering_needs()
+        if needs:
+            if needs.only:
+                queryset = queryset.only(*needs.only)
+            if needs.select_related:
+                queryset = queryset.select_related(*needs.select_related)
+            if needs.prefetch_related:
+                queryset = queryset.prefetch_related(*needs.prefetch_related)
+
+        if self.keyset_field:
+            queryset = queryset.order_by(self.keyset_field)
+        return queryset
+
+    def get_instances(self, offset=None, limit=None, since=None):
+        '''Returns the model instances from position offset to position
+        limit, included. Without a range, the instances are iterated
+        without being kept in the cache of the queryset, unless related
+        objects have to be prefetched.'''
+        queryset = self.get_projected_queryset(since)
+        if offset is None:
+            needs = self.get_rendering_needs()
+            if needs and needs.prefetch_related:
+                return queryset
+            return queryset.iterator()
+
+        cursor = None
+        if self.keyset_field:
+            cursor = cache.get(self.get_cache_key('cursor', since, offset))
+            metrics.record_cache('cursor', cursor is not None)
+
+        size = limit - offset + 1
+        field = (self.keyset_field or '').lstrip('-')
+        if cursor is not None:
+            lookup = field + ('__lt' if self.keyset_field[0] == '-'
+                              else '__gt')
+            instances = list(queryset.filter(**{lookup: cursor})[:size])
+        else:
+            instances = list(queryset[offset:limit + 1])
+
+        if self.keyset_field and len(instances) == size:
+            cache.set(self.get_cache_key('cursor', since, limit + 1),
+                      getattr(instances[-1], field), self.cursor_timeout)
+        return instances
+
+    def get_count(self, since=None):
+        '''Returns the total number of items, cached for count_timeout
+        seconds.'''
+        if not self.count_timeout:
+            return self.get_changed_queryset(since).count()
+
+        key = self.get_cache_key('count', since)
+        count = cache.get(key)
+        metrics.record_cache('count', count is not None)
+        if count is None:
+            count = self.get_changed_queryset(since).count()
+            cache.set(key, count, self.count_timeout)
+        return count
+
+    def list(self, offset=None, limit=None, since=None):
+        return (self.get_item_node(instance) for instance
+                in self.get_instances(offset, limit, since))
+
+    def _get_range_params(self, request_range):
+        '''Ranges are served up to max_limit items at once.'''
+        if request_range.limit < request_range.offset:
+            raise RequestedRangeNotSatisfiableError(self)
+        return {'offset': request_range.offset,
+                'limit': min(request_range.limit,
+                             request_range.offset + self.max_limit - 1)}
+
+    def _set_content_range(self, response, kwparams, count, since=None):
+        super(ModelCollectionNode, self)._set_content_range(response,
+                                                            kwparams, count,
+                                                            since)
+        if count:
+            first, limit = kwparams['offset'], kwparams['limit']
+            last = first + count - 1
+            #A range served short is the end of the collection, no need to
+            #count it.
+            total = last + 1 if last < limit else self.get_count(since)
+            response['Content-Range'] = str(ContentRange(self.range_unit,
+                                                         first, last, total))
+
 
 class ResourceNode(Node):
+    '''fragment_timeout: when set, the rendering of the node in collections
+    is cached under its ETag for that many seconds, already encoded in JSON
+    (see nuages.core.fragments).'''
     method_handlers = RESOURCE_HTTP_METHODS_HANDLERS
+    fragment_timeout = None
 
     def render_in_collection(self):
         payload = super(ResourceNode, self).render_in_collection()
@@ -430,15 +1069,94 @@ class ResourceNode(Node):
         return payload
 
 
+class MetricsNode(ResourceNode):
+    '''Exposes the metrics collected by Nuages (see NUAGES_METRICS) in the
+    Prometheus text exposition format. To register it, subclass it with a
+    url, and override _can_read to grant access to the clients allowed to
+    read the metrics: like any node, it's denied by default.'''
+    outputs = ['text/plain', '*/*']
+
+    def retrieve(self):
+        return metrics.registry.expose()
+
+    def _process_get(self):
+        response = HttpResponse(node=self,
+                                content=self._call_http_method_handler(
+                                                                method='GET'),
+                                content_type=metrics.CONTENT_TYPE)
+        response.preformatted = True
+        return response
+
+
+class BlobNode(ResourceNode):
+    '''Serves a file as is, like an image or an archive, instead of a
+    serialized resource. Subclasses implement get_path(), returning the
+    path of the file, and _can_read.
+
+    Byte ranges are supported, including suffix ranges, several ranges at
+    once and If-Range. The ETag is computed from the metadata of the file.
+    Files are sent by the front server when NUAGES_SENDFILE_HEADER is set
+    (see nuages.core.blobs).
+
+    - content_type: Content type of the file, guessed from its name when
+    None.'''
+    content_type = None
+    outputs = ['application/octet-stream', '*/*']
+    _stat = None
+
+    def get_path(self):
+        raise NotImplementedError
+
+    def get_sendfile_path(self):
+        '''Returns the value of the NUAGES_SENDFILE_HEADER header, the path
+        of the file by default. Override it to map the path to the internal
+        location of the front server, for X-Accel-Redirect for instance.'''
+        return self.get_path()
+
+    def get_stat(self):
+        '''Returns the os.stat of the file, raises a NotFoundError if
+        there's none.'''
+        if self._stat is None:
+            path = self.get_path()
+            try:
+                self._stat = os.stat(path) if path else None
+            except OSError:
+                pass
+            if self._stat is None:
+                raise NotFoundError(self)
+        return self._stat
+
+    def get_etag(self):
+        return blobs.get_etag(self.get_stat())
+
+    def retrieve(self):
+        return self.get_path()
+
+    def _process_get(self):
+        path = self._call_http_method_handler(method='GET')
+        return blobs.serve(self, path, self.get_stat(),
+                           self.content_type or blobs.get_content_type(path))
 
 
 class NodeAlias(object):
     '''Represents a node that's an alias with a different URL pattern to
-    another node'''
+    another node
+
+    - rewrite: When True, requests are processed by the canonical node right
+    away, and their response carries its URL in a Content-Location header,
+    instead of redirecting clients to it. Any method is then accepted, and
+    left to the canonical node to allow. Canonical URLs served by something
+    else than a node, like another alias, are still redirected to.
+    - resolution_timeout: Number of seconds the URL of the canonical node
+    is kept in cache per alias URL, for aliases always resolving to the same
+    node. Override get_cache_key() if it depends on something else, like
+    the user.'''
     parent = None
     url = None
     name = ''
     permanent = True
+    rewrite = False
+    resolution_timeout = None
 
     def __init__(self, request, **kwargs):
         self.request = request
@@ -467,33 +1185,84 @@ class NodeAlias(object):
     @classmethod
     def get_allowed_methods(cls, implicits=True):
         implicit_methods = ['HEAD', 'OPTIONS'] if implicits else []
+        if cls.rewrite:
+            return ['GET', 'POST', 'PUT', 'PATCH', 'DELETE'] + implicit_methods
         return ['GET'] + implicit_methods
 
+    @classmethod
+    def get_cache_key(cls, request, **kwargs):
+        return cls.get_view_name() + str(sorted(kwargs.items()))
+
+    @classmethod
+    def get_canonical_path(cls, request, **kwargs):
+        '''Returns the path of the canonical node, and whether it's secure.'''
+        key = None
+        if cls.resolution_timeout:
+            key = cls.get_cache_key(request, **kwargs)
+            resolution = _resolutions.get(key)
+            metrics.record_cache('alias', resolution is not None)
+            if resolution is not None:
+                return resolution
+
+        with instrumentation.phase(request, 'instantiation'):
+            node = cls(request, **kwargs).get_canonical_node(**kwargs)
+        resolution = node.build_url(absolute=False), node.secure
+        if key:
+            _resolutions.set(key, resolution, cls.resolution_timeout)
+        return resolution
+
     @classmethod
     def process(cls, request, **kwargs):
-        if request.method not in cls.get_allowed_methods():
+        method = HttpRequest(request).method
+        if method not in cls.get_allowed_methods():
             raise MethodNotAllowedError(cls)
 
-        response = HttpResponse(status=301 if cls.permanent else 302)
-        response['Location'] = (cls(request, **kwargs)
-                                .get_canonical_node(**kwargs)
-                                .build_url())
+        path, secure = cls.get_canonical_path(request, **kwargs)
+        url = build_absolute_url(request, path, secure)
+        match = resolve(path) if cls.rewrite else None
+        node_cls = getattr(match and match.func, 'im_self', None)
+        if not isinstance(node_cls, type) or not issubclass(node_cls, Node):
+            #Only nodes can be processed in place, other views, aliases
+            #included, get a redirect which keeps the method.
+            status = 301 if cls.permanent else 302
+            if method not in IDEMPOTENT_METHODS:
+                status = 307
+            response = HttpResponse(status=status)
+            response['Location'] = url
+            return response
+
+        #The canonical node is validated as the middleware would have.
+        if method not in node_cls.get_allowed_methods():
+            raise MethodNotAllowedError(node_cls)
+        if (method != 'OPTIONS' and
+            not get_matching_mime_types_for_node(HttpRequest(request),
+                                                 node_cls)):
+            raise NotAcceptableError(node_cls)
+
+        response = match.func(request, *match.args, **match.kwargs)
+        if response.status_code < 400:
+            response['Content-Location'] = url
         return response
 
 
+_resolutions = LRUCache(ALIAS_CACHE_SIZE)
+
 
 class parseData(object):
     '''Decorates Node handler methods and allows incoming data to be parsed
-    and validated using a Form.
+    and validated using a Form or a Validator.
 
     Decorated Node handler method is called with mandatory parameters as args,
     and optional ones as kwargs'''
     def __init__(self, form_cls):
-        if not issubclass(form_cls, Form):
+        if (form_cls is not None and
+            not issubclass(form_cls, Form) and
+            not issubclass(form_cls, Validator)):
             raise ValueError('\'form_cls\' must be a subclass of ' \
-                             'nuages.forms.Form')
+                             'nuages.forms.Form or nuages.forms.Validator')
 
         self.form_cls = form_cls
+        self.is_validator = bool(form_cls) and issubclass(form_cls, Validator)
 
     def __call__(self, fn):
         if (fn.func_name not in RESOURCE_HTTP_METHODS_HANDLERS.values() and
@@ -501,6 +1270,7 @@ class parseData(object):
             raise RuntimeError('%s can only decorate Node handler methods' %
                                self.__class__.__name__)
 
+        @functools.wraps(fn)
         def wrapped_fn(*args, **kwargs):
             required, optional = self.parse(args[0])
             args += required
@@ -521,13 +1291,19 @@ class parseData(object):
     def parse(self, node):
         return (), {}
 
-
-class parseQueryString(parseData):
-    '''Added as a decorator, parses data from the query string and
-    validates it using the submitted Form instance.'''
-    def parse(self, node):
+    def validate(self, node, data):
         try:
-            form = self.form_cls(node.request.GET, node=node)
+            if self.is_validator:
+                required, optional, errors = self.form_cls.validate(data)
+                if errors:
+                    raise InvalidRequestError(
+                                        description=errors_as_text(errors))
+                #Passed as the fields of a Form are, see get_fields().
+                return (sum([(self.form_cls, value) for value in required],
+                            ()),
+                        optional)
+
+            form = self.form_cls(data, node=node)
             if not form.is_valid():
                 raise InvalidRequestError(description=form.errors_as_text())
             return self.get_fields(form)
@@ -535,18 +1311,41 @@ class parseQueryString(parseData):
             raise InvalidRequestError(description=str(e))
 
 
+class parseQueryString(parseData):
+    '''Added as a decorator, parses data from the query string and
+    validates it using the submitted Form or Validator class.'''
+    def parse(self, node):
+        return self.validate(node, node.request.GET)
+
+
 class parseBody(parseData):
     '''Added as a decorator, takes the data in the body of the request,
     checks if it came in a supported format, validates it using the submitted
-    Form instance, and passes it as required and optional parameters to the
-    handler method.
+    Form or Validator, and passes it as required and optional parameters to
+    the handler method.
 
     Can only decorate handlers of POST, PUT and PATCH methods.
 
-    Non url-encoded data is passed \'as is\' in the 'payload' attribute.
+    - form_cls: Form or Validator validating url-encoded and JSON bodies.
+    When None, the body is passed \'as is\' in the 'payload' parameter.
+    - content_types: Content types accepted by the handler.
+    - max_size: Maximum size of the body in bytes, checked against the
+    Content-Length header before anything is read.
+    - stream: When True, 'payload' is a nuages.http.BodyReader, which reads
+    the body from the client as the handler reads it, and hashes it on the
+    way, instead of a string. Iterating over it yields the chunks of the
+    body. form_cls is ignored.
+    - spool: When True, the body is streamed into a temporary file before
+    the handler is called, kept in memory up to NUAGES_BODY_SPOOL_THRESHOLD
+    bytes, so that the handler gets its hash up front and can read it more
+    than once. Implies stream.
     '''
-    def __init__(self, form_cls, content_types=[FORM_URL_ENCODED]):
+    def __init__(self, form_cls=None, content_types=[FORM_URL_ENCODED],
+                 max_size=MAX_BODY_SIZE, stream=False, spool=False):
         self.content_types = content_types
+        self.max_size = max_size
+        self.stream = stream or spool
+        self.spool = spool
         super(parseBody, self).__init__(form_cls)
 
     def parse(self, node):
@@ -555,28 +1354,142 @@ class parseBody(parseData):
                                'methods can\'t carry data in their bodies.' %
                                (self.__class__.__name__, node.request.method))
 
-        if not node.request.META.get('CONTENT_LENGTH', 0):
-            raise BadRequestError(node, 'Request has not payload')
-
+        content_length = self.get_content_length(node)
         request_content_type = node.request.META.get('CONTENT_TYPE')
         if request_content_type not in self.content_types:
-            raise UnsupportedMediaTypeError(node,
-                                            required_format=FORM_URL_ENCODED)
+            raise UnsupportedMediaTypeError(
+                            node, required_format=', '.join(self.content_types))
+
+        if self.stream:
+            reader = get_body_reader(node.request, content_length)
+            if self.spool:
+                with instrumentation.phase(node.request, 'body'):
+                    reader.spool(BODY_SPOOL_THRESHOLD)
+            return (), {'payload': reader}
+
+        if request_content_type == JSON:
+            try:
+                data = json.loads(read_body(node.request))
+            except ValueError, e:
+                raise InvalidRequestError(description='Invalid JSON: %s' % e)
 
-        if request_content_type != FORM_URL_ENCODED:
             if not self.form_cls:
-                return (), {'payload': node.request.raw_post_data}
+                return (), {'payload': data}
+            if not isinstance(data, dict):
+                raise InvalidRequestError(
+                                    description='A JSON object is expected.')
+            return self.validate(node, data)
+
+        if not self.form_cls:
+            return (), {'payload': read_body(node.request)}
+
+        if request_content_type != FORM_URL_ENCODED:
             raise UnsupportedMediaTypeError(node,
                                             required_format=FORM_URL_ENCODED)
 
+        return self.validate(node, QueryDict(read_body(node.request),
+                                             encoding=node.request.encoding))
+
+    def get_content_length(self, node):
         try:
-            form = self.form_cls(node.request.POST, node=node)
-            if not form.is_valid():
-                raise InvalidRequestError(description=form.errors_as_text())
-            return self.get_fields(form)
-        except UnexpectedFieldsError, e:
-            raise InvalidRequestError(description=str(e))
+            content_length = int(node.request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise BadRequestError(node, 'Invalid Content-Length header.')
+
+        if not content_length:
+            raise BadRequestError(node, 'Request has not payload')
 
+        if self.max_size and content_length > self.max_size:
+            raise RequestEntityTooLargeError(node, max_size=self.max_size)
+        return content_length
+
+    def parse_many(self, node, max_items):
+        '''Parses a JSON array of at most max_items elements, and returns
+        for each one of them either the (args, kwargs) tuple the decorated
+        handler would be called with, or the InvalidRequestError raised by
+        its validation.'''
+        self.get_content_length(node)
+        if node.request.META.get('CONTENT_TYPE') != JSON:
+            raise UnsupportedMediaTypeError(node, required_format=JSON)
+
+        try:
+            data = json.loads(read_body(node.request))
+        except ValueError, e:
+            raise InvalidRequestError(description='Invalid JSON: %s' % e)
+
+        if not isinstance(data, list):
+            raise InvalidRequestError(description='A JSON array is expected.')
+        if len(data) > max_items:
+            raise RequestEntityTooLargeError(node, description='At most %d ' \
+                                             'items can be sent at once.' %
+                                             max_items)
+
+        parsed = []
+        for element in data:
+            if not self.form_cls:
+                parsed.append(((), {'payload': element}))
+                continue
+
+            try:
+                if not isinstance(element, dict):
+                    raise InvalidRequestError(
+                                    description='A JSON object is expected.')
+                parsed.append(self.validate(node, element))
+            except InvalidRequestError, e:
+                parsed.append(e)
+        return parsed
+
+
+
+class parsePatch(parseBody):
+    '''Added as a decorator of modify handlers, parses a JSON Patch
+    (application/json-patch+json) or JSON Merge Patch
+    (application/merge-patch+json) body into a nuages.utils.patch.Patch
+    instance, passed to the handler in the 'patch' parameter.
+
+    The handler can go through patch.operations, or call patch.apply on
+    the current state of the resource; a PatchError raised by either turns
+    into a 409 response.'''
+    def __init__(self, content_types=[JSON_PATCH, MERGE_PATCH],
+                 max_size=MAX_BODY_SIZE):
+        super(parsePatch, self).__init__(None, content_types, max_size)
+
+    def parse(self, node):
+        if node.request.method != 'PATCH':
+            raise RuntimeError('%s can only decorate handlers of PATCH ' \
+                               'requests.' % self.__class__.__name__)
+
+        self.get_content_length(node)
+        content_type = node.request.META.get('CONTENT_TYPE')
+        if content_type not in self.content_types:
+            raise UnsupportedMediaTypeError(
+                    node, required_format=', '.join(self.content_types))
+
+        try:
+            node._patch = Patch(content_type,
+                                json.loads(read_body(node.request)))
+        except ValueError, e:
+            raise InvalidRequestError(description='Invalid patch: %s' % e)
+        return (), {'patch': node._patch}
+
+
+class prefetch(object):
+    '''Decorates the render_in_collection method of the item_node of a
+    ModelCollectionNode, declaring what it needs from the model instances
+    so that they're loaded with the queryset of the collection.
+
+    - only: Names of the fields to load, passed to QuerySet.only().
+    - select_related: Relations to join, passed to select_related().
+    - prefetch_related: Relations to load in a query of their own, passed
+    to prefetch_related() (Django 1.4+).'''
+    def __init__(self, only=None, select_related=(), prefetch_related=()):
+        self.only = only
+        self.select_related = select_related
+        self.prefetch_related = prefetch_related
+
+    def __call__(self, fn):
+        fn.func_dict[self.__class__.__name__] = self
+        return fn
 
 def get_method_handlers(node_cls):
     if issubclass(node_cls, CollectionNode):
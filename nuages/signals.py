@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from django.dispatch import Signal
+
+
+#Sent once Nuages is done with a request, with the duration of each phase
+#of its processing, in seconds. queries is the QueryAccount of the request
+#when queries are accounted, None otherwise.
+request_timed = Signal(providing_args=['request', 'response', 'node_cls',
+                                       'timings', 'duration', 'queries'])
+
+
+#Sent when a node turns a request away to protect itself, with the reason:
+#rate_limit, queue_time or concurrency.
+request_shed = Signal(providing_args=['request', 'node_cls', 'reason'])
@@ -1,12 +1,71 @@
 # -*- coding: utf-8 -*-
+from django.forms import fields
+from django.utils.encoding import force_unicode
+from nuages.core.serializers import is_serializable
 
 
 __all__ = ('EndPoint', 'Node', 'Method', 'QueryStringParameter',
            'BodyParameter')
 
 
+def get_field_schema(field):
+    '''Returns the JSON schema describing the values accepted by a form
+    field.'''
+    schema = {'type': 'string'}
+    if isinstance(field, fields.BooleanField):
+        schema = {'type': 'boolean'}
+    elif isinstance(field, fields.IntegerField):
+        schema = {'type': ('number' if isinstance(field, fields.FloatField)
+                           else 'integer')}
+        if field.min_value is not None:
+            schema['minimum'] = field.min_value
+        if field.max_value is not None:
+            schema['maximum'] = field.max_value
+    elif isinstance(field, fields.DecimalField):
+        schema = {'type': 'number'}
+    elif isinstance(field, fields.DateTimeField):
+        schema['format'] = 'date-time'
+    elif isinstance(field, fields.DateField):
+        schema['format'] = 'date'
+    elif isinstance(field, fields.TimeField):
+        schema['format'] = 'time'
+    elif isinstance(field, fields.ChoiceField):
+        #Choices of model fields are not listed, it would query the database.
+        enum = ([force_unicode(key) for key, _ in field.choices]
+                if not hasattr(field, 'queryset') else None)
+        if isinstance(field, fields.MultipleChoiceField):
+            schema = {'type': 'array', 'items': {'type': 'string'}}
+            if enum:
+                schema['items']['enum'] = enum
+        elif enum:
+            schema['enum'] = enum
+    elif isinstance(field, fields.CharField):
+        if isinstance(field, fields.EmailField):
+            schema['format'] = 'email'
+        elif isinstance(field, fields.URLField):
+            schema['format'] = 'uri'
+        if field.max_length is not None:
+            schema['maxLength'] = field.max_length
+        if field.min_length is not None:
+            schema['minLength'] = field.min_length
+
+    if field.label:
+        schema['title'] = force_unicode(field.label)
+    if field.help_text:
+        schema['description'] = force_unicode(field.help_text)
+    #A default which can't be encoded, e.g. a Decimal, is left out rather
+    #than breaking the documentation of the whole node.
+    if (field.initial is not None and not callable(field.initial) and
+        is_serializable(field.initial)):
+        schema['default'] = field.initial
+    return schema
+
+
 class DocElement(object):
-    pass
+    def to_dict(self):
+        '''Returns a representation of the element made of simple types
+        only, ready to be serialized.'''
+        raise NotImplementedError
 
 
 class EndPoint(DocElement):
@@ -14,27 +73,91 @@ class EndPoint(DocElement):
         self.url = url
         self.nodes = []
 
+    def to_dict(self):
+        return {'url': self.url,
+                'nodes': [node.to_dict() for node in self.nodes]}
+
 
 class Node(DocElement):
-    def __init__(self, name, url_regex, accept):
+    def __init__(self, name, url_regex, accept, description=''):
         self.name = name
         self.url_regex = url_regex
         self.accept = accept
+        self.description = description
         self.methods = []
 
+    def to_dict(self):
+        return {'name': self.name,
+                'url': self.url_regex,
+                'description': self.description,
+                'outputs': sorted(self.accept),
+                'allow': [method.verb for method in self.methods],
+                'methods': dict([(method.verb, method.to_dict())
+                                 for method in self.methods])}
+
 
 class Method(DocElement):
     def __init__(self, verb, description='', queryString_form=None,
                  body_form=None, content_types=[]):
         self.verb = verb
-        self.description = ''
-        self.required_parameters = []
-        self.optional_parameters = []
-        
+        self.description = (description or '').strip()
+        self.content_types = list(content_types)
+        self.query_parameters = QueryStringParameter.from_form(
+                                                            queryString_form)
+        self.body_parameters = BodyParameter.from_form(body_form)
+
+    @property
+    def required_parameters(self):
+        return [p for p in self.query_parameters + self.body_parameters
+                if p.required]
+
+    @property
+    def optional_parameters(self):
+        return [p for p in self.query_parameters + self.body_parameters
+                if not p.required]
+
+    def to_dict(self):
+        return {'description': self.description,
+                'content_types': self.content_types,
+                'query': Parameter.to_schema(self.query_parameters),
+                'body': Parameter.to_schema(self.body_parameters)}
 
-class QueryStringParameter(DocElement):
+
+class Parameter(DocElement):
+    def __init__(self, name, field):
+        self.name = name
+        self.field = field
+        self.required = field.required
+
+    def to_dict(self):
+        if hasattr(self.field, 'get_schema'):
+            return self.field.get_schema()
+        return get_field_schema(self.field)
+
+    @classmethod
+    def from_form(cls, form_cls):
+        if not form_cls:
+            return []
+        return [cls(name, field) for name, field
+                in form_cls.base_fields.items()]
+
+    @staticmethod
+    def to_schema(parameters):
+        '''Returns the JSON schema of an object made of the parameters.'''
+        if not parameters:
+            return None
+
+        return {'type': 'object',
+                'properties': dict([(p.name, p.to_dict())
+                                    for p in parameters]),
+                'required': sorted([p.name for p in parameters
+                                    if p.required]),
+                'additionalProperties': False}
+
+
+class QueryStringParameter(Parameter):
     pass
 
 
-class BodyParameter(DocElement):
-    pass
\ No newline at end of file
+class BodyParameter(Parameter):
+    pass
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+from collections import OrderedDict
+
+
+__all__ = ('LRUCache',)
+
+
+class LRUCache(object):
+    '''Thread-safe in-process cache keeping at most max_size entries, for
+    timeout seconds each. The least recently used entries are dropped first
+    once the cache is full.'''
+    def __init__(self, max_size=1000, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                return default
+
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._entries)
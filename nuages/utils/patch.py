@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import copy
+
+
+__all__ = ('JSON_PATCH', 'MERGE_PATCH', 'PatchError', 'Operation', 'Patch',
+           'parse_pointer')
+
+JSON_PATCH = 'application/json-patch+json'
+MERGE_PATCH = 'application/merge-patch+json'
+OPERATIONS = ('add', 'remove', 'replace', 'move', 'copy', 'test')
+
+
+class PatchError(ValueError):
+    '''Raised when a patch is malformed, or can't be applied to a
+    document.'''
+    pass
+
+
+def parse_pointer(pointer):
+    '''Returns the list of the reference tokens of a JSON pointer.
+    (http://tools.ietf.org/html/rfc6901)'''
+    if not isinstance(pointer, basestring):
+        raise PatchError('A JSON pointer must be a string.')
+    if not pointer:
+        return []
+    if not pointer.startswith('/'):
+        raise PatchError('Invalid JSON pointer: %s' % pointer)
+    return [token.replace('~1', '/').replace('~0', '~')
+            for token in pointer[1:].split('/')]
+
+
+def get_index(container, token, adding=False):
+    if adding and token == '-':
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith('0')):
+        raise PatchError('Invalid array index: %s' % token)
+
+    index = int(token)
+    if index > len(container) or (not adding and index == len(container)):
+        raise PatchError('Array index out of range: %s' % token)
+    return index
+
+
+def resolve(document, tokens):
+    '''Returns the value of document the tokens point to.'''
+    for token in tokens:
+        if isinstance(document, list):
+            document = document[get_index(document, token)]
+        elif isinstance(document, dict) and token in document:
+            document = document[token]
+        else:
+            raise PatchError('Path not found: /%s' % '/'.join(tokens))
+    return document
+
+
+class Operation(object):
+    '''Operation of a JSON Patch (http://tools.ietf.org/html/rfc6902).
+    path and from_ are the JSON pointers of the operation, and tokens and
+    from_tokens their reference tokens.'''
+    def __init__(self, op, path, value=None, from_=None):
+        self.op = op
+        self.path = path
+        self.value = value
+        self.from_ = from_
+        self.tokens = parse_pointer(path)
+        self.from_tokens = (parse_pointer(from_) if from_ is not None
+                            else None)
+
+    @classmethod
+    def parse(cls, data):
+        if not isinstance(data, dict):
+            raise PatchError('A patch operation must be a JSON object.')
+
+        op = data.get('op')
+        if op not in OPERATIONS:
+            raise PatchError('Invalid patch operation: %s' % op)
+        if 'path' not in data:
+            raise PatchError('The "path" of a patch operation is missing.')
+        if op in ['add', 'replace', 'test'] and 'value' not in data:
+            raise PatchError('The "value" of a patch operation is missing.')
+        if op in ['move', 'copy'] and 'from' not in data:
+            raise PatchError('The "from" of a patch operation is missing.')
+        return cls(op, data['path'], data.get('value'), data.get('from'))
+
+    def apply(self, document):
+        '''Applies the operation to document, modifying it in place, and
+        returns the document, which is a new one when the root is
+        replaced.'''
+        if self.op == 'test':
+            if resolve(document, self.tokens) != self.value:
+                raise PatchError('Test failed: %s' % self.path)
+            return document
+
+        if self.op == 'move':
+            if self.tokens[:len(self.from_tokens)] == self.from_tokens and \
+               self.tokens != self.from_tokens:
+                raise PatchError('Can\'t move a value into itself.')
+            value = resolve(document, self.from_tokens)
+            document = self.remove(document, self.from_tokens)
+            return self.add(document, self.tokens, value)
+
+        if self.op == 'copy':
+            value = copy.deepcopy(resolve(document, self.from_tokens))
+            return self.add(document, self.tokens, value)
+
+        if self.op == 'remove':
+            return self.remove(document, self.tokens)
+
+        if self.op == 'replace':
+            resolve(document, self.tokens)
+            document = self.remove(document, self.tokens)
+        return self.add(document, self.tokens, copy.deepcopy(self.value))
+
+    def add(self, document, tokens, value):
+        if not tokens:
+            return value
+
+        parent = resolve(document, tokens[:-1])
+        if isinstance(parent, list):
+            parent.insert(get_index(parent, tokens[-1], adding=True), value)
+        elif isinstance(parent, dict):
+            parent[tokens[-1]] = value
+        else:
+            raise PatchError('Path not found: /%s' % '/'.join(tokens))
+        return document
+
+    def remove(self, document, tokens):
+        if not tokens:
+            return None
+
+        parent = resolve(document, tokens[:-1])
+        if isinstance(parent, list):
+            del parent[get_index(parent, tokens[-1])]
+        elif isinstance(parent, dict) and tokens[-1] in parent:
+            del parent[tokens[-1]]
+        else:
+            raise PatchError('Path not found: /%s' % '/'.join(tokens))
+        return document
+
+    def to_dict(self):
+        data = {'op': self.op, 'path': self.path}
+        if self.op in ['add', 'replace', 'test']:
+            data['value'] = self.value
+        if self.from_ is not None:
+            data['from'] = self.from_
+        return data
+
+
+def escape_token(token):
+    return token.replace('~', '~0').replace('/', '~1')
+
+
+def merge_to_operations(patch, prefix=''):
+    '''Returns the JSON Patch operations equivalent to a JSON Merge Patch
+    applied to an object holding objects where the patch does.'''
+    operations = []
+    for key, value in patch.items():
+        path = prefix + '/' + escape_token(key)
+        if value is None:
+            operations.append(Operation('remove', path))
+        elif isinstance(value, dict):
+            operations += merge_to_operations(value, path)
+        else:
+            operations.append(Operation('add', path, value))
+    return operations
+
+
+def merge(document, patch):
+    '''Applies a JSON Merge Patch to document, and returns the result.
+    (http://tools.ietf.org/html/rfc7396)'''
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if not isinstance(document, dict):
+        document = {}
+
+    for key, value in patch.items():
+        if value is None:
+            document.pop(key, None)
+        else:
+            document[key] = merge(document.get(key), value)
+    return document
+
+
+class Patch(object):
+    '''Changes sent in the body of a PATCH request, either as a JSON Patch
+    or as a JSON Merge Patch.
+
+    Handlers can go through the operations, which are JSON Patch operations
+    in both cases, or have the patch applied to a document.'''
+    def __init__(self, content_type, data):
+        self.content_type = content_type
+        self.data = data
+        if content_type == MERGE_PATCH:
+            if not isinstance(data, dict):
+                raise PatchError('A JSON Merge Patch must be a JSON object.')
+            self.operations = merge_to_operations(data)
+        else:
+            if not isinstance(data, list):
+                raise PatchError('A JSON Patch must be a JSON array.')
+            self.operations = map(Operation.parse, data)
+
+    def get_fields(self):
+        '''Returns the names of the top-level members changed by the patch,
+        None if the whole document is.'''
+        fields = set()
+        for operation in self.operations:
+            if operation.op == 'test':
+                continue
+            if not operation.tokens:
+                return None
+            fields.add(operation.tokens[0])
+            if operation.op == 'move':
+                if not operation.from_tokens:
+                    return None
+                fields.add(operation.from_tokens[0])
+        return fields
+
+    def apply(self, document):
+        '''Returns a copy of document with the patch applied. Raises a
+        PatchError if it can't be.'''
+        document = copy.deepcopy(document)
+        if self.content_type == MERGE_PATCH:
+            return merge(document, self.data)
+
+        for operation in self.operations:
+            document = operation.apply(document)
+        return document